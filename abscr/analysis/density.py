@@ -0,0 +1,140 @@
+'''Binned FFT kernel density estimation of cell positions'''
+
+import logging
+import os
+import numpy as np
+from scipy import signal
+
+# estimators per outline file, see DensityEstimator.for_file
+_file_cache = {}
+
+
+def scott_factor(n):
+    '''
+    Returns Scott's bandwidth factor n ** (-1 / 6) for two-dimensional data, as used by scipy.stats.gaussian_kde.
+    '''
+    return n ** (-1 / 6)
+
+
+class DensityEstimator:
+    '''
+    Gaussian kernel density estimate of 2D points on a regular grid, computed by binning the points onto
+    the grid nodes and convolving the bin counts with the Gaussian kernel by FFT. This takes
+    O(n + N^2 log N) time for n points on an N x N grid, instead of O(n N^2) for the exact evaluation with
+    scipy.stats.gaussian_kde, which it matches closely: the kernel has the full covariance of the data
+    scaled by Scott's factor.
+
+    The bin position of every point is computed once, so the density of any subset of the points
+    (e.g. a selection in the app) only needs a re-binning of the subset and one convolution.
+
+        Parameters:
+            x, y (array-like): point coordinates
+            grid_size (int, default 300): number of grid nodes along each axis
+            extent (tuple): (xmin, xmax, ymin, ymax) of the grid, defaults to the range of the points
+    '''
+
+    def __init__(self, x, y, grid_size=300, extent=None) -> None:
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.grid_size = grid_size
+        if extent is None:
+            extent = (self.x.min(), self.x.max(), self.y.min(), self.y.max())
+        self.extent = extent
+        xmin, xmax, ymin, ymax = extent
+        self.X, self.Y = np.mgrid[xmin:xmax:grid_size * 1j, ymin:ymax:grid_size * 1j]
+        self.dx = (xmax - xmin) / (grid_size - 1) if xmax > xmin else 1.0
+        self.dy = (ymax - ymin) / (grid_size - 1) if ymax > ymin else 1.0
+
+        # linear binning: every point is split between the four grid nodes around it
+        fx = np.clip((self.x - xmin) / self.dx, 0, grid_size - 1)
+        fy = np.clip((self.y - ymin) / self.dy, 0, grid_size - 1)
+        ix = np.minimum(fx.astype(int), grid_size - 2)
+        iy = np.minimum(fy.astype(int), grid_size - 2)
+        wx, wy = fx - ix, fy - iy
+        self._bin_index = np.stack([ix * grid_size + iy, ix * grid_size + iy + 1,
+                                    (ix + 1) * grid_size + iy, (ix + 1) * grid_size + iy + 1], axis=1)
+        self._bin_weight = np.stack([(1 - wx) * (1 - wy), (1 - wx) * wy, wx * (1 - wy), wx * wy], axis=1)
+        self._all_bins = self._bin(slice(None))
+        self._cache = {}
+
+    @classmethod
+    def for_file(cls, filename, x, y, **kwargs):
+        '''
+        Returns the estimator of the points of an outline file, reusing the one created before as long as
+        the file is unchanged.
+        '''
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, tuple(sorted(kwargs.items())))
+        if key not in _file_cache:
+            _file_cache[key] = cls(x, y, **kwargs)
+        return _file_cache[key]
+
+    def _bin(self, indices):
+        counts = np.bincount(self._bin_index[indices].ravel(), weights=self._bin_weight[indices].ravel(),
+                             minlength=self.grid_size ** 2)
+        return counts.reshape(self.grid_size, self.grid_size)
+
+    def bandwidth(self, indices=None):
+        '''
+        Returns the kernel covariance of a subset of the points (all points if indices is None):
+        the data covariance times the squared Scott factor.
+        '''
+        x, y = (self.x, self.y) if indices is None else (self.x[indices], self.y[indices])
+        return np.cov(np.vstack([x, y])) * scott_factor(len(x)) ** 2
+
+    def kernel(self, covariance):
+        '''
+        Evaluates the Gaussian kernel with the given covariance on the grid offsets, truncated at 4
+        standard deviations and at the grid size.
+        '''
+        half_x = min(self.grid_size - 1, int(np.ceil(4 * np.sqrt(covariance[0, 0]) / self.dx)))
+        half_y = min(self.grid_size - 1, int(np.ceil(4 * np.sqrt(covariance[1, 1]) / self.dy)))
+        ox, oy = np.mgrid[-half_x:half_x + 1, -half_y:half_y + 1]
+        offsets = np.stack([ox.ravel() * self.dx, oy.ravel() * self.dy])
+        inv = np.linalg.inv(covariance)
+        energy = np.sum(offsets * (inv @ offsets), axis=0) / 2
+        norm = 2 * np.pi * np.sqrt(np.linalg.det(covariance))
+        return (np.exp(-energy) / norm).reshape(ox.shape)
+
+    def density(self, indices=None):
+        '''
+        Returns the density of all points, or of the subset given by indices, on the grid.
+
+            Parameters:
+                indices (array-like): indices of the subset, all points if None
+
+            Returns:
+                X, Y, Z (np.ndarray): grid coordinates and density, as np.mgrid[xmin:xmax, ymin:ymax]
+        '''
+        if indices is not None:
+            indices = np.unique(np.asarray(indices, dtype=int))
+            if len(indices) == len(self.x):
+                indices = None
+        if indices is None and 'all' in self._cache:
+            return self.X, self.Y, self._cache['all']
+
+        n = len(self.x) if indices is None else len(indices)
+        if n < 2:
+            return self.X, self.Y, np.zeros_like(self.X)
+
+        if indices is None:
+            bins = self._all_bins
+        elif 2 * n > len(self.x):
+            # re-bin the smaller side of the selection
+            complement = np.ones(len(self.x), dtype=bool)
+            complement[indices] = False
+            bins = self._all_bins - self._bin(complement)
+        else:
+            bins = self._bin(indices)
+
+        covariance = self.bandwidth(indices)
+        if not np.all(np.isfinite(covariance)) or np.linalg.det(covariance) <= 0:
+            # e.g. collinear points; fall back to an isotropic kernel of about one grid cell
+            logging.warning('Singular point covariance, using a kernel of one grid cell')
+            covariance = np.diag([max(covariance[0, 0], self.dx ** 2), max(covariance[1, 1], self.dy ** 2)])
+        Z = signal.fftconvolve(bins, self.kernel(covariance), mode='same') / n
+        # FFT round-off can leave tiny negative values
+        np.maximum(Z, 0, out=Z)
+        if indices is None:
+            self._cache['all'] = Z
+        return self.X, self.Y, Z
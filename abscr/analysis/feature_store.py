@@ -0,0 +1,245 @@
+'''Persistent columnar per-cell feature store, partitioned by spatial tile'''
+
+import json
+import logging
+import operator
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from abscr.analysis.features import compute_features
+
+STORE_VERSION = 1
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq,
+             '!=': operator.ne}
+
+
+def _may_match(op, value, low, high):
+    # whether a partition with column values in [low, high] can hold a row matching the predicate
+    if op == '<':
+        return low < value
+    if op == '<=':
+        return low <= value
+    if op == '>':
+        return high > value
+    if op == '>=':
+        return high >= value
+    if op == '==':
+        return low <= value <= high
+    return not low == high == value
+
+
+class FeatureStore:
+    '''
+    Per-cell features of one slide, stored column by column and partitioned by spatial tile:
+
+        <path>/meta.json
+        <path>/<col>_<row>/<column>.npy
+
+    Every cell is stored in the partition of the tile of its centroid. meta.json holds the columns, the
+    partitions with their cell count and the minimum and maximum of every column, and the class names of
+    the cell_class column, which is stored as int16 codes (-1 for unclassified cells). Queries read only the
+    partitions whose minimum and maximum can satisfy the region and the predicates, and only the columns
+    they need, memory-mapped.
+
+    Stores are written with FeatureStore.write or FeatureStore.from_polygons and opened with
+    FeatureStore(path).
+
+        Parameters:
+            path (str): directory of the store
+    '''
+
+    def __init__(self, path) -> None:
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            logging.error(f'{path} is not a feature store')
+            raise ValueError(f'No feature store found at {path}')
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != STORE_VERSION:
+            raise ValueError(f"Feature store version {self.meta['version']} of {path} is not supported")
+        self.columns = self.meta['columns']
+        self.class_names = self.meta['class_names']
+        self.tile_size = self.meta['tile_size']
+
+    @classmethod
+    def write(cls, path, features, tile_size=2048, classes=None, slide=None):
+        '''
+        Writes a feature store, replacing an existing one at path.
+
+            Parameters:
+                path (str): directory of the store
+                features (dict or pd.DataFrame): equally long columns, including the centroid x and y
+                tile_size (int, default 2048): side of the partition tiles, in the units of x and y
+                classes (array-like): class name of every cell, None for unclassified cells
+                slide (str): name of the slide, stored in meta.json
+
+            Returns:
+                store (FeatureStore): the written store
+        '''
+        columns = {c: np.asarray(features[c]) for c in features.keys()}
+        if 'label' not in columns:
+            # labels in input order, as in outline files
+            columns['label'] = np.arange(1, len(columns['x']) + 1, dtype=np.int32)
+        class_names = []
+        if classes is not None:
+            classes = pd.Categorical([None if c is None or c != c else str(c) for c in classes])
+            class_names = [str(c) for c in classes.categories]
+            columns['cell_class'] = classes.codes.astype(np.int16)
+        else:
+            columns['cell_class'] = np.full(len(columns['x']), -1, dtype=np.int16)
+
+        tile_col = np.floor(columns['x'] / tile_size).astype(int)
+        tile_row = np.floor(columns['y'] / tile_size).astype(int)
+        order = np.lexsort((tile_col, tile_row))
+        keys = np.column_stack([tile_col[order], tile_row[order]])
+        starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+        if len(order) == 0:
+            # a slide without cells gets a store without partitions
+            starts = starts[:0]
+        ends = np.r_[starts[1:], len(order)]
+
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=parent)
+        partitions = []
+        try:
+            for start, end in zip(starts, ends):
+                col, row = keys[start]
+                name = f'{col}_{row}'
+                rows = order[start:end]
+                os.makedirs(os.path.join(tmp_dir, name))
+                stats = {}
+                for c, values in columns.items():
+                    part = values[rows]
+                    np.save(os.path.join(tmp_dir, name, f'{c}.npy'), part)
+                    # NaN metrics (e.g. of degenerate polygons) are left out of the statistics
+                    if part.dtype.kind == 'f' and not np.isnan(part).all():
+                        stats[c] = [np.nanmin(part).item(), np.nanmax(part).item()]
+                    else:
+                        stats[c] = [part.min().item(), part.max().item()]
+                partitions.append({'name': name, 'col': int(col), 'row': int(row), 'count': int(end - start),
+                                   'stats': stats})
+            meta = {
+                'version': STORE_VERSION,
+                'slide': slide,
+                'tile_size': tile_size,
+                'count': len(order),
+                'columns': {c: values.dtype.str for c, values in columns.items()},
+                'class_names': class_names,
+                'partitions': partitions,
+            }
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_dir, path)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logging.info(f'Wrote the features of {len(order)} cells in {len(partitions)} partitions to {path}')
+        return cls(path)
+
+    @classmethod
+    def from_polygons(cls, path, polygons, tile_size=2048, classes=None, slide=None):
+        '''
+        Computes the features of Cellpose outline polygons (see abscr.analysis.features) and writes them
+        to a feature store.
+        '''
+        return cls.write(path, compute_features(polygons), tile_size=tile_size, classes=classes, slide=slide)
+
+    def _predicates(self, where):
+        predicates = []
+        for column, op, value in where or []:
+            if column not in self.columns:
+                raise ValueError(f'Unknown column {column}')
+            if op not in OPERATORS:
+                raise ValueError(f'Unknown operator {op}, expected one of {list(OPERATORS)}')
+            if column == 'cell_class':
+                # compare the codes; classes not in the store have no code
+                value = self.class_names.index(value) if value in self.class_names else -2
+            predicates.append((column, op, value))
+        return predicates
+
+    def partitions(self, bbox=None, where=None):
+        '''
+        Returns the partitions a query has to read: those overlapping the region whose column minima and
+        maxima can satisfy the predicates.
+        '''
+        predicates = self._predicates(where)
+        selected = []
+        for partition in self.meta['partitions']:
+            stats = partition['stats']
+            if bbox is not None:
+                x0, y0, x1, y1 = bbox
+                if stats['x'][1] < x0 or stats['x'][0] > x1 or stats['y'][1] < y0 or stats['y'][0] > y1:
+                    continue
+            if all(_may_match(op, value, *stats[column]) for column, op, value in predicates):
+                selected.append(partition)
+        return selected
+
+    def query(self, bbox=None, where=None, columns=None):
+        '''
+        Returns the cells whose centroid lies in a region and that satisfy all predicates.
+
+            Parameters:
+                bbox (tuple): (x0, y0, x1, y1) of the region, inclusive, the whole slide if None
+                where (list): (column, operator, value) predicates, e.g. [('roundness', '>', 0.8)];
+                    operators are <, <=, >, >=, == and !=, cell_class is compared by class name
+                columns (list): columns of the result, all columns if None
+
+            Returns:
+                cells (pd.DataFrame): one row per cell, with cell_class as a categorical of the class names
+        '''
+        columns = list(self.columns) if columns is None else list(columns)
+        for column in columns:
+            if column not in self.columns:
+                raise ValueError(f'Unknown column {column}')
+        predicates = self._predicates(where)
+        needed = list(dict.fromkeys(columns + [c for c, _, _ in predicates] + (['x', 'y'] if bbox else [])))
+
+        parts = []
+        for partition in self.partitions(bbox, where):
+            data = {c: np.load(os.path.join(self.path, partition['name'], f'{c}.npy'), mmap_mode='r')
+                    for c in needed}
+            keep = np.ones(partition['count'], dtype=bool)
+            if bbox is not None:
+                x0, y0, x1, y1 = bbox
+                keep &= (data['x'] >= x0) & (data['x'] <= x1) & (data['y'] >= y0) & (data['y'] <= y1)
+            for column, op, value in predicates:
+                keep &= OPERATORS[op](data[column], value)
+            parts.append({c: np.asarray(data[c][keep]) for c in columns})
+
+        if parts:
+            result = pd.DataFrame({c: np.concatenate([part[c] for part in parts]) for c in columns})
+        else:
+            result = pd.DataFrame({c: np.zeros(0, dtype=self.columns[c]) for c in columns})
+        if 'cell_class' in result:
+            result['cell_class'] = pd.Categorical.from_codes(result['cell_class'].to_numpy(),
+                                                             categories=self.class_names)
+        return result
+
+
+def query_cohort(paths, bbox=None, where=None, columns=None):
+    '''
+    Runs a query over the feature stores of many slides.
+
+        Parameters:
+            paths (list): directories of the feature stores
+            bbox, where, columns: as in FeatureStore.query
+
+        Returns:
+            cells (pd.DataFrame): the cells of all slides, with the slide name (or the store directory if the
+                store has no slide name) in the first column, slide
+    '''
+    results = []
+    for path in paths:
+        store = FeatureStore(path)
+        cells = store.query(bbox=bbox, where=where, columns=columns)
+        cells.insert(0, 'slide', store.meta['slide'] or path)
+        results.append(cells)
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,172 @@
+'''Per-cell features of Cellpose outline files, cached in columnar sidecar files'''
+
+import hashlib
+import logging
+import os
+import numpy as np
+import shapely
+
+FEATURE_COLUMNS = ['x', 'y', 'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1', 'area', 'diameter', 'convexity', 'solidity',
+                   'roundness']
+SIDECAR_SUFFIX = '.features.npz'
+# bumped whenever the computed columns change, so that old sidecars are recomputed
+SIDECAR_VERSION = 2
+
+
+def read_outlines(filename):
+    '''
+    Reads a Cellpose outline file (one polygon per line as x1,y1,x2,y2,...).
+
+        Returns:
+            polygons (list): (n, 2) int arrays of x, y coordinates
+    '''
+    polygons = []
+    with open(filename) as f:
+        for line in f:
+            if len(line) < 2:
+                continue
+            coords = np.fromstring(line, sep=',').astype(int)
+            polygons.append(coords.reshape(-1, 2))
+    return polygons
+
+
+def compute_features(polygons, chunk_size=10000, progress=None):
+    '''
+    Computes the centroid, the bounding box, the area, the shape metrics of abscr.analysis.analysis
+    (convexity, solidity, roundness) and the diameter of the minimum bounding circle of every polygon. The metrics are computed
+    with the vectorised shapely functions, chunk_size polygons at a time.
+
+        Parameters:
+            polygons (list): (n, 2) arrays of x, y coordinates
+            chunk_size (int, default 10000): number of polygons per chunk
+            progress (callable): called as progress(done, total) after every chunk
+
+        Returns:
+            features (dict): one np.ndarray per column of FEATURE_COLUMNS
+    '''
+    columns = {c: [] for c in FEATURE_COLUMNS}
+    total = len(polygons)
+    for start in range(0, total, chunk_size):
+        chunk = polygons[start:start + chunk_size]
+        rings = shapely.linearrings(np.concatenate(chunk), indices=np.repeat(np.arange(len(chunk)),
+                                                                              [len(p) for p in chunk]))
+        polys = shapely.polygons(rings)
+        hulls = shapely.convex_hull(polys)
+        centroids = shapely.centroid(polys)
+        area = shapely.area(polys)
+        hull_length = shapely.length(hulls)
+        columns['x'].append(shapely.get_x(centroids))
+        columns['y'].append(shapely.get_y(centroids))
+        bounds = shapely.bounds(polys)
+        for i, c in enumerate(['bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1']):
+            columns[c].append(bounds[:, i])
+        columns['area'].append(area)
+        columns['diameter'].append(2 * shapely.minimum_bounding_radius(polys))
+        columns['convexity'].append(hull_length / shapely.length(polys))
+        columns['solidity'].append(area / shapely.area(hulls))
+        columns['roundness'].append(4 * np.pi * area / hull_length ** 2)
+        if progress is not None:
+            progress(min(start + chunk_size, total), total)
+    return {c: np.concatenate(v) if v else np.zeros(0) for c, v in columns.items()}
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class FeatureSidecar:
+    '''
+    Columnar cache of the features and polygons of an outline file, stored next to it (or in cache_dir)
+    as <outline file>.features.npz. The sidecar is valid while the size and modification time of the
+    outline file are unchanged; if they differ, the content hash decides, so a copied or touched file
+    doesn't trigger a recomputation.
+
+    The polygons are stored flat, as the concatenated x and y coordinates and the offset of every
+    polygon, so loading a sidecar doesn't parse the outline file.
+
+        Parameters:
+            filename (str): path to the outline file
+            cache_dir (str): directory of the sidecar, defaults to the directory of the outline file
+    '''
+
+    def __init__(self, filename, cache_dir=None) -> None:
+        self.filename = filename
+        directory = cache_dir if cache_dir is not None else os.path.dirname(filename)
+        self.path = os.path.join(directory, os.path.basename(filename) + SIDECAR_SUFFIX)
+
+    def is_valid(self):
+        '''
+        Returns True if the sidecar exists and matches the outline file.
+        '''
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                meta = data['meta']
+                digest = str(data['sha1'])
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f'Unreadable feature sidecar {self.path}: {e}')
+            return False
+        if meta[0] != SIDECAR_VERSION:
+            return False
+        if tuple(meta[1:]) == file_signature(self.filename):
+            return True
+        return digest == file_hash(self.filename)
+
+    def load(self):
+        '''
+        Loads the sidecar.
+
+            Returns:
+                features (dict): one np.ndarray per column of FEATURE_COLUMNS
+                polygons (list): (n, 2) int arrays of x, y coordinates
+        '''
+        with np.load(self.path) as data:
+            features = {c: data[c] for c in FEATURE_COLUMNS}
+            coords = np.column_stack([data['poly_x'], data['poly_y']])
+            offsets = data['offsets']
+        polygons = np.split(coords, offsets[1:-1])
+        return features, polygons
+
+    def compute(self, progress=None):
+        '''
+        Reads the outline file, computes the features and writes the sidecar.
+
+            Parameters:
+                progress (callable): called as progress(done, total), see compute_features
+
+            Returns:
+                features, polygons: as returned by load
+        '''
+        signature = file_signature(self.filename)
+        digest = file_hash(self.filename)
+        polygons = read_outlines(self.filename)
+        features = compute_features(polygons, progress=progress)
+
+        coords = np.concatenate(polygons) if polygons else np.zeros((0, 2), dtype=int)
+        offsets = np.cumsum([0] + [len(p) for p in polygons])
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # written to a temporary file first, so a concurrent reader never sees a partial sidecar
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, **features, poly_x=coords[:, 0].astype(np.int32), poly_y=coords[:, 1].astype(np.int32),
+                 offsets=offsets, meta=np.array([SIDECAR_VERSION, *signature], dtype=np.int64), sha1=digest)
+        os.replace(tmp_path, self.path)
+        logging.info(f'Wrote the features of {len(polygons)} cells to {self.path}')
+        return features, polygons
+
+    def get(self, progress=None):
+        '''
+        Returns the features and polygons of the outline file, from the sidecar if it is valid.
+        '''
+        if self.is_valid():
+            return self.load()
+        return self.compute(progress=progress)
@@ -0,0 +1,132 @@
+'''Spatial neighbourhood statistics of cells, computed with KD-trees over their centroids'''
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+
+def mask_centroids(masks):
+    '''
+    Returns the labels and the centroids of the cells of a label mask, in ascending label order.
+
+        Parameters:
+            masks (np.ndarray): label mask, 0 is background
+
+        Returns:
+            labels (np.ndarray): labels of the cells
+            x, y (np.ndarray): centroid coordinates (column, row) of the cells
+    '''
+    labels = np.unique(masks)
+    labels = labels[labels != 0]
+    if len(labels) == 0:
+        return labels, np.zeros(0), np.zeros(0)
+    centroids = np.array(ndimage.center_of_mass(np.ones(masks.shape), masks, labels)).reshape(-1, 2)
+    return labels, centroids[:, 1], centroids[:, 0]
+
+
+class NeighbourhoodAnalysis:
+    '''
+    Neighbourhood statistics of every cell of a segmentation: the distance to the nearest neighbouring
+    cell, the local density within a radius and, for a second cell population (e.g. immune cells), the
+    distance to the nearest cell of that population and the number of its cells within a radius.
+
+    The centroids are indexed once in a KD-tree, and all queries are run in chunks of chunk_size cells, so
+    memory stays bounded for slides with a million cells. The results are in the order of the input
+    cells, so they can be joined with a morphology table of the same cells.
+
+        Parameters:
+            x, y (array-like): centroid coordinates of the cells
+            chunk_size (int, default 100000): number of cells per query
+            workers (int, default 1): number of threads of the KD-tree queries, -1 uses all CPUs
+    '''
+
+    def __init__(self, x, y, chunk_size=100000, workers=1) -> None:
+        self.points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.tree = cKDTree(self.points)
+
+    def _chunks(self):
+        for start in range(0, len(self.points), self.chunk_size):
+            yield slice(start, start + self.chunk_size)
+
+    def nearest_neighbour_distance(self):
+        '''
+        Returns the distance of every cell to its nearest neighbouring cell (inf if it is the only cell).
+        '''
+        result = np.full(len(self.points), np.inf)
+        if len(self.points) < 2:
+            return result
+        for chunk in self._chunks():
+            # the nearest point is the cell itself
+            distances, _ = self.tree.query(self.points[chunk], k=2, workers=self.workers)
+            result[chunk] = distances[:, 1]
+        return result
+
+    def neighbour_count(self, radius):
+        '''
+        Returns the number of other cells within radius of every cell.
+        '''
+        result = np.zeros(len(self.points), dtype=int)
+        for chunk in self._chunks():
+            result[chunk] = self.tree.query_ball_point(self.points[chunk], radius, workers=self.workers,
+                                                       return_length=True) - 1
+        return result
+
+    def local_density(self, radius):
+        '''
+        Returns the number of other cells within radius of every cell per unit area (cells per pixel² for
+        pixel coordinates).
+        '''
+        return self.neighbour_count(radius) / (np.pi * radius ** 2)
+
+    def colocation(self, other_x, other_y, radius):
+        '''
+        Relates every cell to a second cell population.
+
+            Parameters:
+                other_x, other_y (array-like): centroid coordinates of the other population
+                radius (float): neighbourhood radius
+
+            Returns:
+                distance (np.ndarray): distance of every cell to the nearest cell of the other population,
+                    inf if it is empty
+                count (np.ndarray): number of cells of the other population within radius of every cell
+        '''
+        other = np.column_stack([np.asarray(other_x, dtype=float), np.asarray(other_y, dtype=float)])
+        distance = np.full(len(self.points), np.inf)
+        count = np.zeros(len(self.points), dtype=int)
+        if len(other) == 0:
+            return distance, count
+        other_tree = cKDTree(other)
+        for chunk in self._chunks():
+            distance[chunk], _ = other_tree.query(self.points[chunk], k=1, workers=self.workers)
+            count[chunk] = other_tree.query_ball_point(self.points[chunk], radius, workers=self.workers,
+                                                       return_length=True)
+        return distance, count
+
+    def table(self, radius, other=None, prefix='immune'):
+        '''
+        Returns the neighbourhood statistics as a table with one row per cell, in input order.
+
+            Parameters:
+                radius (float): neighbourhood radius of the density and co-location columns
+                other (tuple): (x, y) centroid coordinates of a second cell population, optional
+                prefix (str, default 'immune'): column name prefix of the second population
+
+            Returns:
+                table (pd.DataFrame): columns nn_distance, neighbours, local_density and, with other,
+                    <prefix>_distance and <prefix>_count
+        '''
+        neighbours = self.neighbour_count(radius)
+        table = pd.DataFrame({
+            'nn_distance': self.nearest_neighbour_distance(),
+            'neighbours': neighbours,
+            'local_density': neighbours / (np.pi * radius ** 2),
+        })
+        if other is not None:
+            distance, count = self.colocation(other[0], other[1], radius)
+            table[f'{prefix}_distance'] = distance
+            table[f'{prefix}_count'] = count
+        return table
@@ -0,0 +1,468 @@
+'''Command-line entry point for parallel batch segmentation and counting'''
+
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from abscr.batch.manifest import JobManifest
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.scn', '.bif', '.mrxs')
+
+# resident per-worker state, set up once by _init_worker
+_segmentor = None
+_counter = None
+_preprocessor = None
+_cpu_config = None
+
+
+def collect_units(inputs, omero_host=None, omero_user=None):
+    '''
+    Expands the command-line inputs into work units.
+
+    Inputs can be image files, slide files, directories containing those, or OMERO datasets given as
+    ``omero:<dataset_id>``.
+
+        Returns:
+            units (list): list of (unit_id, kind, source) tuples
+    '''
+    units = []
+    omero_client = None
+    for item in inputs:
+        if item.startswith('omero:'):
+            if omero_client is None:
+                if omero_host is None or omero_user is None:
+                    raise ValueError('--omero-host and --omero-user are required for OMERO inputs')
+                # imported lazily so that the local workflow doesn't need omero-py
+                from abscr.omero_connection.connector import OmeroClient
+                omero_client = OmeroClient(omero_user, omero_host)
+            dataset = omero_client.conn.getObject('Dataset', int(item.split(':', 1)[1]))
+            for image_obj in dataset.listChildren():
+                basename = os.path.splitext(image_obj.getName())[0]
+                units.append((f'{basename}_{image_obj.getId()}', 'omero', (omero_client, image_obj)))
+            continue
+
+        paths = [item]
+        if os.path.isdir(item):
+            paths = [os.path.join(item, name) for name in sorted(os.listdir(item))]
+        for path in paths:
+            basename, ext = os.path.splitext(os.path.basename(path))
+            if ext.lower() in SLIDE_EXTENSIONS:
+                units.append((_file_unit_id(basename, path), 'slide', path))
+            elif ext.lower() in IMAGE_EXTENSIONS:
+                units.append((_file_unit_id(basename, path), 'image', path))
+            else:
+                logging.warning(f'Skipping {path}: unsupported file format')
+
+    # an input listed twice is processed once
+    unique, seen = [], set()
+    for unit in units:
+        if unit[0] not in seen:
+            seen.add(unit[0])
+            unique.append(unit)
+    return unique
+
+
+def _file_unit_id(basename, path):
+    # Unit ids name the output files and the manifest entries. Files of the same name in different
+    # directories are told apart by a suffix derived from their path, which doesn't depend on the other
+    # inputs, so a unit keeps its id when a job is resumed with more inputs.
+    return f'{basename}_{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]}'
+
+
+def _init_worker(threads, model_types, trace, cpu_inference, quantize):
+    global _segmentor, _counter, _preprocessor, _cpu_config
+    # set before torch is imported so that every thread pool in the worker respects the limit
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+
+    import torch
+    from abscr.segmentation.segmentor import Segmentor
+    from abscr.analysis.counter import CellCounter
+    from abscr.preprocessing.preprocessor import Preprocessor
+    from abscr.segmentation.cpu_inference import CPUInferenceConfig
+    from abscr.util import profiling
+
+    if trace:
+        profiling.enable()
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    if cpu_inference:
+        _cpu_config = CPUInferenceConfig(num_threads=threads, num_interop_threads=1, quantize=quantize)
+    _segmentor = Segmentor()
+    for model_type in model_types:
+        _segmentor.get_model(model_type, cpu_config=_cpu_config)
+    _counter = CellCounter()
+    _preprocessor = Preprocessor()
+
+
+def _process_unit(unit_id, kind, source, params):
+    return segment_unit(_segmentor, _preprocessor, _counter, unit_id, kind, source, params, cpu_config=_cpu_config)
+
+
+def segment_unit(segmentor, preprocessor, counter, unit_id, kind, source, params, cpu_config=None, engine=None):
+    '''
+    Segments, counts and exports the outlines of one work unit.
+
+        Returns:
+            result (dict): cell count, pixels, run time, output files and, if traced, the stage timings
+    '''
+    import numpy as np
+    from tiffslide import TiffSlide
+    from abscr.preprocessing.preprocessor import is_slide
+    from abscr.util.profiling import get_tracer
+
+    tracer = get_tracer()
+    tracer.reset()
+    tic = time.time()
+    params = dict(params)
+    scale_factor = params.pop('scale_factor', 8)
+    trace = params.pop('trace', False)
+    params.pop('cpu_inference', None)
+    params.pop('quantize', None)
+    calibrate = params.pop('calibrate', False)
+    params['cpu_config'] = cpu_config
+    params['engine'] = engine
+    if kind == 'slide':
+        slide = source if is_slide(source) else TiffSlide(source)
+        # OMERO slides hold a pixels store on the server until they are closed
+        try:
+            image, diameter = preprocessor.scale_image(slide, scale_factor)
+        finally:
+            slide.close()
+        image_array = np.asarray(image.convert('RGB'))
+    else:
+        # images use the predict_all default diameter
+        diameter = 30
+        if is_slide(source):
+            # OMERO images read from the server pyramid are segmented at full resolution, as their JPEG
+            # rendering would be
+            try:
+                image_array = source.read_region((0, 0), 0, source.dimensions, as_array=True)
+            finally:
+                source.close()
+        else:
+            image_array = source if isinstance(source, np.ndarray) else np.asarray(segmentor.check_image(source))
+    if params['diameter_epithelial'] is None:
+        if calibrate:
+            # estimated once by predict_all and cross-checked against the mpp-derived diameter
+            params['mpp_diameter'] = diameter if kind == 'slide' else None
+        else:
+            params['diameter_epithelial'] = diameter
+
+    result = segmentor.predict_all(image_array, basename=unit_id, **params)
+    epithelial_count = counter.count_cells_from_masks(result.epithelial_masks)
+    immune_count = None
+    outputs = [os.path.join(params['savedir'], unit_id + '_cp_outlines.txt')]
+    if result.immune_masks is not None:
+        immune_count = counter.count_cells_from_masks(result.immune_masks)
+        outputs.append(os.path.join(params['savedir'], unit_id + '_immune_cp_outlines.txt'))
+    if params['save_png']:
+        outputs.append(os.path.join(params['savedir'], unit_id + '_segmentation.png'))
+    calibrations = {population: c.to_dict() for population, c in result.calibrations.items()}
+    if calibrations:
+        outputs.append(os.path.join(params['savedir'], unit_id + '_calibration.json'))
+
+    result = {
+        'unit_id': unit_id,
+        'epithelial_cells': epithelial_count,
+        'immune_cells': immune_count,
+        'pixels': int(image_array.shape[0] * image_array.shape[1]),
+        'seconds': time.time() - tic,
+        'outputs': outputs,
+        'calibration': calibrations,
+    }
+    if trace:
+        trace_dir = os.path.join(params['savedir'], 'traces')
+        os.makedirs(trace_dir, exist_ok=True)
+        tracer.export_json(os.path.join(trace_dir, unit_id + '.json'))
+        result['trace'] = tracer.summary()
+    return result
+
+
+def _load_source(kind, source, in_process=False):
+    # OMERO connections can't be shared with worker processes, so the coordinator fetches the pixels;
+    # units processed in this process read the raw pixels tile by tile from the server pyramid instead.
+    # Both are segmented as full-resolution images.
+    if kind == 'omero' and in_process:
+        from abscr.omero_connection.omero_slide import OmeroSlide
+        omero_client, image_obj = source
+        return 'image', OmeroSlide(omero_client, image_obj)
+    if kind == 'omero':
+        import numpy as np
+        omero_client, image_obj = source
+        region = omero_client.get_image_jpg_region(image_obj, 0, 0, (image_obj.getSizeX(), image_obj.getSizeY()))
+        return 'image', np.asarray(region.convert('RGB'))
+    return kind, source
+
+
+def pass_model_types(params):
+    # the model type of every segmentation pass of a unit, in the order of Segmentor.predict_all
+    types = [params['model_type_epithelial']]
+    if params['model_type_immune'] is not None:
+        types.append(params['model_type_immune'])
+    return types
+
+
+def model_types(params):
+    # the distinct models the workers load; passes may share one
+    return list(dict.fromkeys(pass_model_types(params)))
+
+
+class _TiledExecutor:
+    '''
+    Runs the units one after another in the main process, with their tiles spread over the workers
+    of a ParallelTileSegmentor.
+    '''
+
+    def __init__(self, workers, threads, params):
+        from abscr.analysis.counter import CellCounter
+        from abscr.preprocessing.preprocessor import Preprocessor
+        from abscr.segmentation.parallel import ParallelTileSegmentor
+        from abscr.segmentation.segmentor import Segmentor
+        from abscr.util import profiling
+
+        if params.get('trace'):
+            profiling.enable()
+        tile_shape = params['tile_size'] + 2 * params['tile_overlap']
+        self.engine = ParallelTileSegmentor(workers, max_tile_shape=(tile_shape, tile_shape, 4),
+                                            model_type=model_types(params),
+                                            max_passes=len(pass_model_types(params)), threads_per_worker=threads,
+                                            cpu_inference=params.get('cpu_inference', False),
+                                            quantize=params.get('quantize', False))
+        self.tools = (Segmentor(), Preprocessor(), CellCounter())
+
+    def submit(self, func, unit_id, kind, source, params):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(segment_unit(*self.tools, unit_id, kind, source, params, engine=self.engine))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.engine.close()
+
+
+def run_batch(units, savedir, workers, threads, params, resume=True, max_pending=None):
+    '''
+    Segments and counts the cells of all work units in a pool of worker processes. Every worker keeps its
+    own resident model and uses ``threads`` torch threads. Units are scheduled dynamically, with at most
+    ``max_pending`` units in flight, and the progress is recorded in ``<savedir>/manifest.jsonl``.
+
+    If ``params['tile_size']`` is set, the units are processed one after another instead and their tiles are
+    distributed over the workers through shared memory (see ParallelTileSegmentor).
+
+        Returns:
+            report (dict): throughput summary of the run
+    '''
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    results = []
+    failed = []
+    skipped = 0
+    tic = time.time()
+    manifest_params = dict(params)
+    manifest_params['savedir'] = os.path.abspath(savedir)
+
+    with JobManifest(os.path.join(savedir, 'manifest.jsonl'), resume=resume) as manifest:
+        todo = []
+        for unit_id, kind, source in units:
+            manifest.add_unit(unit_id, manifest_params)
+            if resume and manifest.is_done(unit_id, manifest_params):
+                skipped += 1
+                continue
+            todo.append((unit_id, kind, source))
+
+        if params['tile_size'] is not None:
+            executor = _TiledExecutor(workers, threads, params)
+        else:
+            context = multiprocessing.get_context('spawn')
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                              initializer=_init_worker,
+                                                              initargs=(threads, model_types(params),
+                                                                        params.get('trace', False),
+                                                                        params.get('cpu_inference', False),
+                                                                        params.get('quantize', False)))
+        with executor as pool:
+            pending = {}
+            todo = iter(todo)
+            while True:
+                for unit_id, kind, source in todo:
+                    manifest.mark_running(unit_id)
+                    try:
+                        kind, source = _load_source(kind, source, in_process=params['tile_size'] is not None)
+                    except Exception as e:
+                        # an unreadable image fails its unit, not the batch
+                        logging.error(f'{unit_id} failed:\n{traceback.format_exc()}')
+                        manifest.mark_failed(unit_id, e)
+                        failed.append(unit_id)
+                        continue
+                    pending[pool.submit(_process_unit, unit_id, kind, source, params)] = unit_id
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    unit_id = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f'{unit_id} failed:\n{traceback.format_exc()}')
+                        manifest.mark_failed(unit_id, e)
+                        failed.append(unit_id)
+                        continue
+                    manifest.mark_done(unit_id, result['outputs'])
+                    results.append(result)
+                    logging.info(f"{unit_id}: {result['epithelial_cells']} cells in {result['seconds']:.1f} s")
+
+    wall = time.time() - tic
+    cells = sum(r['epithelial_cells'] or 0 for r in results)
+    pixels = sum(r['pixels'] for r in results)
+    report = {
+        'units_total': len(units),
+        'units_processed': len(results),
+        'units_skipped': skipped,
+        'units_failed': failed,
+        'workers': workers,
+        'threads_per_worker': threads,
+        'wall_seconds': wall,
+        'units_per_second': len(results) / wall if wall > 0 else None,
+        'cells_per_second': cells / wall if wall > 0 else None,
+        'megapixels_per_second': pixels / 1e6 / wall if wall > 0 else None,
+        'units': results,
+    }
+    if params.get('trace'):
+        report['stages'] = aggregate_traces(results)
+    return report
+
+
+def aggregate_traces(results):
+    '''
+    Sums up the per-unit stage timings and counters of a traced run. Nested stages are included in the
+    total of their parent stage but not in its self time, so the self times add up to the time spent in
+    traced stages.
+    '''
+    stages = {}
+    counters = {}
+    for r in results:
+        for name, stage in r['trace']['stages'].items():
+            total = stages.setdefault(name, {'calls': 0, 'total': 0.0, 'self': 0.0})
+            total['calls'] += stage['calls']
+            total['total'] += stage['total']
+            total['self'] += stage['self']
+        for name, value in r['trace']['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return {'stages': stages, 'counters': counters}
+
+
+def save_counts(report, savename):
+    with open(savename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['unit_id', 'epithelial_cells', 'immune_cells', 'seconds'])
+        for r in sorted(report['units'], key=lambda r: r['unit_id']):
+            writer.writerow([r['unit_id'], r['epithelial_cells'], r['immune_cells'], f"{r['seconds']:.3f}"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='abscr-batch',
+        description='Segment, count and export cell outlines for images, slides and OMERO datasets.')
+    parser.add_argument('inputs', nargs='+',
+                        help='image or slide files, directories, or OMERO datasets as omero:<dataset_id>')
+    parser.add_argument('-o', '--savedir', default=os.getcwd(), help='output directory')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-t', '--threads-per-worker', type=int, default=None,
+                        help='torch threads per worker, defaults to cpu_count // workers')
+    parser.add_argument('--model-type', default='cyto', help='Cellpose model type')
+    parser.add_argument('--diameter', type=float, default=None,
+                        help='cell diameter in pixels, defaults to 30 for images and to the mpp-derived '
+                             'diameter for slides')
+    parser.add_argument('--flow-threshold', type=float, default=0.4)
+    parser.add_argument('--cellprob-threshold', type=float, default=0.0)
+    parser.add_argument('--no-invert', action='store_true', help='do not invert image intensities')
+    parser.add_argument('--model-type-immune', default=None,
+                        help='Cellpose model type for immune cells (e.g. nuclei); immune cells are only '
+                             'segmented if this is given')
+    parser.add_argument('--diameter-immune', type=float, default=None,
+                        help='immune cell diameter in pixels, estimated once per unit by the size model if not '
+                             'given')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='without --diameter, estimate the cell diameter of every unit with the size model on '
+                             'sampled foreground tiles, cross-checked against the mpp-derived diameter of slides')
+    parser.add_argument('--calibration-tiles', type=int, default=8,
+                        help='number of foreground tiles sampled for the diameter calibration')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--scale-factor', type=int, default=8, help='downsampling factor for slides')
+    parser.add_argument('--cpu-inference', action='store_true',
+                        help='run the models in the CPU inference mode (inference-only, channels-last layout)')
+    parser.add_argument('--quantize', action='store_true',
+                        help='with --cpu-inference, quantise the linear layers of the network to int8')
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help='segment images tile by tile, spreading the tiles of each image over the workers')
+    parser.add_argument('--tile-overlap', type=int, default=64, help='context margin around every tile')
+    parser.add_argument('--save-png', action='store_true', help='save segmentation plots')
+    parser.add_argument('--no-resume', action='store_true', help='reprocess units finished in earlier runs')
+    parser.add_argument('--omero-host', default=None)
+    parser.add_argument('--omero-user', default=None)
+    parser.add_argument('--trace', action='store_true',
+                        help='record per-stage timings, saved to <savedir>/traces/<unit>.json and the report')
+    parser.add_argument('--report', default=None,
+                        help='path of the JSON throughput report, defaults to <savedir>/report.json')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    os.makedirs(args.savedir, exist_ok=True)
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    params = {
+        'diameter_epithelial': args.diameter,
+        'flow_threshold_epithelial': args.flow_threshold,
+        'cellprob_threshold_epithelial': args.cellprob_threshold,
+        'invert_epithelial': not args.no_invert,
+        'model_type_epithelial': args.model_type,
+        'model_type_immune': args.model_type_immune,
+        'diameter_immune': args.diameter_immune,
+        'batch_size': args.batch_size,
+        'calibrate': args.calibrate,
+        'calibration_tiles': args.calibration_tiles,
+        'save_png': args.save_png,
+        'plot_segm': False,
+        'savedir': args.savedir,
+        'scale_factor': args.scale_factor,
+        'trace': args.trace,
+        'cpu_inference': args.cpu_inference,
+        'quantize': args.quantize,
+        'tile_size': args.tile_size,
+        'tile_overlap': args.tile_overlap,
+    }
+
+    units = collect_units(args.inputs, omero_host=args.omero_host, omero_user=args.omero_user)
+    report = run_batch(units, args.savedir, args.workers, threads, params, resume=not args.no_resume)
+    save_counts(report, os.path.join(args.savedir, 'counts.csv'))
+    with open(args.report or os.path.join(args.savedir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    logging.info(f"Processed {report['units_processed']} units ({report['units_skipped']} skipped, "
+                 f"{len(report['units_failed'])} failed) in {report['wall_seconds']:.1f} s")
+    return 1 if report['units_failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+'''Job manifest for checkpointed, resumable batch runs'''
+
+import json
+import logging
+import os
+import time
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# arguments which only change how a unit is processed, not its outputs, and must not invalidate finished units
+RUNTIME_PARAMS = ('engine', 'cpu_config', 'trace')
+
+
+class JobManifest:
+    '''
+    Records every work unit (image or tile) of a batch job together with its parameters, status and
+    output files.
+
+    The manifest is an append-only JSON-lines journal: every status change is written as a single line,
+    flushed and fsync'ed, so a job killed at any moment leaves a readable manifest behind. When the manifest
+    is reopened the journal is replayed (the last record of each unit wins, a truncated last line is ignored)
+    and compacted into a fresh file that atomically replaces the old one.
+
+        Parameters:
+            path (str): path to the manifest file
+            resume (bool, default True): load the existing manifest instead of starting from scratch
+    '''
+
+    def __init__(self, path, resume=True) -> None:
+        self.path = path
+        self.units = {}
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+
+        if resume and os.path.exists(path):
+            self._load()
+        self._compact()
+        self._journal = open(self.path, 'a')
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f'Skipping a corrupted record in {self.path}')
+                    continue
+                self.units[record['unit_id']] = record
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in self.units.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _write(self, record):
+        self.units[record['unit_id']] = record
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    @staticmethod
+    def _normalize_params(params):
+        # round trip through json so that tuples/lists and key order compare equal; runtime objects such as
+        # worker pools would otherwise be stored by their repr, which differs between runs
+        params = {k: v for k, v in (params or {}).items() if k not in RUNTIME_PARAMS}
+        return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+    def add_unit(self, unit_id, params=None):
+        '''
+        Registers a work unit. Units which are already known keep their status unless their parameters changed.
+
+            Parameters:
+                unit_id (str): unique name of the work unit
+                params (dict): parameters the unit is processed with; the RUNTIME_PARAMS are not recorded
+
+            Returns:
+                record (dict): manifest record of the unit
+        '''
+        params = self._normalize_params(params)
+        record = self.units.get(unit_id)
+        if record is not None and record['params'] == params:
+            return record
+        self._write({'unit_id': unit_id, 'params': params, 'status': PENDING,
+                     'outputs': {}, 'error': None, 'updated': time.time()})
+        return self.units[unit_id]
+
+    def mark_running(self, unit_id):
+        record = dict(self.units[unit_id], status=RUNNING, error=None, updated=time.time())
+        self._write(record)
+
+    def mark_done(self, unit_id, outputs):
+        '''
+        Marks a work unit as finished and records the size of every output file, so that outputs can be
+        verified on resume.
+
+            Parameters:
+                unit_id (str): name of the work unit
+                outputs (list-like): paths to the files produced by the unit
+        '''
+        outputs = {os.path.abspath(p): os.path.getsize(p) for p in outputs}
+        record = dict(self.units[unit_id], status=DONE, outputs=outputs, error=None, updated=time.time())
+        self._write(record)
+
+    def mark_failed(self, unit_id, error):
+        record = dict(self.units[unit_id], status=FAILED, error=str(error), updated=time.time())
+        self._write(record)
+
+    def verify_outputs(self, unit_id) -> bool:
+        '''
+        Checks that every output of a finished unit still exists and has the recorded size.
+        '''
+        record = self.units.get(unit_id)
+        if record is None or record['status'] != DONE:
+            return False
+        for path, size in record['outputs'].items():
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                logging.warning(f'Output {path} of {unit_id} is missing or incomplete')
+                return False
+        return True
+
+    def is_done(self, unit_id, params=None, verify=True) -> bool:
+        '''
+        Returns True if the unit was finished with the same parameters (and, if verify is set, its outputs
+        are intact), i.e. the unit can be skipped on resume.
+        '''
+        record = self.units.get(unit_id)
+        if record is None or record['status'] != DONE:
+            return False
+        if params is not None and record['params'] != self._normalize_params(params):
+            return False
+        return self.verify_outputs(unit_id) if verify else True
+
+    def pending_units(self, verify=True) -> list:
+        return [unit_id for unit_id in self.units if not self.is_done(unit_id, verify=verify)]
+
+    def summary(self) -> dict:
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for record in self.units.values():
+            counts[record['status']] += 1
+        return counts
+
+    def close(self):
+        if not self._journal.closed:
+            self._journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
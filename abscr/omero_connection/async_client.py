@@ -0,0 +1,165 @@
+'''Asyncio facade over OmeroClient for concurrent OMERO queries'''
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+
+class AsyncOmeroClient:
+    '''
+    Runs the blocking OmeroClient methods as coroutines, so that many round trips to the server are in flight
+    at once. Every call runs on a thread of a bounded executor with one of several sessions (OmeroClient
+    instances). A gateway connection is not thread-safe, so a session is only ever used by one call at a time:
+    idle sessions wait in a queue, and a call takes one out and puts it back when it is done.
+
+    Use AsyncOmeroClient.connect to log in once and join further sessions, or pass existing clients, e.g. to
+    run against a mock gateway in tests.
+
+        Parameters:
+            clients (list): OmeroClient instances, one per session
+            max_concurrency (int): maximum number of calls in flight, defaults to the number of sessions
+    '''
+
+    def __init__(self, clients, max_concurrency=None) -> None:
+        if not clients:
+            raise ValueError('AsyncOmeroClient needs at least one OmeroClient session')
+        self.clients = list(clients)
+        self.max_concurrency = max_concurrency or len(self.clients)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_concurrency,
+                                                                               len(self.clients)),
+                                                               thread_name_prefix='omero')
+        # created lazily, so that they belong to the running event loop
+        self._sessions = None
+        self._semaphore = None
+
+    @classmethod
+    def connect(cls, username, host, port=4064, sessions=4, max_concurrency=None):
+        '''
+        Logs in once (asking for the password) and joins sessions - 1 further connections to the same session.
+        '''
+        # imported lazily so that the client can be used with mock sessions without omero-py
+        from abscr.omero_connection.connector import OmeroClient
+        client = OmeroClient(username, host, port=port)
+        return cls([client] + [client.join_session() for _ in range(sessions - 1)],
+                   max_concurrency=max_concurrency)
+
+    def _start(self):
+        if self._sessions is None:
+            self._sessions = asyncio.Queue()
+            for client in self.clients:
+                self._sessions.put_nowait(client)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def run(self, func, *args, **kwargs):
+        '''
+        Runs func(client, *args, **kwargs) on a free session, in the executor.
+        '''
+        self._start()
+        async with self._semaphore:
+            client = await self._sessions.get()
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(func, client, *args, **kwargs))
+            finally:
+                self._sessions.put_nowait(client)
+
+    async def call(self, method, *args, **kwargs):
+        '''
+        Runs the OmeroClient method of the given name on a free session.
+        '''
+        return await self.run(lambda client, *a, **kw: getattr(client, method)(*a, **kw), *args, **kwargs)
+
+    async def gather(self, method, calls, return_exceptions=True):
+        '''
+        Runs an OmeroClient method for many argument tuples concurrently.
+
+            Parameters:
+                method (str): name of the OmeroClient method
+                calls (iterable): argument tuples of the calls
+                return_exceptions (bool, default True): return the exception of a failed call in its place
+                    instead of raising it, so that one failure doesn't discard the other results
+
+            Returns:
+                results (list): the results in the order of the calls
+        '''
+        return await asyncio.gather(*(self.call(method, *args) for args in calls),
+                                    return_exceptions=return_exceptions)
+
+    async def get_image_cursor(self, image_id):
+        return await self.call('get_image_cursor', image_id)
+
+    async def show_img_info(self, image_obj):
+        return await self.call('show_img_info', image_obj)
+
+    async def get_metadata(self, object_name, object_id, namespace=None):
+        return await self.call('get_metadata', object_name, object_id, namespace)
+
+    async def add_metadata(self, object_name, object_id, key_value_data):
+        return await self.call('add_metadata', object_name, object_id, key_value_data)
+
+    async def add_file_metadata(self, object_name, object_id, namespace, filename):
+        return await self.call('add_file_metadata', object_name, object_id, namespace, filename)
+
+    async def delete_metadata(self, object_name, object_id, namespace=None):
+        return await self.call('delete_metadata', object_name, object_id, namespace)
+
+    async def create_dataset(self, dataset_name, project_id=None, description=None, across_groups=True):
+        return await self.call('create_dataset', dataset_name, project_id, description, across_groups)
+
+    async def get_image_cursors(self, image_ids):
+        '''
+        Returns {image_id: image object} for many images; failed lookups are logged and left out.
+        '''
+        return self._by_id(image_ids, await self.gather('get_image_cursor', [(i,) for i in image_ids]))
+
+    async def get_metadata_many(self, object_name, object_ids, namespace=None):
+        '''
+        Returns {object_id: key-value dict} for many objects; failed lookups are logged and left out.
+        '''
+        return self._by_id(object_ids, await self.gather('get_metadata', [(object_name, i, namespace)
+                                                                          for i in object_ids]))
+
+    async def add_metadata_many(self, object_name, key_value_data):
+        '''
+        Adds a map annotation to many objects, given as {object_id: key-value data}.
+
+            Returns:
+                results (dict): {object_id: None, or the exception of a failed call}
+        '''
+        results = await self.gather('add_metadata', [(object_name, i, data) for i, data in key_value_data.items()])
+        return dict(zip(key_value_data, results))
+
+    async def delete_metadata_many(self, object_name, object_ids, namespace=None):
+        '''
+        Deletes the annotations of many objects.
+
+            Returns:
+                results (dict): {object_id: None, or the exception of a failed call}
+        '''
+        results = await self.gather('delete_metadata', [(object_name, i, namespace) for i in object_ids])
+        return dict(zip(object_ids, results))
+
+    @staticmethod
+    def _by_id(ids, results):
+        by_id = {}
+        for object_id, result in zip(ids, results):
+            if isinstance(result, Exception):
+                logging.error(f'OMERO call for object {object_id} failed: {result}')
+                continue
+            by_id[object_id] = result
+        return by_id
+
+    def close(self):
+        '''
+        Shuts the executor down and closes all sessions.
+        '''
+        self._executor.shutdown(wait=True)
+        for client in self.clients:
+            client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.close()
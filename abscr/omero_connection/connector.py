@@ -12,9 +12,16 @@ import logging
 from signal import SIGABRT, SIGILL, SIGINT, SIGSEGV, SIGTERM, signal
 import ezomero
 import numpy as np
+from abscr.batch.manifest import JobManifest
+from abscr.omero_connection.label_shapes import label_polygons, tile_masks
+from abscr.omero_connection.tiled_upload import TileSource, labels_dtype, tile_bytes
+from abscr.util.profiling import get_tracer
 
 logging.basicConfig(level=logging.WARNING)
 
+# namespace of the map annotations linking label images and their source images
+LABEL_IMAGE_NAMESPACE = 'abscr.segmentation/label-image'
+
 
 class OmeroClient:
     def __init__(self, username, host, port=4064):
@@ -66,6 +73,25 @@ class OmeroClient:
     def __set_password(self, password):
         self.__password = password
 
+    def join_session(self):
+        """
+        Returns a new OmeroClient with its own connection to the session of this client, without asking
+        for the password again. A gateway connection must only be used by one thread at a time, so
+        concurrent callers (see AsyncOmeroClient) use one joined client each.
+        """
+        self._keep_connection()
+        client = OmeroClient.__new__(OmeroClient)
+        client.username = self.username
+        client.__password = self.__password
+        client.host = self.host
+        client.port = self.port
+        conn = BlitzGateway(host=self.host, port=self.port, secure=True)
+        if not conn.connect(sUuid=self.conn._getSessionId()):
+            raise ValueError(f'Could not join the OMERO session on {self.host}')
+        conn.c.enableKeepAlive(120)
+        client.conn = conn
+        return client
+
     def show_user_summary(self):
         self._keep_connection()
 
@@ -89,7 +115,8 @@ class OmeroClient:
 
     def get_image_cursor(self, image_id):
         self._keep_connection()
-        return self.conn.getObject('Image', image_id)
+        with get_tracer().span('omero.get_image_cursor'):
+            return self.conn.getObject('Image', image_id)
 
     def show_img_info(self, image_obj):
         self._keep_connection()
@@ -108,7 +135,9 @@ class OmeroClient:
         self._keep_connection()
 
         w, h = image_obj.getSizeX(), image_obj.getSizeY()
-        thumbnail = image_obj.getThumbnail(size=(w/factor, h/factor))
+        with get_tracer().span('omero.get_image_thumbnail'):
+            thumbnail = image_obj.getThumbnail(size=(w/factor, h/factor))
+        get_tracer().count('omero.bytes_read', len(thumbnail))
         result = Image.open(io.BytesIO(thumbnail))
         result.filename = image_obj.getName()
         return result
@@ -119,7 +148,9 @@ class OmeroClient:
         w, h = size
         # TODO: z, t
         z, t = 0, 0
-        im_jpg_bytes = image_obj.renderJpegRegion(z, t, x, y, w, h)
+        with get_tracer().span('omero.get_image_jpg_region', width=w, height=h):
+            im_jpg_bytes = image_obj.renderJpegRegion(z, t, x, y, w, h)
+        get_tracer().count('omero.bytes_read', len(im_jpg_bytes))
         result = Image.open(io.BytesIO(im_jpg_bytes))
         filename, ext = os.path.splitext(image_obj.getName())
         result.filename = f'{filename}_{x}_{y}_{w}x{h}{ext}'
@@ -134,10 +165,151 @@ class OmeroClient:
         '''
 
         self._keep_connection()
-        im_id = ezomero.post_image(
-            conn=self.conn, image=image_array, image_name=image_name, dataset_id=dataset_id)
+        with get_tracer().span('omero.post_image'):
+            im_id = ezomero.post_image(
+                conn=self.conn, image=image_array, image_name=image_name, dataset_id=dataset_id)
+        get_tracer().count('omero.bytes_written', image_array.nbytes)
         return im_id
 
+    def _create_image(self, tiles, image_name, dataset_id, description=None):
+        # an empty image of the size and pixel type of the source, linked to the dataset
+        query_service = self.conn.getQueryService()
+        pixels_type = query_service.findByQuery(f"from PixelsType as p where p.value='{tiles.pixel_type}'", None)
+        image_id = self.conn.getPixelsService().createImage(
+            tiles.size_x, tiles.size_y, 1, 1, list(range(tiles.size_c)), pixels_type, image_name,
+            description or '', self.conn.SERVICE_OPTS).getValue()
+        link = omero.model.DatasetImageLinkI()
+        link.setParent(omero.model.DatasetI(dataset_id, False))
+        link.setChild(omero.model.ImageI(image_id, False))
+        self.conn.getUpdateService().saveObject(link, self.conn.SERVICE_OPTS)
+        return image_id
+
+    def _open_pixels_store(self, image_id):
+        store = self.conn.c.sf.createRawPixelsStore()
+        try:
+            pixels_id = self.conn.getObject('Image', image_id).getPrimaryPixels().getId()
+            store.setPixelsId(pixels_id, True, self.conn.SERVICE_OPTS)
+        except Exception:
+            store.close()
+            raise
+        return store
+
+    def post_image_tiled(self, source, image_name: str, dataset_id: int, size: Optional[tuple] = None, dtype=None,
+                         description: Optional[str] = None, manifest_path: Optional[str] = None) -> int:
+        '''
+        Uploads a large image tile by tile through the raw pixels store, without building a 5-dim array:
+        only the tile being sent is in memory. The image has one Z plane and one timepoint; every channel
+        of a tile is sent as a separate plane tile.
+
+        Slides and arrays are read in the tile size of the server (RawPixelsStore.getTileSize), row by row.
+        Images large enough to be stored as a pyramid on the server only accept tiles in that size and
+        order, so the tiles of a tile iterable must then lie on the server's tile grid and come row by row,
+        otherwise a ValueError is raised.
+
+        Parameters
+        ----------
+        source : slide (TiffSlide-like), lazy array of shape (Y, X) or (Y, X, C), or iterable of
+            (x, y, tile) tuples, see abscr.omero_connection.tiled_upload.TileSource
+        image_name : name of the new image
+        dataset_id : id of the dataset where the image will be posted
+        size : (size_x, size_y) of a tile iterable
+        dtype : pixel type the tiles are converted to, defaults to the type of the source
+        manifest_path : path of a JobManifest recording the created image and the sent tiles; an upload
+            interrupted before the pixels were saved is resumed into the same image, skipping the sent tiles.
+            The pyramid of a pyramid-backed image is written in one pass and cannot be reopened, so such an
+            upload starts over in a new image (the interrupted one is marked failed in the manifest).
+
+        Returns
+        -------
+        image_id : id of the uploaded image
+        '''
+        self._keep_connection()
+        tracer = get_tracer()
+        tiles = TileSource(source, size=size, dtype=dtype)
+        params = {'image_name': image_name, 'dataset_id': dataset_id,
+                  'size': [tiles.size_x, tiles.size_y, tiles.size_c], 'pixel_type': tiles.pixel_type}
+        manifest = JobManifest(manifest_path) if manifest_path is not None else None
+        store = None
+        try:
+            image_id = None
+            if manifest is not None:
+                for unit_id in manifest.units:
+                    if unit_id.startswith('image:') and manifest.is_done(unit_id, params, verify=False):
+                        image_id = int(unit_id.split(':', 1)[1])
+            if image_id is not None:
+                store = self._open_pixels_store(image_id)
+                if store.requiresPixelsPyramid():
+                    logging.warning(f'Image {image_id} is pyramid-backed and cannot be resumed, starting over')
+                    manifest.mark_failed(f'image:{image_id}', 'pyramid-backed images cannot be resumed')
+                    store.close()
+                    store, image_id = None, None
+                else:
+                    logging.info(f'Resuming the upload of image {image_id}')
+            if image_id is None:
+                image_id = self._create_image(tiles, image_name, dataset_id, description)
+                if manifest is not None:
+                    manifest.add_unit(f'image:{image_id}', params)
+                    manifest.mark_done(f'image:{image_id}', [])
+                store = self._open_pixels_store(image_id)
+
+            tile_w, tile_h = store.getTileSize()
+            tiles.tile_size = (tile_w, tile_h)
+            pyramid = store.requiresPixelsPyramid()
+            previous = None
+            for x, y, tile in tiles:
+                h, w = tile.shape[:2]
+                on_grid = (x % tile_w == 0 and y % tile_h == 0 and w == min(tile_w, tiles.size_x - x)
+                           and h == min(tile_h, tiles.size_y - y))
+                if pyramid and not (on_grid and (previous is None or (y, x) > previous)):
+                    raise ValueError(f'Tile ({x}, {y}, {w}, {h}) is not the next tile of the {tile_w}x{tile_h} '
+                                     f'tile grid of the pyramid-backed image {image_id}')
+                previous = (y, x)
+                unit_id = f'{image_id}:tile:{x}_{y}'
+                if manifest is not None:
+                    manifest.add_unit(unit_id)
+                    if manifest.is_done(unit_id, verify=False):
+                        continue
+                with tracer.span('omero.set_tile', width=w, height=h):
+                    for c in range(tiles.size_c):
+                        store.setTile(tile_bytes(tile[..., c]), 0, c, 0, x, y, w, h, self.conn.SERVICE_OPTS)
+                tracer.count('omero.bytes_written', tile.nbytes)
+                if manifest is not None:
+                    manifest.mark_done(unit_id, [])
+            with tracer.span('omero.save_pixels'):
+                store.save(self.conn.SERVICE_OPTS)
+        finally:
+            if store is not None:
+                store.close()
+            if manifest is not None:
+                manifest.close()
+        logging.info(f'Uploaded {image_name} as image {image_id} ({tiles.size_x}x{tiles.size_y}, '
+                     f'{tiles.size_c} channels)')
+        return image_id
+
+    def post_label_image(self, labels, image_name: str, dataset_id: int, source_image_id: Optional[int] = None,
+                         manifest_path: Optional[str] = None, max_label: Optional[int] = None) -> int:
+        '''
+        Uploads a label image (e.g. the masks of Segmentor.predict_tiled) tile by tile with post_image_tiled,
+        in the smallest unsigned pixel type that holds its labels, so it can be viewed next to the source.
+        If source_image_id is given, the two images are linked by map annotations (label_image_id on the
+        source, source_image_id on the label image) in the LABEL_IMAGE_NAMESPACE namespace.
+
+        The pixel type is chosen for max_label, or the largest label of an in-memory array; lazy arrays are
+        not read for it and are uploaded in the range of their own integer type unless max_label is given.
+
+        Returns
+        -------
+        image_id : id of the uploaded label image
+        '''
+        image_id = self.post_image_tiled(labels, image_name, dataset_id, dtype=labels_dtype(labels, max_label),
+                                         manifest_path=manifest_path, description=None if source_image_id is None
+                                         else f'Labels of image {source_image_id}')
+        if source_image_id is not None:
+            self.add_metadata_bulk('Image', {source_image_id: {'label_image_id': image_id},
+                                             image_id: {'source_image_id': source_image_id}},
+                                   namespace=LABEL_IMAGE_NAMESPACE)
+        return image_id
+
     def create_project(self, project_name: str, description: Optional[str] = None) -> int:
         return ezomero.post_project(self.conn, project_name, description)
 
@@ -206,6 +378,102 @@ class OmeroClient:
         roi.addShape(shape)
         # Save the ROI (saves any linked shapes too)
         return updateService.saveAndReturnObject(roi)
+
+    @staticmethod
+    def mask_to_shape(x, y, width, height, bits, z=0, t=0, c=0, text=None, color=(255, 255, 0, 128)):
+        """Creates an omero mask shape from a binary mask packed into bits
+        Parameters
+        ----------
+        x, y, width, height : position and size of the mask in the image
+        bits : bytes of the mask pixels, packed row by row (np.packbits)
+        z, c, t : ints
+            the Z, C and T position of the shape in the stack
+        color : RGBA fill colour of the mask
+        """
+
+        shape = omero.model.MaskI()
+        shape.setX(omero.rtypes.rdouble(x))
+        shape.setY(omero.rtypes.rdouble(y))
+        shape.setWidth(omero.rtypes.rdouble(width))
+        shape.setHeight(omero.rtypes.rdouble(height))
+        shape.setBytes(bits)
+        shape.theZ = omero.rtypes.rint(z)
+        shape.theT = omero.rtypes.rint(t)
+        shape.theC = omero.rtypes.rint(c)
+        # OMERO colours are RGBA packed into a signed 32-bit int
+        r, g, b, a = color
+        shape.setFillColor(omero.rtypes.rint(int(np.int32(np.uint32((r << 24) | (g << 16) | (b << 8) | a)))))
+        if text and len(text) > 0:
+            shape.setTextValue(omero.rtypes.rstring(text))
+        return shape
+
+    def post_segmentation(self, image, labels, mode='masks', tile_size=2048, polygon_labels=None, z=0, t=0, c=0,
+                          dataset_id=None, chunk_size=1000, max_label=None):
+        """Publishes a segmentation on an image as a few compact objects instead of one polygon ROI per cell.
+        Parameters
+        ----------
+        image : omero Image object
+        labels : label image of the cells (e.g. the masks of Segmentor.predict_all), 0 is background; lazy
+            arrays are read tile by tile
+        mode : 'masks' adds one ROI holding a binary mask shape per tile with cells (see
+            abscr.omero_connection.label_shapes.tile_masks). The masks don't keep the identity of the cells:
+            they only stay separable by the gaps left where cells touch, and their labels are lost.
+            'label_image' keeps the labels, uploading them as an image next to the source with post_label_image
+        tile_size : side of the mask tiles
+        polygon_labels : labels of the cells which also get a polygon ROI each, e.g. cells to review; the
+            polygon ROIs carry the label as their text
+        z, t, c : position of the shapes in the stack (defaults to 0)
+        dataset_id : dataset of the label image, defaults to the dataset of the image; required for images
+            outside of a dataset
+        chunk_size : number of ROIs saved per request
+        max_label : largest label, sets the pixel type of the label image (see post_label_image)
+        Returns
+        -------
+        result : dict with the ids of the mask ROI ('mask_roi_id'), the label image ('label_image_id')
+            and the polygon ROIs by cell label ('polygon_roi_ids')
+        """
+
+        self._keep_connection()
+        if mode not in ('masks', 'label_image'):
+            raise ValueError(f"Unknown mode {mode}, expected 'masks' or 'label_image'")
+        result = {'mask_roi_id': None, 'label_image_id': None, 'polygon_roi_ids': {}}
+        rois = []
+        if mode == 'masks':
+            roi = omero.model.RoiI()
+            roi.setImage(image._obj)
+            for x, y, width, height, bits in tile_masks(labels, tile_size=tile_size):
+                roi.addShape(self.mask_to_shape(x, y, width, height, bits, z=z, t=t, c=c))
+            roi.setName(omero.rtypes.rstring('cells'))
+            rois.append(('masks', roi))
+        else:
+            if dataset_id is None:
+                parent = image.getParent()
+                if parent is None:
+                    raise ValueError(f'Image {image.getId()} is not in a dataset, the dataset_id of its label '
+                                     'image must be given')
+                dataset_id = parent.getId()
+            result['label_image_id'] = self.post_label_image(labels, f'{image.getName()}_labels', dataset_id,
+                                                             source_image_id=image.getId(), max_label=max_label)
+
+        # the polygons are traced on the whole label image, so it is only read if polygons are requested
+        polygons = label_polygons(labels, polygon_labels) if polygon_labels else {}
+        for label, polygon in polygons.items():
+            roi = omero.model.RoiI()
+            roi.setImage(image._obj)
+            roi.addShape(self.polygon_to_shape(polygon, z=z, t=t, c=c, text=str(label)))
+            rois.append((label, roi))
+
+        update_service = self.conn.getUpdateService()
+        for start in range(0, len(rois), chunk_size):
+            chunk = rois[start:start + chunk_size]
+            with get_tracer().span('omero.save_rois', count=len(chunk)):
+                saved = update_service.saveAndReturnArray([roi for _, roi in chunk], self.conn.SERVICE_OPTS)
+            for (key, _), roi in zip(chunk, saved):
+                if key == 'masks':
+                    result['mask_roi_id'] = roi.getId().getValue()
+                else:
+                    result['polygon_roi_ids'][key] = roi.getId().getValue()
+        return result
     
     def add_metadata(self, object_name, object_id, key_value_data):
         """
@@ -220,6 +488,21 @@ class OmeroClient:
         omero_object = self.conn.getObject(object_name, object_id)
         omero_object.linkAnnotation(map_ann)
         
+    def get_metadata(self, object_name, object_id, namespace=None):
+        """
+        Returns the key-value pairs of the map annotations of an object, merged into one dict.
+        namespace defaults to omero.constants.metadata.NSCLIENTMAPANNOTATION
+        """
+        self._keep_connection()
+        if namespace is None:
+            namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
+        omero_object = self.conn.getObject(object_name, object_id)
+        metadata = {}
+        for ann in omero_object.listAnnotations(ns=namespace):
+            if isinstance(ann, omero.gateway.MapAnnotationWrapper):
+                metadata.update(ann.getValue())
+        return metadata
+
     def add_file_metadata(self, object_name, object_id, namespace, filename):
         self._keep_connection()
         file_ann = self.conn.createFileAnnfromLocalFile(filename, mimetype="text/plain", ns=namespace, desc=None)
@@ -244,6 +527,145 @@ class OmeroClient:
             to_delete.append(ann.id)
         self.conn.deleteObjects('Annotation', to_delete, wait=True)
 
+    def _missing_objects(self, object_name, object_ids):
+        # a single query for all objects instead of a getObject call per object
+        found = {obj.getId() for obj in self.conn.getObjects(object_name, list(object_ids))}
+        return {i: ValueError(f'{object_name} {i} not found') for i in object_ids if i not in found}
+
+    @staticmethod
+    def _annotation_link(object_name, object_id, annotation):
+        link = getattr(omero.model, f'{object_name}AnnotationLinkI')()
+        link.setParent(getattr(omero.model, f'{object_name}I')(object_id, False))
+        link.setChild(annotation)
+        return link
+
+    def _save_links(self, links, results, chunk_size):
+        # the new annotations are saved together with their links, chunk_size links per request
+        update_service = self.conn.getUpdateService()
+        for start in range(0, len(links), chunk_size):
+            chunk = links[start:start + chunk_size]
+            try:
+                with get_tracer().span('omero.save_links', count=len(chunk)):
+                    saved = update_service.saveAndReturnArray([link for _, link in chunk], self.conn.SERVICE_OPTS)
+            except Exception as e:
+                logging.error(f'Saving {len(chunk)} annotation links failed: {e}')
+                for object_id, _ in chunk:
+                    results[object_id] = e
+                continue
+            for (object_id, _), link in zip(chunk, saved):
+                results[object_id] = link.getChild().getId().getValue()
+
+    def add_metadata_bulk(self, object_name, key_value_data, namespace=None, chunk_size=1000):
+        """
+        Adds a map annotation to many objects with a few round trips: the objects are looked up in one
+        query, and the annotations and their links are saved chunk_size at a time.
+
+        Parameters
+        ----------
+        object_name : "Project", "Dataset", "Image"
+        key_value_data : dict of object id -> key-value data (dict or list of pairs)
+        namespace : defaults to omero.constants.metadata.NSCLIENTMAPANNOTATION
+        chunk_size : number of annotations saved per request
+
+        Returns
+        -------
+        results : dict of object id -> id of the new annotation, or the exception if it failed
+        """
+        self._keep_connection()
+        if namespace is None:
+            namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
+        results = self._missing_objects(object_name, key_value_data)
+        links = []
+        for object_id, data in key_value_data.items():
+            if object_id in results:
+                continue
+            map_ann = omero.model.MapAnnotationI()
+            map_ann.setNs(omero.rtypes.rstring(namespace))
+            pairs = data.items() if isinstance(data, dict) else data
+            map_ann.setMapValue([omero.model.NamedValue(str(k), str(v)) for k, v in pairs])
+            links.append((object_id, self._annotation_link(object_name, object_id, map_ann)))
+        self._save_links(links, results, chunk_size)
+        return {i: results[i] for i in key_value_data}
+
+    def add_file_metadata_bulk(self, object_name, filenames, namespace, chunk_size=1000):
+        """
+        Attaches files to many objects. A file given for several objects is uploaded once and linked to
+        all of them; the links are saved chunk_size at a time.
+
+        Parameters
+        ----------
+        object_name : "Project", "Dataset", "Image"
+        filenames : dict of object id -> path of the file
+        namespace : namespace of the file annotations
+
+        Returns
+        -------
+        results : dict of object id -> id of the file annotation, or the exception if it failed
+        """
+        self._keep_connection()
+        results = self._missing_objects(object_name, filenames)
+        uploaded = {}
+        links = []
+        for object_id, filename in filenames.items():
+            if object_id in results:
+                continue
+            if filename not in uploaded:
+                try:
+                    with get_tracer().span('omero.upload_file'):
+                        uploaded[filename] = self.conn.createFileAnnfromLocalFile(
+                            filename, mimetype="text/plain", ns=namespace, desc=None).getId()
+                except Exception as e:
+                    logging.error(f'Uploading {filename} failed: {e}')
+                    uploaded[filename] = e
+            if isinstance(uploaded[filename], Exception):
+                results[object_id] = uploaded[filename]
+                continue
+            file_ann = omero.model.FileAnnotationI(uploaded[filename], False)
+            links.append((object_id, self._annotation_link(object_name, object_id, file_ann)))
+        self._save_links(links, results, chunk_size)
+        return {i: results[i] for i in filenames}
+
+    def get_metadata_bulk(self, object_name, object_ids, namespace=None):
+        """
+        Returns the key-value pairs of the map annotations of many objects, read in one query.
+
+        Returns
+        -------
+        metadata : dict of object id -> dict of the merged key-value pairs
+        """
+        self._keep_connection()
+        if namespace is None:
+            namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
+        metadata = {i: {} for i in object_ids}
+        for link in self.conn.getAnnotationLinks(object_name, parent_ids=list(object_ids), ns=namespace):
+            ann = link.getChild()
+            if isinstance(ann, omero.gateway.MapAnnotationWrapper):
+                metadata[link.getParent().getId()].update(ann.getValue())
+        return metadata
+
+    def delete_metadata_bulk(self, object_name, object_ids, namespace=None):
+        """
+        Deletes the annotations of many objects with one query for the annotation links and a single
+        delete request. As with delete_metadata, all annotations are deleted if namespace is None.
+
+        Returns
+        -------
+        results : dict of object id -> number of deleted annotations, or the exception if the delete failed
+        """
+        self._keep_connection()
+        annotations = {i: set() for i in object_ids}
+        for link in self.conn.getAnnotationLinks(object_name, parent_ids=list(object_ids), ns=namespace):
+            annotations[link.getParent().getId()].add(link.getChild().getId())
+        to_delete = set().union(*annotations.values())
+        if to_delete:
+            try:
+                with get_tracer().span('omero.delete_annotations', count=len(to_delete)):
+                    self.conn.deleteObjects('Annotation', list(to_delete), wait=True)
+            except Exception as e:
+                logging.error(f'Deleting {len(to_delete)} annotations failed: {e}')
+                return {i: e for i in object_ids}
+        return {i: len(ids) for i, ids in annotations.items()}
+
     def close(self, *args):
         if self.conn and self.conn.isConnected():
             self.conn.close()
@@ -0,0 +1,65 @@
+'''Compact shapes of label masks for publishing segmentations to OMERO'''
+
+import numpy as np
+from scipy import ndimage
+from cellpose import utils
+
+
+def tile_masks(labels, tile_size=2048):
+    '''
+    Splits a label image into binary masks of the cell pixels of every tile, as stored by OMERO mask shapes.
+    Pixels where two cells touch are left out, so that neighbouring cells stay distinguishable.
+
+        Parameters:
+            labels (array-like): label image, 0 is background; lazy arrays are read tile by tile
+            tile_size (int, default 2048): side of the tiles
+
+        Yields:
+            (x, y, width, height, bits): the mask cropped to the cells of the tile, with its position in the
+                image, and its pixels packed row by row into bits (np.packbits); tiles without cells are skipped
+    '''
+    height, width = labels.shape[:2]
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tile = np.asarray(labels[y0:y0 + tile_size, x0:x0 + tile_size])
+            mask = tile > 0
+            if not mask.any():
+                continue
+            touching_x = (tile[:, 1:] != tile[:, :-1]) & mask[:, 1:] & mask[:, :-1]
+            touching_y = (tile[1:] != tile[:-1]) & mask[1:] & mask[:-1]
+            mask[:, 1:][touching_x] = False
+            mask[1:][touching_y] = False
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            if len(rows) == 0:
+                continue
+            crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            yield x0 + int(cols[0]), y0 + int(rows[0]), crop.shape[1], crop.shape[0], np.packbits(crop).tobytes()
+
+
+def label_polygons(labels, subset):
+    '''
+    Traces the outlines of a subset of the cells of a label image.
+
+        Parameters:
+            labels (np.ndarray): label image, 0 is background
+            subset (iterable): labels of the cells to trace
+
+        Returns:
+            polygons (dict): label -> (n, 2) array of x, y outline coordinates; labels not in the image are
+                left out
+    '''
+    labels = np.asarray(labels)
+    boxes = ndimage.find_objects(labels)
+    polygons = {}
+    for label in subset:
+        if label < 1 or label > len(boxes) or boxes[label - 1] is None:
+            continue
+        rows, cols = boxes[label - 1]
+        # a one-pixel border, so that the outline of a cell touching its box is closed
+        y0, x0 = max(rows.start - 1, 0), max(cols.start - 1, 0)
+        crop = (labels[y0:rows.stop + 1, x0:cols.stop + 1] == label).astype(np.int32)
+        outlines = utils.outlines_list(crop)
+        if outlines and len(outlines[0]):
+            polygons[label] = outlines[0] + (x0, y0)
+    return polygons
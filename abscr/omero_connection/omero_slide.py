@@ -0,0 +1,157 @@
+'''TiffSlide-like lazy access to the pixels of an OMERO image'''
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from abscr.omero_connection.tiled_upload import PIXEL_TYPES
+from abscr.util.profiling import get_tracer
+
+# OMERO pixel types and the numpy dtypes of their (big-endian) raw pixels
+NUMPY_TYPES = {omero_type: np.dtype(numpy_type).newbyteorder('>') for numpy_type, omero_type in PIXEL_TYPES.items()}
+
+
+class OmeroSlide:
+    '''
+    Reads an OMERO image lazily through the raw pixels store, with the read_region, level_dimensions,
+    level_downsamples, properties and get_best_level_for_downsample interface of a TiffSlide, so that
+    Preprocessor.scale_image, Preprocessor.iter_tiles and the tiled and cascade segmentation work on remote
+    slides without downloading them first.
+
+    The levels are the resolution levels of the server's pyramid, level 0 being the full resolution. Regions
+    are assembled from the server tiles of a level, which are kept in an LRU cache of cache_size tiles, so
+    overlapping reads of neighbouring regions fetch every tile once. Images with one channel are read as
+    grayscale (images with two channels by their first one), images with three or more as RGB (the first
+    three channels).
+
+        Parameters:
+            client (OmeroClient): connection to the server
+            image (omero.gateway.ImageWrapper or int): the image or its id
+            cache_size (int, default 256): number of server tiles kept in the cache
+    '''
+
+    def __init__(self, client, image, cache_size=256) -> None:
+        if isinstance(image, int):
+            image = client.get_image_cursor(image)
+        if image is None:
+            raise ValueError('OMERO image not found')
+        self.client = client
+        self.image = image
+        self.cache_size = cache_size
+        self.dtype = NUMPY_TYPES[image.getPixelsType()]
+        self.size_c = 3 if image.getSizeC() >= 3 else 1
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        conn = client.conn
+        self._store = conn.c.sf.createRawPixelsStore()
+        self._store.setPixelsId(image.getPrimaryPixels().getId(), False, conn.SERVICE_OPTS)
+        # the server numbers its resolution levels from the smallest one, the descriptions from the largest
+        self._n_levels = self._store.getResolutionLevels()
+        descriptions = self._store.getResolutionDescriptions() if self._n_levels > 1 else []
+        self.level_dimensions = ([(d.sizeX, d.sizeY) for d in descriptions] if descriptions
+                                 else [(image.getSizeX(), image.getSizeY())])
+        width = self.level_dimensions[0][0]
+        self.level_downsamples = [width / w for w, _ in self.level_dimensions]
+        self._tile_sizes = []
+        for level in range(len(self.level_dimensions)):
+            self._store.setResolutionLevel(self._n_levels - 1 - level)
+            self._tile_sizes.append(tuple(self._store.getTileSize()))
+
+        self.properties = {
+            'tiffslide.vendor': 'omero',
+            'tiffslide.mpp-x': image.getPixelSizeX(),
+            'tiffslide.mpp-y': image.getPixelSizeY(),
+            'tiffslide.level-count': self.level_count,
+        }
+        for level, ((w, h), downsample, (tile_w, tile_h)) in enumerate(zip(self.level_dimensions,
+                                                                           self.level_downsamples,
+                                                                           self._tile_sizes)):
+            self.properties.update({
+                f'tiffslide.level[{level}].width': w,
+                f'tiffslide.level[{level}].height': h,
+                f'tiffslide.level[{level}].downsample': downsample,
+                f'tiffslide.level[{level}].tile-width': tile_w,
+                f'tiffslide.level[{level}].tile-height': tile_h,
+            })
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    def get_best_level_for_downsample(self, downsample):
+        '''
+        Returns the lowest resolution level whose downsample doesn't exceed the requested one.
+        '''
+        for level in range(self.level_count - 1, -1, -1):
+            if self.level_downsamples[level] <= downsample * 1.01:
+                return level
+        return 0
+
+    def _tile(self, level, col, row):
+        key = (level, col, row)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            tile_w, tile_h = self._tile_sizes[level]
+            width, height = self.level_dimensions[level]
+            x, y = col * tile_w, row * tile_h
+            w, h = min(tile_w, width - x), min(tile_h, height - y)
+            with get_tracer().span('omero.get_tile', level=level):
+                self._store.setResolutionLevel(self._n_levels - 1 - level)
+                planes = [np.frombuffer(self._store.getTile(0, c, 0, x, y, w, h), dtype=self.dtype).reshape(h, w)
+                          for c in range(self.size_c)]
+            tile = np.stack(planes, axis=-1).astype(self.dtype.newbyteorder('='))
+            get_tracer().count('omero.bytes_read', tile.nbytes)
+            self._cache[key] = tile
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return tile
+
+    def read_region(self, location, level, size, as_array=False):
+        '''
+        Reads a region of a level. As with TiffSlide, location is given in level 0 coordinates and size in
+        the coordinates of the level; pixels outside of the image are 0.
+
+            Returns:
+                region (PIL.Image or np.ndarray): RGB or grayscale region, an array of shape (h, w) or (h, w, 3)
+                    with as_array
+        '''
+        downsample = self.level_downsamples[level]
+        left, upper = int(location[0] / downsample), int(location[1] / downsample)
+        w, h = size
+        width, height = self.level_dimensions[level]
+        tile_w, tile_h = self._tile_sizes[level]
+        region = np.zeros((h, w, self.size_c), dtype=self.dtype.newbyteorder('='))
+        x0, y0 = max(left, 0), max(upper, 0)
+        x1, y1 = min(left + w, width), min(upper + h, height)
+        for row in range(y0 // tile_h, (y1 - 1) // tile_h + 1 if y1 > y0 else 0):
+            for col in range(x0 // tile_w, (x1 - 1) // tile_w + 1 if x1 > x0 else 0):
+                tile = self._tile(level, col, row)
+                tx, ty = col * tile_w, row * tile_h
+                ix0, iy0 = max(x0, tx), max(y0, ty)
+                ix1, iy1 = min(x1, tx + tile.shape[1]), min(y1, ty + tile.shape[0])
+                region[iy0 - upper:iy1 - upper, ix0 - left:ix1 - left] = tile[iy0 - ty:iy1 - ty, ix0 - tx:ix1 - tx]
+        if self.size_c == 1:
+            region = region[..., 0]
+        if as_array:
+            return region
+        if region.dtype != np.uint8:
+            raise ValueError(f'Regions of {region.dtype} images can only be read with as_array=True')
+        return Image.fromarray(region)
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
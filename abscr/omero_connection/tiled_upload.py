@@ -0,0 +1,119 @@
+'''Tile sources for streaming large images to OMERO without loading them whole'''
+
+import itertools
+import numpy as np
+
+# numpy dtypes and the OMERO pixel types they are uploaded as
+PIXEL_TYPES = {
+    'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16', 'int32': 'int32',
+    'uint32': 'uint32', 'float32': 'float', 'float64': 'double',
+}
+
+
+class TileSource:
+    '''
+    Reads an image tile by tile for an upload. The image can be
+
+    - a slide with a TiffSlide-like read_region/level_dimensions interface, read at level 0 as RGB,
+    - a lazy array (np.memmap, zarr, dask, ...) of shape (Y, X) or (Y, X, C), sliced tile by tile,
+    - an iterable of (x, y, tile) tuples with tiles of shape (h, w) or (h, w, C); size must then be given.
+      The tiles are consumed as they are uploaded, so only a few of them are in memory at a time.
+
+        Parameters:
+            source: slide, lazy array or tile iterable
+            tile_size (int or tuple, default 1024): side, or (width, height), of the tiles of slides and arrays
+            size (tuple): (size_x, size_y) of a tile iterable
+            dtype (np.dtype): pixel type the tiles are cast to, defaults to the type of the source
+    '''
+
+    def __init__(self, source, tile_size=1024, size=None, dtype=None) -> None:
+        self.source = source
+        self.tile_size = tile_size
+        if hasattr(source, 'read_region'):
+            self.kind = 'slide'
+            self.size_x, self.size_y = source.level_dimensions[0]
+            self.size_c = 3
+            self.dtype = np.dtype('uint8')
+        elif hasattr(source, 'shape') and hasattr(source, '__getitem__'):
+            self.kind = 'array'
+            self.size_y, self.size_x = source.shape[:2]
+            self.size_c = source.shape[2] if len(source.shape) > 2 else 1
+            self.dtype = np.dtype(source.dtype)
+        else:
+            if size is None:
+                raise ValueError('The size (size_x, size_y) of a tile iterable must be given')
+            self.kind = 'tiles'
+            self.size_x, self.size_y = size
+            # the first tile tells the channels and the pixel type; it is put back in front of the others
+            tiles = iter(source)
+            first = next(tiles, None)
+            if first is None:
+                raise ValueError('The tile iterable is empty')
+            first_tile = np.asarray(first[2])
+            self.size_c = first_tile.shape[2] if first_tile.ndim > 2 else 1
+            self.dtype = first_tile.dtype
+            self.source = itertools.chain([first], tiles)
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        if self.dtype.name not in PIXEL_TYPES:
+            raise ValueError(f'Pixel type {self.dtype} cannot be uploaded, expected one of {list(PIXEL_TYPES)}')
+
+    @property
+    def pixel_type(self):
+        return PIXEL_TYPES[self.dtype.name]
+
+    def boxes(self):
+        '''
+        Returns the (x, y, w, h) of the tiles of a slide or array, row by row.
+        '''
+        tile_w, tile_h = (self.tile_size, self.tile_size) if np.isscalar(self.tile_size) else self.tile_size
+        return [(x, y, min(tile_w, self.size_x - x), min(tile_h, self.size_y - y))
+                for y in range(0, self.size_y, tile_h) for x in range(0, self.size_x, tile_w)]
+
+    def _tiles(self):
+        if self.kind == 'tiles':
+            yield from self.source
+            return
+        for x, y, w, h in self.boxes():
+            if self.kind == 'slide':
+                yield x, y, self.source.read_region((x, y), 0, (w, h)).convert('RGB')
+            else:
+                yield x, y, self.source[y:y + h, x:x + w]
+
+    def __iter__(self):
+        '''
+        Yields (x, y, tile) with tiles of shape (h, w, C) and the pixel type dtype.
+        '''
+        for x, y, tile in self._tiles():
+            tile = np.asarray(tile, dtype=self.dtype)
+            yield x, y, tile if tile.ndim > 2 else tile[..., np.newaxis]
+
+
+def tile_bytes(plane):
+    '''
+    Returns a 2-D tile plane as the big-endian bytes the OMERO raw pixels store expects.
+    '''
+    return np.ascontiguousarray(plane, dtype=plane.dtype.newbyteorder('>')).tobytes()
+
+
+def label_dtype(max_label):
+    '''
+    Returns the smallest unsigned pixel type that holds the labels of a label image.
+    '''
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'{max_label} labels cannot be uploaded as an OMERO label image')
+
+
+def labels_dtype(labels, max_label=None):
+    '''
+    Returns the pixel type a label image is uploaded in: the smallest one for max_label, or for the largest
+    label of an in-memory array. Lazy arrays are not read for it; they keep the range of their own integer
+    type (at most uint32).
+    '''
+    if max_label is None and isinstance(labels, np.ndarray):
+        max_label = int(labels.max())
+    if max_label is None:
+        max_label = min(np.iinfo(labels.dtype).max, np.iinfo(np.uint32).max)
+    return label_dtype(max_label)
@@ -1,19 +1,39 @@
+import logging
 import numpy as np
 import PIL
 from tiffslide import TiffSlide
+from abscr.omero_connection.omero_slide import OmeroSlide
 from abscr.segmentation import segmentor
+from abscr.util.profiling import get_tracer
 
 EPITHELIAL_CELL_DIAMETER = 60 # epithelial cell diameter in micrometers
 
+
+def is_slide(image):
+    # OMERO images are read through the same lazy, level-aware interface as TiffSlide
+    return isinstance(image, (TiffSlide, OmeroSlide))
+
+
 class Preprocessor:
     def __init__(self) -> None:
         pass
 
     def scale_image(self, image, factor, cell_diameter=None):
-        if isinstance(image, TiffSlide):
+        with get_tracer().span('scale_image', factor=factor):
+            scaled_image, cell_diam_scaled = self._scale_image(image, factor, cell_diameter)
+        get_tracer().count('preprocessing.pixels', scaled_image.size[0] * scaled_image.size[1])
+        return (scaled_image, cell_diam_scaled)
+
+    def _scale_image(self, image, factor, cell_diameter=None):
+        if is_slide(image):
             level = image.get_best_level_for_downsample(factor)
             if cell_diameter is not None:
                 cell_diam_pixels_scaled = cell_diameter / factor
+            elif image.properties.get('tiffslide.mpp-x') is None or image.properties.get('tiffslide.mpp-y') is None:
+                # without a physical pixel size the diameter is taken in pixels, as for arrays and images
+                logging.warning('The slide has no mpp metadata, assuming a cell diameter of '
+                                f'{EPITHELIAL_CELL_DIAMETER} pixels')
+                cell_diam_pixels_scaled = EPITHELIAL_CELL_DIAMETER / image.properties[f'tiffslide.level[{level}].downsample']
             else:
                 cell_diameter = EPITHELIAL_CELL_DIAMETER
                 cell_diam_pixels = cell_diameter / ((image.properties['tiffslide.mpp-x'] + image.properties['tiffslide.mpp-y']) / 2)
@@ -43,9 +63,15 @@ class Preprocessor:
 
 
     def crop_image(self, image, left, upper, right, lower, level=None) -> 'PIL.Image':
-        if isinstance(image, TiffSlide):
+        with get_tracer().span('crop_image', level=level):
+            cropped = self._crop_image(image, left, upper, right, lower, level)
+        get_tracer().count('preprocessing.pixels', cropped.size[0] * cropped.size[1])
+        return cropped
+
+    def _crop_image(self, image, left, upper, right, lower, level=None):
+        if is_slide(image):
             if level is None:
-                raise ValueError('When passing an image as TiffSlide object, the level must be specified.')
+                raise ValueError('When passing an image as TiffSlide or OmeroSlide object, the level must be specified.')
                 return
             return image.read_region((left, upper), level, (right - left, lower - upper))
         elif isinstance(image, np.ndarray):
@@ -54,3 +80,59 @@ class Preprocessor:
         else:
             PIL_image = segmentor.Segmentor().check_image(image)
             return PIL_image.crop((left, upper, right, lower))
+
+    @staticmethod
+    def tile_grid(width, height, tile_size, overlap=0) -> list:
+        '''
+        Splits an image into tiles. The core boxes of the tiles partition the image, the read boxes extend
+        them by overlap pixels on every side (clipped to the image).
+
+            Parameters:
+                width (int): image width
+                height (int): image height
+                tile_size (int): side of a core box
+                overlap (int, default 0): margin added around every core box
+
+            Returns:
+                tiles (list): list of (core_box, read_box) tuples, boxes as (left, upper, right, lower)
+        '''
+        tiles = []
+        for upper in range(0, height, tile_size):
+            for left in range(0, width, tile_size):
+                core_box = (left, upper, min(left + tile_size, width), min(upper + tile_size, height))
+                read_box = (max(left - overlap, 0), max(upper - overlap, 0),
+                            min(core_box[2] + overlap, width), min(core_box[3] + overlap, height))
+                tiles.append((core_box, read_box))
+        return tiles
+
+    def iter_tiles(self, image, tile_size, overlap=0, level=0):
+        '''
+        Lazily reads an image tile by tile. TiffSlide images are read region by region at the given level,
+        so the whole slide is never loaded at once.
+
+            Parameters:
+                image (TiffSlide, np.ndarray, PIL.Image or str): image to split
+                tile_size (int): side of a tile core box
+                overlap (int, default 0): margin read around every core box
+                level (int, default 0): pyramid level of a TiffSlide image
+
+            Yields:
+                (core_box, read_box, tile): boxes in the coordinates of the given level, tile as np.ndarray
+        '''
+        if is_slide(image):
+            width, height = image.level_dimensions[level]
+            downsample = image.level_downsamples[level]
+        else:
+            if not isinstance(image, np.ndarray):
+                image = np.asarray(segmentor.Segmentor().check_image(image))
+            height, width = image.shape[:2]
+
+        for core_box, read_box in self.tile_grid(width, height, tile_size, overlap):
+            left, upper, right, lower = read_box
+            with get_tracer().span('read_tile', level=level):
+                if is_slide(image):
+                    location = (int(left * downsample), int(upper * downsample))
+                    tile = image.read_region(location, level, (right - left, lower - upper), as_array=True)
+                else:
+                    tile = image[upper:lower, left:right]
+            yield core_box, read_box, tile
@@ -0,0 +1,181 @@
+'''Slide-level cell diameter calibration with the Cellpose size model'''
+
+import logging
+import numpy as np
+from abscr.segmentation import cpu_inference
+from abscr.util.profiling import get_tracer
+
+# the size model's estimates are log-normally spread around the true diameter; estimates further than
+# this factor away from the mpp-derived diameter are reported as disagreeing
+MPP_TOLERANCE = 1.5
+
+
+def otsu_threshold(values, bins=256):
+    '''
+    Returns the threshold that maximises the between-class variance of the values (Otsu's method).
+    '''
+    values = np.asarray(values, dtype=float).ravel()
+    hist, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(hist * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = sum_low / weight_low
+        mean_high = (sum_low[-1] - sum_low) / weight_high
+        variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    if np.isnan(variance).all():
+        # a constant image has no threshold, and with the returned maximum no foreground
+        return values.max()
+    return centers[np.nanargmax(variance)]
+
+
+def foreground_mask(image_array, invert=True):
+    '''
+    Separates the cells from the background of an image by an Otsu threshold of its grayscale intensity.
+    With invert, the cells are the dark pixels (brightfield), otherwise the bright ones (fluorescence).
+    '''
+    gray = image_array.astype(np.float32)
+    if gray.ndim == 3:
+        gray = gray[..., :3].mean(axis=2)
+    threshold = otsu_threshold(gray)
+    return gray < threshold if invert else gray > threshold
+
+
+def foreground_tiles(image_array, tile_size=512, n_tiles=8, min_foreground=0.1, invert=True, seed=0):
+    '''
+    Samples tiles of an image that contain cells.
+
+        Parameters:
+            image_array (np.ndarray): image
+            tile_size (int, default 512): side of the tiles, the image is split into a grid of such tiles
+            n_tiles (int, default 8): number of tiles to sample
+            min_foreground (float, default 0.1): minimum fraction of foreground pixels of a sampled tile
+            invert (bool, default True): the cells are darker than the background
+            seed (int, default 0): seed of the sampling, so that a slide is always calibrated on the same tiles
+
+        Returns:
+            boxes (list): (y0, x0, y1, x1) of the sampled tiles, by descending foreground fraction
+            fractions (list): foreground fraction of every sampled tile
+    '''
+    mask = foreground_mask(image_array, invert=invert)
+    height, width = mask.shape
+    candidates = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            box = (y0, x0, min(y0 + tile_size, height), min(x0 + tile_size, width))
+            candidates.append((mask[box[0]:box[2], box[1]:box[3]].mean(), box))
+    candidates = [c for c in candidates if c[0] >= min_foreground]
+    if len(candidates) > n_tiles:
+        rng = np.random.default_rng(seed)
+        candidates = [candidates[i] for i in rng.choice(len(candidates), n_tiles, replace=False)]
+    candidates.sort(key=lambda c: -c[0])
+    return [box for _, box in candidates], [float(fraction) for fraction, _ in candidates]
+
+
+class DiameterCalibration:
+    '''
+    Cell diameter of a slide, estimated once by the Cellpose size model on a few sampled foreground tiles.
+
+    The diameter is the median of the per-tile estimates. The confidence (0 to 1) is
+    1 / (1 + relative standard error of the median), where the standard error is derived from the median
+    absolute deviation of the estimates; it is 0 for fewer than two estimates.
+
+        Parameters:
+            samples (list): per-tile diameter estimates in pixels
+            boxes (list): (y0, x0, y1, x1) of the tiles of the estimates
+            model_type (str): Cellpose model of the size model
+            mpp_diameter (float): diameter expected from the mpp metadata, in pixels, optional
+            fallback (float): diameter used if there are no estimates
+    '''
+
+    def __init__(self, samples, boxes, model_type, mpp_diameter=None, fallback=30) -> None:
+        self.samples = [float(s) for s in samples]
+        self.boxes = [[int(v) for v in box] for box in boxes]
+        self.model_type = model_type
+        self.mpp_diameter = None if mpp_diameter is None else float(mpp_diameter)
+        if self.samples:
+            samples = np.array(self.samples)
+            self.diameter = float(np.median(samples))
+            mad = float(np.median(np.abs(samples - self.diameter)))
+            relative_error = 1.2533 * 1.4826 * mad / self.diameter / np.sqrt(len(samples))
+            self.confidence = 1 / (1 + relative_error) if len(samples) > 1 else 0.0
+        else:
+            self.diameter = float(fallback if self.mpp_diameter is None else self.mpp_diameter)
+            self.confidence = 0.0
+        self.mpp_ratio = None if self.mpp_diameter is None else self.diameter / self.mpp_diameter
+
+    def agrees_with_mpp(self, tolerance=MPP_TOLERANCE):
+        '''
+        Returns False if the estimate differs from the mpp-derived diameter by more than the tolerance
+        factor, True otherwise (also if there is no mpp-derived diameter).
+        '''
+        if self.mpp_ratio is None:
+            return True
+        return 1 / tolerance <= self.mpp_ratio <= tolerance
+
+    def to_dict(self):
+        return {
+            'diameter': self.diameter,
+            'confidence': self.confidence,
+            'model_type': self.model_type,
+            'samples': self.samples,
+            'boxes': self.boxes,
+            'mpp_diameter': self.mpp_diameter,
+            'mpp_ratio': self.mpp_ratio,
+            'agrees_with_mpp': self.agrees_with_mpp(),
+        }
+
+    def __repr__(self):
+        return f'DiameterCalibration(diameter={self.diameter:.1f}, confidence={self.confidence:.2f})'
+
+
+def calibrate_diameter(segmentor, image_array, model_type='cyto', channels=[0, 0], invert=True, n_tiles=8,
+                       tile_size=512, min_foreground=0.1, mpp_diameter=None, batch_size=8, cpu_config=None, seed=0):
+    '''
+    Estimates the cell diameter of a slide once, so that every tile can be segmented with the same diameter
+    instead of running the size model per tile. Foreground tiles are sampled with foreground_tiles and the
+    size model of the Cellpose model is run on each of them.
+
+        Parameters:
+            segmentor (Segmentor): segmentor holding the resident models
+            image_array (np.ndarray): image (e.g. a scaled slide)
+            model_type, channels, invert, batch_size, cpu_config: as in Segmentor.predict_epithelial
+            n_tiles, tile_size, min_foreground, seed: as in foreground_tiles
+            mpp_diameter (float): diameter expected from the mpp metadata, in pixels, to cross-check the
+                estimate; also the fallback if no foreground is found
+
+        Returns:
+            calibration (DiameterCalibration): the estimated diameter and its confidence
+    '''
+    tracer = get_tracer()
+    with tracer.span('calibration.sample'):
+        boxes, _ = foreground_tiles(image_array, tile_size=tile_size, n_tiles=n_tiles,
+                                    min_foreground=min_foreground, invert=invert, seed=seed)
+    model = segmentor.get_model(model_type, cpu_config=cpu_config)
+    if getattr(model, 'sz', None) is None or not getattr(model, 'pretrained_size', None):
+        logging.error(f'The {model_type} model has no size model')
+        raise ValueError(f'Cannot calibrate the diameter: the {model_type} model has no size model')
+
+    samples, sample_boxes = [], []
+    with tracer.span('calibration.size_model', model_type=model_type), cpu_inference.inference_context(cpu_config):
+        for box in boxes:
+            tile = image_array[box[0]:box[2], box[1]:box[3]]
+            diam, _ = model.sz.eval(tile, channels=channels, invert=invert, batch_size=batch_size)
+            diam = float(np.squeeze(diam))
+            # the size model returns its default diameter if it finds no cells, which is no estimate
+            if np.isfinite(diam) and diam > 0 and diam != model.diam_mean:
+                samples.append(diam)
+                sample_boxes.append(box)
+    tracer.count('calibration.tiles', len(boxes))
+
+    calibration = DiameterCalibration(samples, sample_boxes, model_type, mpp_diameter=mpp_diameter,
+                                      fallback=model.diam_mean)
+    if not samples:
+        logging.warning(f'No cells found for the diameter calibration, using {calibration.diameter:.1f} px')
+    elif not calibration.agrees_with_mpp():
+        logging.warning(f'Calibrated diameter {calibration.diameter:.1f} px differs from the mpp-derived '
+                        f'{calibration.mpp_diameter:.1f} px by a factor of {calibration.mpp_ratio:.2f}')
+    else:
+        logging.info(f'Calibrated {model_type} diameter: {calibration}')
+    return calibration
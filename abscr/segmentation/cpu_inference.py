@@ -0,0 +1,157 @@
+'''CPU-optimised inference settings for Cellpose models'''
+
+import contextlib
+import logging
+import time
+import numpy as np
+import torch
+from cellpose import metrics, models
+
+
+class CPUInferenceConfig:
+    '''
+    Settings of the CPU inference mode of Segmentor.predict_epithelial.
+
+        Parameters:
+            num_threads (int): intra-op threads used by torch, defaults to the torch default
+            num_interop_threads (int): inter-op threads used by torch, can only be set once per process
+            inference_mode (bool, default True): run the network under torch.inference_mode
+            channels_last (bool, default True): keep the convolution weights in the channels-last memory
+                format, which is the faster layout for the oneDNN CPU kernels
+            quantize (bool, default False): apply dynamic int8 quantisation to the linear layers of the network
+    '''
+
+    def __init__(self, num_threads=None, num_interop_threads=None, inference_mode=True, channels_last=True,
+                 quantize=False) -> None:
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+        self.quantize = quantize
+
+    def model_key(self):
+        # settings which change the prepared network, used to cache resident models
+        return ('cpu', self.channels_last, self.quantize)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return f'CPUInferenceConfig({", ".join(f"{k}={v}" for k, v in vars(self).items())})'
+
+
+def configure_threads(config):
+    '''
+    Applies the thread settings of the config to torch.
+    '''
+    if config.num_threads is not None and torch.get_num_threads() != config.num_threads:
+        torch.set_num_threads(config.num_threads)
+    if config.num_interop_threads is not None and torch.get_num_interop_threads() != config.num_interop_threads:
+        try:
+            torch.set_num_interop_threads(config.num_interop_threads)
+        except RuntimeError:
+            logging.warning('The inter-op thread count can only be set before torch runs parallel work; '
+                            f'keeping {torch.get_num_interop_threads()} threads')
+
+
+def _channels_last_input(module, args):
+    # forward pre-hook of the network: the convolutions only run in the channels-last kernels if their input
+    # is in that layout as well
+    return (args[0].contiguous(memory_format=torch.channels_last),) + tuple(args[1:])
+
+
+def prepare_model(model, config):
+    '''
+    Prepares a CPU Cellpose model for inference according to the config. The network is modified in place.
+
+        Parameters:
+            model (cellpose.models.Cellpose): model loaded with gpu=False
+            config (CPUInferenceConfig): inference settings
+
+        Returns:
+            model (cellpose.models.Cellpose): the prepared model
+    '''
+    cp = model.cp
+    # Cellpose reloads the weights from disk before every eval unless the model is given as a single path,
+    # which would both waste time and undo the preparation below
+    if isinstance(cp.pretrained_model, list):
+        cp.pretrained_model = cp.pretrained_model[0]
+    cp.net.eval()
+
+    if config.channels_last or config.quantize:
+        # the oneDNN conversion Cellpose does by default uses its own blocked layout: the model flag converts
+        # the weights before every run, the network flag the input in CPnet.forward
+        cp.mkldnn = False
+        cp.net.mkldnn = False
+    if config.channels_last:
+        cp.net = cp.net.to(memory_format=torch.channels_last)
+        cp.net.register_forward_pre_hook(_channels_last_input)
+    if config.quantize:
+        cp.net = torch.ao.quantization.quantize_dynamic(cp.net, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def inference_context(config):
+    '''
+    Returns the context manager the network is run in: torch.inference_mode for an inference-only config,
+    a no-op otherwise. Thread settings are applied on entering.
+    '''
+    if config is None:
+        return contextlib.nullcontext()
+    configure_threads(config)
+    if config.inference_mode:
+        return torch.inference_mode()
+    return contextlib.nullcontext()
+
+
+def check_accuracy(image, config, model_type='cyto', diameter=30, channels=[0, 0], invert=True,
+                   thresholds=(0.5, 0.75, 0.9), **kwargs):
+    '''
+    Compares the masks of the CPU-optimised model with those of the unmodified float model on a reference
+    image and measures the speed of both.
+
+        Parameters:
+            image (np.ndarray): reference image
+            config (CPUInferenceConfig): settings of the optimised model
+            model_type (str): Cellpose model type
+            diameter, channels, invert: Cellpose eval parameters
+            thresholds (tuple): IoU thresholds of the average precision
+            **kwargs: further Cellpose eval parameters
+
+        Returns:
+            report (dict): average precision of the optimised masks against the float masks at each IoU
+                threshold (None if the float model finds no cells, pick another image then), cell counts, the largest cell probability difference, run times and the
+                throughput per core of the optimised model
+    '''
+    eval_kwargs = dict(kwargs, diameter=diameter, channels=channels, invert=invert)
+    # both models run with the same threads so that the timings are comparable
+    configure_threads(config)
+
+    float_model = models.Cellpose(model_type=model_type, gpu=False)
+    tic = time.perf_counter()
+    float_masks, float_flows = float_model.eval(image, **eval_kwargs)[:2]
+    float_seconds = time.perf_counter() - tic
+
+    optimized_model = prepare_model(models.Cellpose(model_type=model_type, gpu=False), config)
+    with inference_context(config):
+        tic = time.perf_counter()
+        optimized_masks, optimized_flows = optimized_model.eval(image, **eval_kwargs)[:2]
+        optimized_seconds = time.perf_counter() - tic
+
+    ap, tp, fp, fn = metrics.average_precision([float_masks], [optimized_masks], threshold=list(thresholds))
+    if float_masks.max() == 0:
+        # the average precision is undefined (NaN) without reference cells
+        logging.warning('The float model finds no cells in the reference image, the accuracy cannot be checked')
+    threads = config.num_threads or torch.get_num_threads()
+    return {
+        'config': config.to_dict(),
+        'average_precision': {t: None if np.isnan(a) else a for t, a in zip(thresholds, ap[0].tolist())},
+        'float_cells': int(float_masks.max()),
+        'optimized_cells': int(optimized_masks.max()),
+        'identical_masks': bool(np.array_equal(float_masks, optimized_masks)),
+        'max_cellprob_difference': float(np.abs(float_flows[2] - optimized_flows[2]).max()),
+        'float_seconds': float_seconds,
+        'optimized_seconds': optimized_seconds,
+        'speedup': float_seconds / optimized_seconds if optimized_seconds > 0 else None,
+        'images_per_second_per_core': 1 / (optimized_seconds * threads) if optimized_seconds > 0 else None,
+    }
@@ -0,0 +1,209 @@
+'''Multi-process data-parallel tile inference with shared-memory transfer'''
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+# resident per-worker state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(input_name, output_name, slot_bytes, slot_pixels, n_outputs, threads, model_types, cpu_inference,
+                 quantize):
+    # set before torch is imported so that every thread pool in the worker respects the limit
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+
+    import torch
+    from abscr.segmentation.cpu_inference import CPUInferenceConfig
+    from abscr.segmentation.segmentor import Segmentor
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    cpu_config = None
+    if cpu_inference:
+        cpu_config = CPUInferenceConfig(num_threads=threads, num_interop_threads=1, quantize=quantize)
+    segmentor = Segmentor()
+    for model_type in model_types:
+        segmentor.get_model(model_type, cpu_config=cpu_config)
+
+    _worker.update({
+        'input': SharedMemory(name=input_name),
+        'output': SharedMemory(name=output_name),
+        'slot_bytes': slot_bytes,
+        'slot_pixels': slot_pixels,
+        'n_outputs': n_outputs,
+        'segmentor': segmentor,
+        'cpu_config': cpu_config,
+    })
+
+
+def _segment_slot(slot, shape, dtype, passes):
+    tile = np.ndarray(shape, dtype=dtype, buffer=_worker['input'].buf, offset=slot * _worker['slot_bytes'])
+    segmentations = _worker['segmentor'].predict_passes(tile, passes, cpu_config=_worker['cpu_config'])
+    del tile
+    diams = []
+    for i, segmentation in enumerate(segmentations):
+        masks = segmentation.masks
+        out = np.ndarray(masks.shape, dtype=np.int32, buffer=_worker['output'].buf,
+                         offset=(slot * _worker['n_outputs'] + i) * _worker['slot_pixels'] * 4)
+        out[:] = masks
+        del out
+        diams.append(segmentation.diams)
+    return masks.shape, diams
+
+
+class ParallelTileSegmentor:
+    '''
+    Pool of worker processes running segmentation on image tiles. Every worker loads its own Cellpose
+    models once and keeps them resident.
+
+    Tiles and label masks are not pickled: the coordinator copies each tile into a free slot of a shared
+    input buffer and the worker writes the mask into the matching slot of a shared output buffer, so only
+    the slot number and the tile shape travel through the task queue. Tiles are handed out as soon as a
+    slot is free, so slow tiles don't stall the other workers.
+
+        Parameters:
+            workers (int): number of worker processes, defaults to the number of CPUs
+            max_tile_shape (tuple): largest tile shape (height, width[, channels]) that will be submitted
+            dtype (np.dtype, default np.uint8): largest tile data type that will be submitted
+            model_type (str or list, default 'cyto'): Cellpose model type, or the model types of several
+                models run on the same tiles (see imap_passes)
+            max_passes (int): largest number of passes run per tile by imap_passes, defaults to the number of
+                model types; passes may share a model type
+            threads_per_worker (int): torch threads per worker, defaults to cpu_count // workers
+            cpu_inference (bool, default False): run the workers in the CPU inference mode
+            quantize (bool, default False): with cpu_inference, quantise the network to int8
+            slots_per_worker (int, default 2): number of tiles in flight per worker
+    '''
+
+    def __init__(self, workers=None, max_tile_shape=(1024, 1024, 3), dtype=np.uint8, model_type='cyto',
+                 max_passes=None, threads_per_worker=None, cpu_inference=False, quantize=False,
+                 slots_per_worker=2) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        model_types = [model_type] if isinstance(model_type, str) else list(model_type)
+        self.model_types = list(dict.fromkeys(model_types))
+        self.max_passes = max_passes or len(model_types)
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        n_slots = self.workers * slots_per_worker
+
+        self.max_tile_shape = tuple(max_tile_shape)
+        self.slot_bytes = int(np.prod(self.max_tile_shape)) * np.dtype(dtype).itemsize
+        self.slot_pixels = self.max_tile_shape[0] * self.max_tile_shape[1]
+        self._input = SharedMemory(create=True, size=n_slots * self.slot_bytes)
+        # one output mask per pass and slot
+        self._output = SharedMemory(create=True, size=n_slots * self.max_passes * self.slot_pixels * 4)
+        self._free_slots = list(range(n_slots))
+
+        context = multiprocessing.get_context('spawn')
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context, initializer=_init_worker,
+            initargs=(self._input.name, self._output.name, self.slot_bytes, self.slot_pixels, self.max_passes,
+                      threads, self.model_types, cpu_inference, quantize))
+        logging.info(f'Started {self.workers} segmentation workers with {threads} threads each')
+
+    def _put_tile(self, slot, tile):
+        if tile.ndim < 2 or tile.shape[0] * tile.shape[1] > self.slot_pixels or tile.nbytes > self.slot_bytes:
+            raise ValueError(f'Tile of shape {tile.shape} and type {tile.dtype} exceeds the maximal tile shape '
+                             f'{self.max_tile_shape}')
+        buffer = np.ndarray(tile.shape, dtype=tile.dtype, buffer=self._input.buf, offset=slot * self.slot_bytes)
+        buffer[:] = tile
+
+    def _get_masks(self, slot, shape, i=0):
+        offset = (slot * self.max_passes + i) * self.slot_pixels * 4
+        masks = np.ndarray(shape, dtype=np.int32, buffer=self._output.buf, offset=offset)
+        return masks.copy()
+
+    def imap(self, tiles, **eval_kwargs):
+        '''
+        Segments tiles in the worker pool with the first model type of the segmentor.
+
+            Parameters:
+                tiles (iterable): (key, tile) pairs, tile as np.ndarray; consumed lazily as slots free up
+                **eval_kwargs: parameters of Segmentor.predict_epithelial (diameter, flow_threshold, ...)
+
+            Yields:
+                (key, masks, diams): in the order in which the tiles finish
+        '''
+        eval_kwargs = dict({'diameter': 30, 'flow_threshold': 0.4, 'cellprob_threshold': 0.0, 'channels': [0, 0],
+                            'invert': True, 'batch_size': 8}, **eval_kwargs, model_type=self.model_types[0])
+        for key, masks, diams in self.imap_passes(tiles, [('predict_epithelial', eval_kwargs)]):
+            yield key, masks[0], diams[0]
+
+    def imap_passes(self, tiles, passes):
+        '''
+        Segments tiles in the worker pool with several models. Every tile is copied to shared memory once
+        and normalised once per worker for all models (see Segmentor.predict_passes).
+
+            Parameters:
+                tiles (iterable): (key, tile) pairs, tile as np.ndarray; consumed lazily as slots free up
+                passes (list): (name, eval_kwargs) pairs as taken by Segmentor.predict_passes, with model
+                    types among those the segmentor was created with
+
+            Yields:
+                (key, masks, diams): masks and diams are lists with one entry per pass, in the order in
+                    which the tiles finish
+        '''
+        for _, eval_kwargs in passes:
+            if eval_kwargs['model_type'] not in self.model_types:
+                raise ValueError(f"Model type {eval_kwargs['model_type']} is not loaded by the workers "
+                                 f'({self.model_types})')
+        if len(passes) > self.max_passes:
+            raise ValueError(f'At most {self.max_passes} passes can be run per tile')
+        tiles = iter(tiles)
+        pending = {}
+        exhausted = False
+        try:
+            while True:
+                while self._free_slots and not exhausted:
+                    try:
+                        key, tile = next(tiles)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    tile = np.ascontiguousarray(tile)
+                    slot = self._free_slots.pop()
+                    try:
+                        self._put_tile(slot, tile)
+                    except ValueError:
+                        self._free_slots.append(slot)
+                        raise
+                    future = self._pool.submit(_segment_slot, slot, tile.shape, tile.dtype.str, passes)
+                    pending[future] = (key, slot)
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key, slot = pending.pop(future)
+                    try:
+                        shape, diams = future.result()
+                        masks = [self._get_masks(slot, shape, i) for i in range(len(passes))]
+                    finally:
+                        self._free_slots.append(slot)
+                    yield key, masks, diams
+        finally:
+            # slots of abandoned tasks must not be reused while a worker may still write to them
+            for future, (_, slot) in pending.items():
+                future.cancel()
+                try:
+                    future.result()
+                except BaseException:
+                    pass
+                self._free_slots.append(slot)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        for shm in (self._input, self._output):
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -1,37 +1,68 @@
+import json
 import logging
 import traceback
 import os
 import numpy as np
 import matplotlib.pyplot as plt
 import PIL
-from cellpose import models, core, io, plot, utils
+from scipy import ndimage
+from cellpose import models, core, io, plot, transforms, utils
+from abscr.batch.manifest import JobManifest
+from abscr.preprocessing import preprocessor
+from abscr.segmentation import cpu_inference
+from abscr.segmentation.calibration import calibrate_diameter
+from abscr.util.profiling import get_tracer
 
 class SegmentationData:
-    def __init__(self, masks=None, flows=None, styles=None, diams=None):
+    def __init__(self, masks=None, flows=None, styles=None, diams=None, outlines=None):
         self.masks = masks
         self.flows = flows
         self.styles = styles
         self.diams = diams
+        self.outlines = outlines
         
 
 class BuccalSwabSegmentation:
-    def __init__(self, epithelial_segm_result, immune_segm_result):
+    def __init__(self, epithelial_segm_result, immune_segm_result, calibrations=None):
         self.epithelial_masks = epithelial_segm_result.masks
         self.epithelial_flows = epithelial_segm_result.flows
         self.epithelial_styles = epithelial_segm_result.styles
         self.epithelial_diams = epithelial_segm_result.diams
         
         self.immune_masks = immune_segm_result.masks
-        self.immune_flows = immune_segm_result.masks
-        self.immune_styles = immune_segm_result.masks
-        self.immune_diams = immune_segm_result.masks
+        self.immune_flows = immune_segm_result.flows
+        self.immune_styles = immune_segm_result.styles
+        self.immune_diams = immune_segm_result.diams
+
+        # DiameterCalibration per population ('epithelial', 'immune') whose diameter was estimated
+        self.calibrations = calibrations if calibrations is not None else {}
 
 
 class Segmentor:
     def __init__(self) -> None:
         self.models = ['cellpose']
+        self._loaded_models = {}
         logging.info(f'Available models:\n{self.models}')
-        pass
+
+    def get_model(self, model_type='cyto', gpu=None, cpu_config=None):
+        '''
+        Returns a Cellpose model of the given type. Models are loaded on first use and stay resident,
+        so repeated predictions don't pay for reloading the network weights.
+
+        If cpu_config (CPUInferenceConfig) is given, the model runs on the CPU and is prepared for
+        CPU inference (memory layout, optional int8 quantisation).
+        '''
+        if cpu_config is not None:
+            gpu = False
+        elif gpu is None:
+            gpu = core.use_gpu()
+        key = (model_type, gpu, cpu_config.model_key() if cpu_config is not None else None)
+        if key not in self._loaded_models:
+            model = models.Cellpose(model_type=model_type, gpu=gpu)
+            if cpu_config is not None:
+                model = cpu_inference.prepare_model(model, cpu_config)
+            self._loaded_models[key] = model
+        return self._loaded_models[key]
     
     @staticmethod
     def check_image(image):
@@ -45,33 +76,344 @@ class Segmentor:
                 return
             return PIL_image
             
+    @staticmethod
+    def prepare_image(image_array, channels=[0, 0], invert=True):
+        '''
+        Converts an image to the two-channel layout of the Cellpose networks and normalises (and optionally
+        inverts) its intensities, which Cellpose otherwise repeats for every model it is run with.
+
+            Returns:
+                prepared (np.ndarray): float32 image of shape (height, width, 2)
+                model_channels (list): channels to pass to Cellpose with the prepared image
+        '''
+        prepared = transforms.convert_image(image_array, channels, normalize=True, invert=invert)
+        # the prepared image already holds the channel to segment first and the optional nuclear channel second
+        model_channels = [1, 2] if channels[1] > 0 else [1, 0]
+        return prepared, model_channels
+
+    def _eval(self, image_array, model_type, diameter, flow_threshold, cellprob_threshold, channels, invert,
+              batch_size, cpu_config=None, normalize=True):
+        tracer = get_tracer()
+        with tracer.span('load_model', model_type=model_type):
+            model = self.get_model(model_type, cpu_config=cpu_config)
+        with tracer.span('cellpose.eval', model_type=model_type), cpu_inference.inference_context(cpu_config):
+            masks, flows, styles, diams = model.eval(image_array, diameter=diameter,
+                                                     flow_threshold=flow_threshold,
+                                                     cellprob_threshold=cellprob_threshold,
+                                                     channels=channels,
+                                                     invert=invert,
+                                                     normalize=normalize,
+                                                     batch_size=batch_size)
+        tracer.count('segmentation.pixels', image_array.shape[0] * image_array.shape[1])
+        tracer.count('segmentation.cells', int(masks.max()))
+        return SegmentationData(masks, flows, styles, diams)
+
     def predict_epithelial(self, image, diameter=30, flow_threshold=0.4, cellprob_threshold=0.0,
-                           channels=[0, 0], invert=True, model_type='cyto', batch_size=8):
+                           channels=[0, 0], invert=True, model_type='cyto', batch_size=8, cpu_config=None):
         if isinstance(image, np.ndarray):
             image_array = image
         else:
-            PIL_image = self.check_image(image)
-            image_array = np.asarray(PIL_image)
-        
-        model = models.Cellpose(model_type=model_type, gpu=core.use_gpu())
-        masks, flows, styles, diams = model.eval(image_array, diameter=diameter,
-                                                 flow_threshold=flow_threshold,
-                                                 cellprob_threshold=cellprob_threshold,
-                                                 channels=channels,
-                                                 invert=invert,
-                                                 batch_size=batch_size)
-        return SegmentationData(masks, flows, styles, diams)
-    
-    # to be implemented
-    def predict_immune(self, image, diameter, flow_threshold, cellprob_threshold,
-                       channels, invert, model_type, batch_size):
-        pass
+            with get_tracer().span('decode'):
+                PIL_image = self.check_image(image)
+                image_array = np.asarray(PIL_image)
+        return self._eval(image_array, model_type, diameter, flow_threshold, cellprob_threshold, channels, invert,
+                          batch_size, cpu_config=cpu_config)
+
+    def predict_immune(self, image, diameter=None, flow_threshold=0.4, cellprob_threshold=0.0,
+                       channels=[0, 0], invert=True, model_type='nuclei', batch_size=8, cpu_config=None):
+        '''
+        Segments immune cells with a Cellpose model, by default the nuclei model. If diameter is None,
+        the diameter is estimated by the size model.
+        '''
+        if isinstance(image, np.ndarray):
+            image_array = image
+        else:
+            with get_tracer().span('decode'):
+                PIL_image = self.check_image(image)
+                image_array = np.asarray(PIL_image)
+        return self._eval(image_array, model_type, diameter, flow_threshold, cellprob_threshold, channels, invert,
+                          batch_size, cpu_config=cpu_config)
+
+    def predict_passes(self, image_array, passes, cpu_config=None):
+        '''
+        Runs several segmentation models on one decoded image. The image is converted and normalised once
+        for every distinct (channels, invert) setting and shared by the models, which run one after another,
+        so only one network works on the image at a time.
+
+            Parameters:
+                image_array (np.ndarray): decoded image
+                passes (list): (name, eval_kwargs) pairs, with eval_kwargs the parameters of predict_epithelial
+                    (model_type, diameter, flow_threshold, cellprob_threshold, channels, invert, batch_size)
+                cpu_config (CPUInferenceConfig): CPU inference settings of all models
+
+            Returns:
+                segmentations (list): SegmentationData of every pass
+        '''
+        tracer = get_tracer()
+        prepared = {}
+        segmentations = []
+        for name, eval_kwargs in passes:
+            eval_kwargs = dict(eval_kwargs)
+            channels = eval_kwargs.pop('channels')
+            invert = eval_kwargs.pop('invert')
+            key = (tuple(channels), bool(invert))
+            if key not in prepared:
+                with tracer.span('normalize'):
+                    prepared[key] = self.prepare_image(image_array, channels, invert)
+            prepared_image, model_channels = prepared[key]
+            with tracer.span(name):
+                segmentations.append(self._eval(prepared_image, channels=model_channels, invert=False,
+                                                normalize=False, cpu_config=cpu_config, **eval_kwargs))
+        return segmentations
+
+    def predict_tiled(self, image, tile_size=1024, tile_overlap=64, level=0, engine=None, diameter=30,
+                      flow_threshold=0.4, cellprob_threshold=0.0, channels=[0, 0], invert=True, model_type='cyto',
+                      batch_size=8, cpu_config=None):
+        '''
+        Segments epithelial cells tile by tile and stitches the tile masks into one label mask.
+
+        Tiles are read with tile_overlap pixels of context around their core region. A cell is kept by the
+        tile whose core region contains the centre of the cell's bounding box, so cells crossing a tile
+        border are neither lost nor duplicated as long as they are smaller than the overlap.
+
+            Parameters:
+                image (TiffSlide, np.ndarray, PIL.Image or str): image to segment
+                tile_size (int, default 1024): side of a tile core region
+                tile_overlap (int, default 64): context margin around every tile
+                level (int, default 0): pyramid level of a TiffSlide image
+                engine (ParallelTileSegmentor): worker pool the tiles are segmented in; if None, tiles are
+                    segmented in this process
+                diameter, flow_threshold, cellprob_threshold, channels, invert, model_type, batch_size,
+                cpu_config: parameters of predict_epithelial (model_type and cpu_config are fixed by the
+                    engine when one is used)
+
+            Returns:
+                segmentation (SegmentationData): stitched masks in the coordinates of the given level
+        '''
+        eval_kwargs = dict(model_type=model_type, diameter=diameter, flow_threshold=flow_threshold,
+                           cellprob_threshold=cellprob_threshold, channels=channels, invert=invert,
+                           batch_size=batch_size)
+        return self.predict_passes_tiled(image, [('predict_epithelial', eval_kwargs)], tile_size=tile_size,
+                                         tile_overlap=tile_overlap, level=level, engine=engine,
+                                         cpu_config=cpu_config)[0]
+
+    def predict_passes_tiled(self, image, passes, tile_size=1024, tile_overlap=64, level=0, engine=None,
+                             cpu_config=None):
+        '''
+        Tiled version of predict_passes: every tile is read once and segmented by all models before the
+        next tile is read, and the masks of each model are stitched as in predict_tiled.
+
+            Returns:
+                segmentations (list): stitched SegmentationData of every pass
+        '''
+        if preprocessor.is_slide(image):
+            width, height = image.level_dimensions[level]
+        else:
+            if not isinstance(image, np.ndarray):
+                image = np.asarray(self.check_image(image))
+            height, width = image.shape[:2]
+        tiles = preprocessor.Preprocessor().iter_tiles(image, tile_size, overlap=tile_overlap, level=level)
+
+        if engine is not None:
+            results = engine.imap_passes((((core_box, read_box), tile) for core_box, read_box, tile in tiles), passes)
+        else:
+            results = (((core_box, read_box), [segmentation.masks for segmentation in segmentations],
+                        [segmentation.diams for segmentation in segmentations])
+                       for core_box, read_box, tile in tiles
+                       for segmentations in [self.predict_passes(tile, passes, cpu_config=cpu_config)])
+
+        masks = [np.zeros((height, width), dtype=np.int32) for _ in passes]
+        n_cells = [0] * len(passes)
+        for (core_box, read_box), tile_masks, _ in results:
+            with get_tracer().span('stitch_tile'):
+                for i in range(len(passes)):
+                    n_cells[i] += self._paste_tile_masks(masks[i], tile_masks[i], core_box, read_box, n_cells[i])
+        return [SegmentationData(masks=masks[i], diams=eval_kwargs['diameter'])
+                for i, (_, eval_kwargs) in enumerate(passes)]
+
+    @staticmethod
+    def _paste_tile_masks(masks, tile_masks, core_box, read_box, label_offset):
+        # keep the cells whose bounding box centre lies in the core region of the tile
+        left, upper = read_box[0], read_box[1]
+        kept = []
+        for label, slices in enumerate(ndimage.find_objects(tile_masks), start=1):
+            if slices is None:
+                continue
+            cy = upper + (slices[0].start + slices[0].stop) / 2
+            cx = left + (slices[1].start + slices[1].stop) / 2
+            if core_box[0] <= cx < core_box[2] and core_box[1] <= cy < core_box[3]:
+                kept.append(label)
+        if not kept:
+            return 0
+
+        remap = np.zeros(tile_masks.max() + 1, dtype=np.int32)
+        remap[kept] = np.arange(label_offset + 1, label_offset + len(kept) + 1)
+        relabeled = remap[tile_masks]
+        region = masks[upper:read_box[3], left:read_box[2]]
+        # pixels already claimed by a cell of a neighbouring tile keep their label
+        selected = (relabeled > 0) & (region == 0)
+        region[selected] = relabeled[selected]
+        return len(kept)
+
+    def predict_cascade(self, image, coarse_downsample=8, fine_level=0, margin=None, tile_size=1024, tile_overlap=64,
+                        engine=None, diameter=30, flow_threshold=0.4, cellprob_threshold=0.0, channels=[0, 0],
+                        invert=True, model_type='cyto', batch_size=8, cpu_config=None, return_masks=False):
+        '''
+        Coarse-to-fine segmentation of a large image or slide. The whole image is segmented at a low resolution
+        first; then only the regions around the detected cells are segmented again at the fine resolution, so
+        most of the slide is processed at low resolution while every reported cell gets a full-resolution
+        outline instead of an upscaled blocky one.
+
+        The fine regions are the connected components of the coarse cell pixels dilated by margin, so nearby
+        cells share one region. A region is read and segmented tile by tile (see predict_tiled), and a fine
+        cell is kept by the region its centre falls into, so cells are not duplicated where region bounding
+        boxes overlap.
+
+            Parameters:
+                image (TiffSlide, np.ndarray, PIL.Image or str): image to segment
+                coarse_downsample (float, default 8): downsample of the coarse pass relative to level 0; slides
+                    use the best pyramid level for it, other images are resized
+                fine_level (int, default 0): pyramid level of the fine pass of a slide
+                margin (int): margin around the coarse cells in fine level pixels, defaults to diameter
+                tile_size, tile_overlap (int): tiling of both passes, see predict_tiled
+                engine (ParallelTileSegmentor): worker pool the tiles of both passes are segmented in
+                diameter (float, default 30): cell diameter in fine level pixels, scaled for the coarse pass
+                flow_threshold, cellprob_threshold, channels, invert, model_type, batch_size, cpu_config:
+                    parameters of predict_epithelial
+                return_masks (bool, default False): also paste the fine cells into a label mask of the fine
+                    level (whole-slide masks at level 0 may not fit in memory)
+
+            Returns:
+                segmentation (SegmentationData): outlines of the fine cells as (n, 2) arrays of x, y in level 0
+                    coordinates, and masks at the fine level if return_masks is set
+        '''
+        tracer = get_tracer()
+        eval_kwargs = dict(model_type=model_type, flow_threshold=flow_threshold,
+                           cellprob_threshold=cellprob_threshold, channels=channels, invert=invert,
+                           batch_size=batch_size)
+        if preprocessor.is_slide(image):
+            fine_downsample = image.level_downsamples[fine_level]
+            fine_width, fine_height = image.level_dimensions[fine_level]
+            coarse_level = image.get_best_level_for_downsample(coarse_downsample)
+            coarse_image = image
+            coarse_width = image.level_dimensions[coarse_level][0]
+        else:
+            if not isinstance(image, np.ndarray):
+                image = np.asarray(self.check_image(image))
+            fine_downsample, fine_level, coarse_level = 1, 0, 0
+            fine_height, fine_width = image.shape[:2]
+            with tracer.span('scale_image', factor=coarse_downsample):
+                coarse_image = np.asarray(PIL.Image.fromarray(image).resize(
+                    (max(1, int(fine_width / coarse_downsample)), max(1, int(fine_height / coarse_downsample)))))
+            coarse_width = coarse_image.shape[1]
+        if coarse_width >= fine_width:
+            raise ValueError(f'The coarse pass (downsample {coarse_downsample}) is not coarser than the fine level')
+
+        # only the cells returned are counted, not those of the coarse pass and the fine tiles
+        with tracer.span('coarse_pass'), tracer.suppress('segmentation.cells'):
+            coarse_masks = self.predict_tiled(coarse_image, tile_size=tile_size, tile_overlap=tile_overlap,
+                                              level=coarse_level, engine=engine,
+                                              diameter=diameter * coarse_width / fine_width,
+                                              cpu_config=cpu_config, **eval_kwargs).masks
+        scale = (fine_width / coarse_masks.shape[1], fine_height / coarse_masks.shape[0])
+        regions, boxes = self.cascade_regions(coarse_masks, scale, diameter if margin is None else margin,
+                                              (fine_width, fine_height))
+        logging.info(f'Coarse pass found {coarse_masks.max()} cells in {len(boxes)} regions')
+
+        def fine_tiles():
+            for region, box in enumerate(boxes, start=1):
+                for core_box, read_box in preprocessor.Preprocessor.tile_grid(box[2] - box[0], box[3] - box[1],
+                                                                               tile_size, tile_overlap):
+                    core_box = (core_box[0] + box[0], core_box[1] + box[1], core_box[2] + box[0], core_box[3] + box[1])
+                    left, upper, right, lower = (read_box[0] + box[0], read_box[1] + box[1], read_box[2] + box[0],
+                                                 read_box[3] + box[1])
+                    with tracer.span('read_tile', level=fine_level):
+                        if preprocessor.is_slide(image):
+                            tile = image.read_region((int(left * fine_downsample), int(upper * fine_downsample)),
+                                                     fine_level, (right - left, lower - upper), as_array=True)
+                        else:
+                            tile = image[upper:lower, left:right]
+                    yield (region, core_box, (left, upper, right, lower)), tile
+
+        passes = [('predict_epithelial', dict(eval_kwargs, diameter=diameter))]
+        if engine is not None:
+            results = ((key, masks[0]) for key, masks, _ in engine.imap_passes(fine_tiles(), passes))
+        else:
+            results = ((key, self.predict_passes(tile, passes, cpu_config=cpu_config)[0].masks)
+                       for key, tile in fine_tiles())
+
+        outlines = []
+        masks = np.zeros((fine_height, fine_width), dtype=np.int32) if return_masks else None
+        with tracer.span('fine_pass'), tracer.suppress('segmentation.cells'):
+            for (region, core_box, read_box), tile_masks in results:
+                kept = self._cascade_cells(tile_masks, region, regions, scale, core_box, read_box)
+                if not kept:
+                    continue
+                with tracer.span('outlines_list'):
+                    tile_outlines = utils.outlines_list(tile_masks)
+                for label in kept:
+                    outline = tile_outlines[label - 1] + (read_box[0], read_box[1])
+                    outlines.append(np.round(outline * fine_downsample).astype(np.int32))
+                if return_masks:
+                    remap = np.zeros(tile_masks.max() + 1, dtype=np.int32)
+                    remap[kept] = np.arange(len(outlines) - len(kept) + 1, len(outlines) + 1)
+                    relabeled = remap[tile_masks]
+                    target = masks[read_box[1]:read_box[3], read_box[0]:read_box[2]]
+                    selected = (relabeled > 0) & (target == 0)
+                    target[selected] = relabeled[selected]
+        tracer.count('segmentation.cells', len(outlines))
+        return SegmentationData(masks=masks, diams=diameter, outlines=outlines)
+
+    @staticmethod
+    def cascade_regions(coarse_masks, scale, margin, fine_size):
+        '''
+        Returns the fine regions of predict_cascade: the connected components of the coarse cell pixels dilated
+        by margin (fine pixels), and their bounding boxes (left, upper, right, lower) at the fine level.
+        '''
+        margin_coarse = max(1, int(np.ceil(margin / min(scale))))
+        dilated = ndimage.maximum_filter(coarse_masks > 0, size=2 * margin_coarse + 1)
+        regions, _ = ndimage.label(dilated)
+        boxes = []
+        for slices in ndimage.find_objects(regions):
+            boxes.append((int(slices[1].start * scale[0]), int(slices[0].start * scale[1]),
+                          min(int(np.ceil(slices[1].stop * scale[0])), fine_size[0]),
+                          min(int(np.ceil(slices[0].stop * scale[1])), fine_size[1])))
+        return regions, boxes
+
+    @staticmethod
+    def _cascade_cells(tile_masks, region, regions, scale, core_box, read_box):
+        # keep the cells whose bounding box centre lies in the core of the tile and in the region of the tile
+        kept = []
+        for label, slices in enumerate(ndimage.find_objects(tile_masks), start=1):
+            if slices is None:
+                continue
+            cy = read_box[1] + (slices[0].start + slices[0].stop) / 2
+            cx = read_box[0] + (slices[1].start + slices[1].stop) / 2
+            if not (core_box[0] <= cx < core_box[2] and core_box[1] <= cy < core_box[3]):
+                continue
+            row = min(int(cy / scale[1]), regions.shape[0] - 1)
+            col = min(int(cx / scale[0]), regions.shape[1] - 1)
+            if regions[row, col] == region:
+                kept.append(label)
+        return kept
 
     def predict_all(self, image, diameter_epithelial=30, flow_threshold_epithelial=0.4, cellprob_threshold_epithelial=0.0,
                     channels_epithelial=[0, 0], invert_epithelial=True, model_type_epithelial='cyto',
                     diameter_immune=None, flow_threshold_immune=None, cellprob_threshold_immune=None,
                     channels_immune=None, invert_immune=None, model_type_immune=None,
-                    batch_size=8, save_png=True, plot_segm=False, savedir=None, basename=None):
+                    batch_size=8, save_png=True, plot_segm=False, savedir=None, basename=None, cpu_config=None,
+                    tile_size=None, tile_overlap=64, engine=None, mpp_diameter=None, calibration_tiles=8):
+        '''
+        Segments the epithelial and, if model_type_immune is given, the immune cells of an image and saves
+        the outlines (and the plot) to savedir.
+
+        A diameter of None is estimated once for the whole image from calibration_tiles sampled foreground
+        tiles (see abscr.segmentation.calibration) and then used for the whole image or every tile, instead
+        of running the size model per tile. The estimates are saved to <basename>_calibration.json. The
+        epithelial estimate is cross-checked against mpp_diameter, the diameter expected from the mpp
+        metadata, if given.
+        '''
+        tracer = get_tracer()
         if isinstance(image, np.ndarray):
             image_array = image
             if basename is None and save_png:
@@ -79,34 +421,132 @@ class Segmentor:
                 return
             basename = basename
         else:
-            PIL_image = self.check_image(image)
-            image_array = np.asarray(PIL_image)
+            with tracer.span('decode'):
+                PIL_image = self.check_image(image)
+                image_array = np.asarray(PIL_image)
             if basename is not None:
                 basename = basename
             else:
                 basename = os.path.splitext(os.path.basename(PIL_image.filename))[0]
         
         
-        epithelial_segmentation = self.predict_epithelial(image_array, diameter=diameter_epithelial,
-                                                          flow_threshold=flow_threshold_epithelial,
-                                                          cellprob_threshold=cellprob_threshold_epithelial,
-                                                          channels=channels_epithelial, invert=invert_epithelial,
-                                                          model_type=model_type_epithelial, batch_size=batch_size)
-        
-        # immune segmentation is to be implemented
-        immune_segmentation = SegmentationData()
-        
+        # both populations are segmented from the same decoded, normalised and tiled image;
+        # the immune settings default to the epithelial ones so that the normalisation can be shared
+        passes = [('predict_epithelial', dict(model_type=model_type_epithelial, diameter=diameter_epithelial,
+                                              flow_threshold=flow_threshold_epithelial,
+                                              cellprob_threshold=cellprob_threshold_epithelial,
+                                              channels=channels_epithelial, invert=invert_epithelial,
+                                              batch_size=batch_size))]
+        if model_type_immune is not None:
+            passes.append(('predict_immune', dict(
+                model_type=model_type_immune, diameter=diameter_immune,
+                flow_threshold=0.4 if flow_threshold_immune is None else flow_threshold_immune,
+                cellprob_threshold=0.0 if cellprob_threshold_immune is None else cellprob_threshold_immune,
+                channels=channels_epithelial if channels_immune is None else channels_immune,
+                invert=invert_epithelial if invert_immune is None else invert_immune,
+                batch_size=batch_size)))
+
+        calibrations = {}
+        for name, eval_kwargs in passes:
+            if eval_kwargs['diameter'] is None:
+                population = name.split('_', 1)[1]
+                with tracer.span('calibrate_diameter', model_type=eval_kwargs['model_type']):
+                    calibration = calibrate_diameter(
+                        self, image_array, model_type=eval_kwargs['model_type'], channels=eval_kwargs['channels'],
+                        invert=eval_kwargs['invert'], n_tiles=calibration_tiles, batch_size=batch_size,
+                        mpp_diameter=mpp_diameter if population == 'epithelial' else None, cpu_config=cpu_config)
+                eval_kwargs['diameter'] = calibration.diameter
+                calibrations[population] = calibration
+
+        # large images are segmented tile by tile, in the engine's worker processes if one is given
+        if tile_size is not None:
+            segmentations = self.predict_passes_tiled(image_array, passes, tile_size=tile_size,
+                                                      tile_overlap=tile_overlap, engine=engine, cpu_config=cpu_config)
+        else:
+            segmentations = self.predict_passes(image_array, passes, cpu_config=cpu_config)
+        epithelial_segmentation = segmentations[0]
+        immune_segmentation = segmentations[1] if len(segmentations) > 1 else SegmentationData()
+        masks_array = [segmentation.masks for segmentation in segmentations]
+
         if savedir is None:
             savedir = os.getcwd()  
         io.check_dir(savedir)
         
-        self.save_txt_masks([epithelial_segmentation.masks], basename=basename, savedir=savedir)
-        self.plot_segmentation(image_array, [epithelial_segmentation.masks], basename=basename,
-                               savedir=savedir, save_png=save_png, plot_segm=plot_segm)
+        with tracer.span('save_txt_masks'):
+            self.save_txt_masks([epithelial_segmentation.masks], basename=basename, savedir=savedir)
+            if immune_segmentation.masks is not None:
+                self.save_txt_masks([immune_segmentation.masks], basename=basename + '_immune', savedir=savedir)
+        if calibrations:
+            with open(os.path.join(savedir, basename + '_calibration.json'), 'w') as f:
+                json.dump({population: c.to_dict() for population, c in calibrations.items()}, f, indent=2)
+        with tracer.span('plot_segmentation'):
+            self.plot_segmentation(image_array, masks_array, basename=basename,
+                                   savedir=savedir, save_png=save_png, plot_segm=plot_segm)
             
-        return BuccalSwabSegmentation(epithelial_segmentation, immune_segmentation)
-    
-    
+        return BuccalSwabSegmentation(epithelial_segmentation, immune_segmentation, calibrations)
+
+    def predict_all_batch(self, images, manifest_path=None, resume=True, savedir=None, save_png=True, **kwargs):
+        '''
+        Runs predict_all over a batch of work units (images or tiles) and records the progress in a job
+        manifest, so that an interrupted job can be resumed without redoing the finished units.
+
+            Parameters:
+                images (dict or list-like): mapping of unit basenames to images (np.ndarray, PIL.Image or
+                    file paths), or a list of PIL images/file paths whose basenames are derived from filenames
+                manifest_path (str): path to the manifest file, defaults to <savedir>/manifest.jsonl
+                resume (bool, default True): skip units finished in a previous run whose outputs are intact
+                savedir (str): output directory
+                save_png (bool, default True): save the segmentation plots
+                **kwargs: further arguments for predict_all
+
+            Returns:
+                manifest (JobManifest): the manifest of the job
+        '''
+        if savedir is None:
+            savedir = os.getcwd()
+        io.check_dir(savedir)
+        if manifest_path is None:
+            manifest_path = os.path.join(savedir, 'manifest.jsonl')
+
+        if not isinstance(images, dict):
+            named = {}
+            for image in images:
+                filename = image.filename if isinstance(image, PIL.Image.Image) else image
+                named[os.path.splitext(os.path.basename(filename))[0]] = image
+            images = named
+
+        params = dict(kwargs, save_png=save_png, savedir=os.path.abspath(savedir))
+        if kwargs.get('cpu_config') is not None:
+            # int8 quantisation changes the masks, the other CPU inference settings don't
+            params['quantize'] = kwargs['cpu_config'].quantize
+        with JobManifest(manifest_path, resume=resume) as manifest:
+            for basename, image in images.items():
+                manifest.add_unit(basename, params)
+                if resume and manifest.is_done(basename, params):
+                    logging.info(f'Skipping {basename}, already segmented')
+                    continue
+
+                manifest.mark_running(basename)
+                try:
+                    result = self.predict_all(image, savedir=savedir, basename=basename, save_png=save_png, **kwargs)
+                except Exception as e:
+                    logging.error(traceback.format_exc())
+                    manifest.mark_failed(basename, e)
+                    continue
+
+                outputs = [os.path.join(savedir, basename + '_cp_outlines.txt')]
+                if kwargs.get('model_type_immune') is not None:
+                    outputs.append(os.path.join(savedir, basename + '_immune_cp_outlines.txt'))
+                if save_png:
+                    outputs.append(os.path.join(savedir, basename + '_segmentation.png'))
+                if result.calibrations:
+                    outputs.append(os.path.join(savedir, basename + '_calibration.json'))
+                manifest.mark_done(basename, outputs)
+
+            logging.info(f'Batch finished: {manifest.summary()}')
+        return manifest
+
+
     def plot_segmentation(self, image, masks_array, basename=None, save_png=False, savedir=None, plot_segm=True):
         if not (save_png or plot_segm):
             return
@@ -144,9 +584,17 @@ class Segmentor:
         
     def save_txt_masks(self, masks_array, basename, savedir=None):
         if len(masks_array) == 1:
-            outlines = utils.outlines_list(masks_array[0])
-            io.outlines_to_text(os.path.join(savedir, basename), outlines)
+            self._save_txt_mask(masks_array[0], os.path.join(savedir, basename))
         else:
             for i in range(len(masks_array)):
-                outlines = utils.outlines_list(masks_array[i])
-                io.outlines_to_text(os.path.join(savedir, basename + '_' + str(i + 1)), outlines)
+                self._save_txt_mask(masks_array[i], os.path.join(savedir, basename + '_' + str(i + 1)))
+
+    @staticmethod
+    def _save_txt_mask(masks, base):
+        tracer = get_tracer()
+        with tracer.span('outlines_list'):
+            outlines = utils.outlines_list(masks)
+        with tracer.span('outlines_to_text'):
+            io.outlines_to_text(base, outlines)
+        if tracer.enabled:
+            tracer.count('outlines.bytes_written', os.path.getsize(base + '_cp_outlines.txt'))
@@ -0,0 +1,176 @@
+'''Lightweight per-stage timing and throughput instrumentation'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.tracer._record(self.name, self.start, time.perf_counter(), self.attrs)
+        return False
+
+
+class Tracer:
+    '''
+    Collects named timing spans and throughput counters.
+
+    When the tracer is disabled (the default), ``span`` returns a shared no-op context manager and ``count``
+    returns immediately, so instrumented code pays only for a function call and an attribute check.
+
+        Parameters:
+            enabled (bool, default False): whether spans and counters are recorded
+    '''
+
+    def __init__(self, enabled=False) -> None:
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.counters = defaultdict(int)
+            self._origin = time.perf_counter()
+            self._wall_origin = time.time()
+
+    def span(self, name, **attrs):
+        '''
+        Returns a context manager timing the enclosed block under the given name, e.g.
+
+            with tracer.span('cellpose.eval', model_type='cyto'):
+                ...
+        '''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, attrs)
+
+    def count(self, name, value=1):
+        '''
+        Adds value to the counter name (e.g. pixels, cells or bytes processed).
+        '''
+        if not self.enabled or name in getattr(self._local, 'suppressed', ()):
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def suppress(self, *names):
+        '''
+        Returns a context manager that ignores the given counters in the current thread, e.g. for the
+        intermediate passes of a stage that counts its final result itself.
+        '''
+        previous = getattr(self._local, 'suppressed', frozenset())
+        self._local.suppressed = previous | frozenset(names)
+        try:
+            yield
+        finally:
+            self._local.suppressed = previous
+
+    def _record(self, name, start, end, attrs):
+        with self._lock:
+            self.spans.append((name, start - self._origin, end - start, threading.get_ident(), os.getpid(), attrs))
+
+    def _self_times(self):
+        # A span nested in another span of the same thread (e.g. cellpose.eval in predict_epithelial) is
+        # subtracted from its parent, so the self times of all stages add up to the time spent in them.
+        self_times = [duration for _, _, duration, _, _, _ in self.spans]
+        order = sorted(range(len(self.spans)),
+                       key=lambda i: (self.spans[i][4], self.spans[i][3], self.spans[i][1], -self.spans[i][2]))
+        stack = []
+        thread = None
+        for i in order:
+            _, start, duration, tid, pid, _ = self.spans[i]
+            if (pid, tid) != thread:
+                stack, thread = [], (pid, tid)
+            while stack and start + duration > stack[-1][1]:
+                stack.pop()
+            if stack:
+                self_times[stack[-1][0]] -= duration
+            stack.append((i, start + duration))
+        return self_times
+
+    def summary(self) -> dict:
+        '''
+        Aggregates the recorded spans per name (calls, total, self, mean, min and max duration in seconds)
+        and returns them together with the counters. The total of a stage includes the stages nested in it,
+        its self time doesn't.
+        '''
+        stages = {}
+        with self._lock:
+            for (name, _, duration, _, _, _), self_time in zip(self.spans, self._self_times()):
+                stage = stages.setdefault(name, {'calls': 0, 'total': 0.0, 'self': 0.0, 'min': duration,
+                                                 'max': duration})
+                stage['calls'] += 1
+                stage['total'] += duration
+                stage['self'] += self_time
+                stage['min'] = min(stage['min'], duration)
+                stage['max'] = max(stage['max'], duration)
+            counters = dict(self.counters)
+            elapsed = time.perf_counter() - self._origin
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['calls']
+        return {'started': self._wall_origin, 'elapsed': elapsed, 'stages': stages, 'counters': counters}
+
+    def export_json(self, savename, include_spans=True):
+        '''
+        Saves the summary and, if include_spans is set, the individual spans in the Chrome trace event
+        format, so the file can be opened in chrome://tracing or Perfetto.
+        '''
+        report = self.summary()
+        if include_spans:
+            with self._lock:
+                report['traceEvents'] = [
+                    {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                     'pid': pid, 'tid': tid, 'args': attrs}
+                    for name, start, duration, tid, pid, attrs in self.spans
+                ]
+        with open(savename, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        return savename
+
+
+_tracer = Tracer(enabled=os.environ.get('ABSCR_TRACE', '0') not in ('', '0'))
+
+
+def get_tracer() -> Tracer:
+    '''
+    Returns the process-wide tracer used by the abscr modules. It is disabled unless the ABSCR_TRACE
+    environment variable is set or enable() is called.
+    '''
+    return _tracer
+
+
+def enable(reset=True):
+    if reset:
+        _tracer.reset()
+    _tracer.enabled = True
+    return _tracer
+
+
+def disable():
+    _tracer.enabled = False
@@ -0,0 +1,171 @@
+'''Disk-cached image tile pyramids and an HTTP endpoint serving them'''
+
+import functools
+import hashlib
+import logging
+import math
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+# one build lock per pyramid, so that concurrent sessions opening the same image build it only once
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+# running tile servers per cache directory
+_servers = {}
+
+
+class TilePyramid:
+    '''
+    Tile pyramid of an image, written once to a cache directory and reused by later sessions for as long
+    as the image file is unchanged (the cache key includes its path, size and modification time).
+
+    Tiles are stored in the TMS layout <key>/<zoom>/<x>/<y>.png: zoom 0 holds the whole image in one tile,
+    every further zoom level doubles the resolution up to the full resolution at max_zoom, and y counts
+    from the bottom. The content of every tile is flipped vertically, so that image row r is drawn at
+    y = r in a y-up plot, the orientation in which the cell outlines are drawn.
+
+        Parameters:
+            image_path (str): path to the image
+            cache_dir (str): root directory of the tile cache
+            tile_size (int, default 256): side of a tile in pixels
+            grayscale (bool, default True): store greyscale tiles
+    '''
+
+    def __init__(self, image_path, cache_dir, tile_size=256, grayscale=True) -> None:
+        self.image_path = image_path
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+        self.grayscale = grayscale
+
+        stat = os.stat(image_path)
+        signature = f'{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}:{tile_size}:{grayscale}'
+        self.key = hashlib.sha1(signature.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, self.key)
+
+        # only the header is read here
+        with Image.open(image_path) as image:
+            self.width, self.height = image.size
+        self.max_zoom = max(0, math.ceil(math.log2(max(self.width, self.height) / tile_size)))
+
+    @property
+    def is_built(self):
+        return os.path.isdir(self.path)
+
+    def tile_count(self, zoom):
+        '''
+        Returns the number of tile columns and rows of a zoom level.
+        '''
+        downsample = 2 ** (self.max_zoom - zoom)
+        return (math.ceil(math.ceil(self.width / downsample) / self.tile_size),
+                math.ceil(math.ceil(self.height / downsample) / self.tile_size))
+
+    def build(self):
+        '''
+        Writes all tiles, unless the pyramid is in the cache already. The tiles are written to a temporary
+        directory that is renamed when complete, so an interrupted build leaves no partial pyramid behind.
+
+            Returns:
+                pyramid (TilePyramid): self
+        '''
+        with _build_locks_lock:
+            lock = _build_locks.setdefault(self.path, threading.Lock())
+        with lock:
+            if self.is_built:
+                return self
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix=self.key + '.', dir=self.cache_dir)
+            try:
+                self._write_tiles(tmp_dir)
+                os.replace(tmp_dir, self.path)
+            except OSError:
+                # another process has built the same pyramid in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not self.is_built:
+                    raise
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        logging.info(f'Built the tile pyramid of {self.image_path} in {self.path}')
+        return self
+
+    def _write_tiles(self, root):
+        mode = 'L' if self.grayscale else 'RGB'
+        level = Image.open(self.image_path).convert(mode)
+        size = self.tile_size
+        for zoom in range(self.max_zoom, -1, -1):
+            if zoom < self.max_zoom:
+                level = level.resize((math.ceil(level.width / 2), math.ceil(level.height / 2)),
+                                     resample=Image.BILINEAR)
+            cols, rows = self.tile_count(zoom)
+            for x in range(cols):
+                os.makedirs(os.path.join(root, str(zoom), str(x)))
+                for y in range(rows):
+                    crop = level.crop((x * size, y * size, min((x + 1) * size, level.width),
+                                       min((y + 1) * size, level.height)))
+                    # the tile is flipped, with the part outside the image left transparent at its top
+                    tile = Image.new(mode + 'A', (size, size))
+                    tile.paste(crop.transpose(Image.FLIP_TOP_BOTTOM), (0, size - crop.height))
+                    tile.save(os.path.join(root, str(zoom), str(x), f'{y}.png'))
+
+    def url_template(self, base_url):
+        '''
+        Returns the tile URL template with {Z}, {X} and {Y} placeholders, as used by bokeh's TMSTileSource.
+        '''
+        return f'{base_url}/{self.key}/{{Z}}/{{X}}/{{Y}}.png'
+
+
+class _TileRequestHandler(SimpleHTTPRequestHandler):
+    def end_headers(self):
+        # the tiles of a key never change
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        super().end_headers()
+
+    def list_directory(self, path):
+        # only tiles are served, the cache directory can't be browsed
+        self.send_error(404, 'File not found')
+        return None
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(cache_dir, host='127.0.0.1', port=0, public_url=None):
+    '''
+    Serves the tiles of the cache directory over HTTP from a background thread; directories are not listed.
+    The server is started once per cache directory and shared by all later calls.
+
+    The returned URL is the one browsers load the tiles from, so it must not be a loopback address if the
+    app is opened from other machines: listen on a public interface (host='0.0.0.0', the URL then names
+    this machine) or give the public_url under which the server is reached, e.g. through a proxy.
+
+        Parameters:
+            cache_dir (str): root directory of the tile cache
+            host (str, default '127.0.0.1'): interface to listen on
+            port (int, default 0): port to listen on, 0 picks a free port
+            public_url (str): URL of the cache directory as seen by browsers
+
+        Returns:
+            base_url (str): URL of the cache directory
+    '''
+    cache_dir = os.path.abspath(cache_dir)
+    with _build_locks_lock:
+        if cache_dir not in _servers:
+            os.makedirs(cache_dir, exist_ok=True)
+            handler = functools.partial(_TileRequestHandler, directory=cache_dir)
+            server = ThreadingHTTPServer((host, port), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            _servers[cache_dir] = server
+            logging.info(f'Serving tiles from {cache_dir} on port {server.server_address[1]}')
+        server = _servers[cache_dir]
+    if public_url is not None:
+        return public_url.rstrip('/')
+    address, port = server.server_address[:2]
+    if address in ('0.0.0.0', '::'):
+        address = socket.getfqdn()
+    return f'http://{address}:{port}'
@@ -255,19 +255,165 @@ def filter_outlines(min_w, max_w, min_h, max_h, outlines, indent_left=0, indent_
             res.append(cur_outline)
     return res
 
+def polygon_to_wkt(polygon):
+    polygon_wkt = 'Polygon (('
+    first_polygon_wkt = ''
+    for j, point in enumerate(polygon):
+        if j == 0:
+            first_polygon_wkt = f"{point[0]} {point[1]}"
+        polygon_wkt += f"{point[0]} {point[1]}, "
+    polygon_wkt += f'{first_polygon_wkt}))'
+    return polygon_wkt
+
 def outlines_to_wkt_polygons(outlines_file, object_type='Epithelial cell'):
     polygons = make_polygons_from_outlines(outlines_file)
     dat = []
 
     for i, polygon in enumerate(polygons):
-        polygon_wkt = 'Polygon (('
-        first_polygon_wkt = ''
-        for j, point in enumerate(polygon):
-            if j == 0:
-                first_polygon_wkt = f"{point[0]} {point[1]}"
-            polygon_wkt += f"{point[0]} {point[1]}, "
-        polygon_wkt += f'{first_polygon_wkt}))'
-        dat.append([polygon_wkt, object_type, i + 1])
+        dat.append([polygon_to_wkt(polygon), object_type, i + 1])
 
     dat = pd.DataFrame(dat, columns=['polygon', 'name', 'object'])
     return dat
+
+# Streaming variants of the outline transforms above. They consume and yield chunks (lists) of at most
+# chunk_size outlines, so they can be chained into a lazy pipeline from an outline file to an exported file,
+# e.g. save_outlines_to_txt_chunked(iter_iterative_scaling_moving_avg('cells_cp_outlines.txt'), 'scaled.txt'),
+# with a peak memory of one chunk per stage, independent of the number of cells.
+
+def iter_outlines_from_txt(outlines_file, chunk_size=1000):
+    '''
+    Reads outlines from a .txt file chunk by chunk.
+
+        Parameters:
+            outlines_file (str): path to a file containing mask outlines
+            chunk_size (int, default 1000): number of outlines per chunk
+
+        Yields:
+            chunk (list): flat outline arrays (x1, y1, x2, y2, ...)
+    '''
+    chunk = []
+    with open(outlines_file) as f:
+        for o in f:
+            chunk.append(np.fromstring(o, sep=',').astype(int))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def _iter_chunks(outlines, chunk_size):
+    # a path is read lazily, anything else is taken as an iterable of chunks
+    if isinstance(outlines, str):
+        return iter_outlines_from_txt(outlines, chunk_size)
+    return outlines
+
+def iter_scale_outlines(outlines, factor, chunk_size=1000):
+    '''
+    Streaming variant of scale_outlines.
+
+        Parameters:
+            outlines (str or iterable): path to a file containing mask outlines, or chunks of outlines
+            factor (int): scaling factor
+            chunk_size (int, default 1000): number of outlines per chunk read from a file
+
+        Yields:
+            chunk (list): scaled outlines
+    '''
+    for chunk in _iter_chunks(outlines, chunk_size):
+        yield [coords_flat * factor for coords_flat in chunk]
+
+def iter_smooth_outlines_moving_avg(outlines, num_avg=5, chunk_size=1000):
+    '''
+    Streaming variant of smooth_outlines_moving_avg.
+
+        Parameters:
+            outlines (str or iterable): path to a file containing mask outlines, or chunks of outlines
+            num_avg (int): moving average parameter
+            chunk_size (int, default 1000): number of outlines per chunk read from a file
+
+        Yields:
+            chunk (list): smoothed outlines
+    '''
+    for chunk in _iter_chunks(outlines, chunk_size):
+        yield smooth_outlines_moving_avg_from_array(chunk, num_avg)
+
+def iter_iterative_scaling_moving_avg(outlines, num_avg=5, factor=8, scale_step=2, chunk_size=1000):
+    '''
+    Streaming variant of iterative_scaling_moving_avg.
+
+        Parameters:
+            outlines (str or iterable): path to a file containing mask outlines, or chunks of outlines
+            num_avg (int): moving average parameter
+            factor (int): total scaling factor
+            scale_step (int): size of a single scaling step
+            chunk_size (int, default 1000): number of outlines per chunk read from a file
+
+        Yields:
+            chunk (list): smoothed outlines
+    '''
+    num_iter = math.log(factor, scale_step)
+    assert num_iter % 1 == .0, 'Iterative scaling requires an integer number of scaling steps'
+
+    for chunk in _iter_chunks(outlines, chunk_size):
+        smoothed = smooth_outlines_moving_avg_from_array(chunk, num_avg)
+        for i in range(1, int(num_iter) + 1):
+            scaled = scale_outlines_from_array(smoothed, 2)
+            smoothed = smooth_outlines_moving_avg_from_array(scaled)
+        yield smoothed
+
+def iter_make_polygons_from_outlines(outlines, chunk_size=1000):
+    '''
+    Streaming variant of make_polygons_from_outlines.
+
+        Parameters:
+            outlines (str or iterable): path to a file containing mask outlines, or chunks of outlines
+            chunk_size (int, default 1000): number of outlines per chunk read from a file
+
+        Yields:
+            chunk (list): polygons as arrays of (x, y) points
+    '''
+    for chunk in _iter_chunks(outlines, chunk_size):
+        yield make_polygons_from_outlines_array(chunk)
+
+def iter_outlines_to_wkt_polygons(outlines, object_type='Epithelial cell', chunk_size=1000):
+    '''
+    Streaming variant of outlines_to_wkt_polygons. Objects are numbered across chunks.
+
+        Parameters:
+            outlines (str or iterable): path to a file containing mask outlines, or chunks of outlines
+            object_type (str): value of the name column
+            chunk_size (int, default 1000): number of outlines per chunk read from a file
+
+        Yields:
+            dat (pd.DataFrame): rows of a chunk with the columns polygon, name and object
+    '''
+    n = 0
+    for polygons in iter_make_polygons_from_outlines(outlines, chunk_size):
+        dat = [[polygon_to_wkt(polygon), object_type, n + i + 1] for i, polygon in enumerate(polygons)]
+        n += len(polygons)
+        yield pd.DataFrame(dat, columns=['polygon', 'name', 'object'])
+
+def save_outlines_to_txt_chunked(chunks, savename):
+    '''
+    Saves chunks of outlines into a file as they arrive, see save_outlines_to_txt.
+
+        Parameters:
+            chunks (iterable): chunks of outlines
+            savename (str): file name
+    '''
+    with open(savename, 'w') as f:
+        for chunk in chunks:
+            for o in chunk:
+                f.write(','.join(map(lambda x: str(x), o)) + '\n')
+
+def save_wkt_polygons_to_csv_chunked(chunks, savename):
+    '''
+    Saves the data frames of iter_outlines_to_wkt_polygons into one .csv file as they arrive.
+
+        Parameters:
+            chunks (iterable): data frames with the columns polygon, name and object
+            savename (str): file name
+    '''
+    with open(savename, 'w', newline='') as f:
+        for i, dat in enumerate(chunks):
+            dat.to_csv(f, index=False, header=i == 0)
@@ -6,21 +6,36 @@ from dash.dependencies import Input, Output, State
 from dash import html
 from dash import dcc
 import dash_bootstrap_components as dbc
-import plotly.express as px
+import plotly.graph_objects as go
 from dash.exceptions import PreventUpdate
 import numpy as np
-from skimage import io, filters, measure, color, img_as_ubyte
-import PIL
+from skimage import filters, measure, color
 import pandas as pd
 import matplotlib as mpl
-import base64
+import importlib.util
 import json
-from utils import get_polygons_from_outlines
+import math
+from collections import defaultdict
+from functools import partial
+from utils import polygons_from_upload, RegionIndex
+from tiles import TileSource
 import argparse
 
 
 parser = argparse.ArgumentParser(description='')
 parser.add_argument('filename', action='store', type=str, help='Path to the image')
+parser.add_argument('--window', nargs=4, type=int, default=[500, 500, 1800, 800],
+                    metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+                    help='region of the image to open (in full resolution pixels), pass 0 0 0 0 to open the whole image')
+parser.add_argument('--render', choices=['merged', 'traces'], default='merged',
+                    help='draw the contours as a few WebGL traces (one per colour bin) or as one trace per region')
+parser.add_argument('--screen-width', type=int, default=1200,
+                    help='approximate width of the image view in screen pixels, used for the level of detail')
+parser.add_argument('--max-overlay-pixels', type=int, default=4_000_000,
+                    help='largest number of pixels the window is segmented at; larger windows are segmented at '
+                         'a lower resolution level')
+parser.add_argument('--tile-size', type=int, default=256, help='side of the served image tiles in pixels')
+parser.add_argument('--tile-cache', type=int, default=1024, help='number of encoded tiles kept in memory')
 
 args = parser.parse_args()
 # print(args.filename)
@@ -42,8 +57,35 @@ server = app.server
 
 filename = args.filename
 
-offset = 500
-img = io.imread(filename, as_gray=True)[offset:800+offset, offset:1800+offset]
+# The image is served to the browser as tiles of a lazy multi-resolution pyramid, so only the tiles in view are
+# decoded and encoded, at the resolution of the current zoom
+tile_source = TileSource(filename, tile_size=args.tile_size, cache_size=args.tile_cache)
+tile_source.register_routes(server)
+
+full_width, full_height = tile_source.dimensions
+window_x, window_y, window_width, window_height = args.window
+if window_width <= 0 or window_height <= 0:
+    window_x, window_y, window_width, window_height = 0, 0, full_width, full_height
+window_width = min(window_width, full_width - window_x)
+window_height = min(window_height, full_height - window_y)
+
+
+def overlay_level(pixels):
+    # the highest resolution level at which the window fits into --max-overlay-pixels
+    required = math.sqrt(pixels / args.max_overlay_pixels)
+    for level, downsample in enumerate(tile_source.level_downsamples):
+        if downsample >= required:
+            return level
+    return tile_source.level_count - 1
+
+
+# Only the window is read and segmented, at a resolution level that bounds the start-up time and memory for any
+# image size. The figure coordinates are the pixel coordinates of the window at this level
+segmentation_level = overlay_level(window_width * window_height)
+segmentation_downsample = tile_source.level_downsamples[segmentation_level]
+img = color.rgb2gray(np.asarray(tile_source.read_region(
+    (window_x, window_y), segmentation_level,
+    (int(window_width / segmentation_downsample), int(window_height / segmentation_downsample)))))
 label_array = measure.label(img < filters.threshold_otsu(img))
 current_labels = np.unique(label_array)[np.nonzero(np.unique(label_array))]
 # Compute and store properties of the labeled image
@@ -54,12 +96,10 @@ prop_names = [
     "eccentricity",
     "mean_intensity",
 ]
-prop_table = measure.regionprops_table(
-    label_array, intensity_image=img, properties=prop_names
-)
-table = pd.DataFrame(prop_table)
-# remove very small objects
-table = table.query('area > 75')
+# Contours, properties, hover texts and colour mappings are computed once here and looked up by the callbacks.
+# Very small objects are removed
+region_index = RegionIndex(label_array, intensity_image=img, properties=prop_names, min_area=75)
+table = region_index.table
 # Format the Table columns
 columns = [
     {"name": label_name, "id": label_name, "selectable": True}
@@ -76,20 +116,113 @@ columns = [
 # Select the columns that are selected when the app starts
 initial_columns = ["label", "area"]
 
-img = img_as_ubyte(color.gray2rgb(img))
-img = PIL.Image.fromarray(img)
-# Pad label-array with zero to get contours of regions on the edge
-label_array = np.pad(label_array, (1,), "constant", constant_values=(0,))
+# The background figure only holds an invisible trace spanning the window, the image itself is added as layout
+# images of the tiles in view. We do not want any hover-information for the background, so we disable it
+background = go.Figure(go.Scatter(
+    x=[0, img.shape[1]],
+    y=[0, img.shape[0]],
+    mode="markers",
+    marker=dict(opacity=0),
+    hoverinfo="skip",
+    showlegend=False,
+))
+background.update_yaxes(scaleanchor="x", constrain="domain")
+background.update_xaxes(constrain="domain")
+
+
+# Level of detail: contours are simplified to half a screen pixel and regions smaller than a screen pixel are
+# not drawn
+LOD_TOLERANCE = 0.5
+LOD_MIN_SIZE = 1.0
+# Number of colour bins, and thereby WebGL traces, of the merged rendering
+COLOR_BINS = 50
+
+
+def merged_contour_traces(index, labels, color_column, active_columns, tolerance=0):
+    """
+    Returns the contours of the given regions as one filled Scattergl trace per colour bin, with the
+    contours of a bin separated by gaps. Every point carries the label and the column values of its region
+    as customdata, which a single hovertemplate per trace formats, so hovering and the table highlighting
+    work per region.
+    """
+    bins, bin_colors = index.color_bins(color_column, COLOR_BINS)
+    hover_data, hovertemplate = index.hover_data(active_columns)
+    groups = defaultdict(list)
+    for label in labels:
+        groups[bins[label]].append(label)
+
+    traces = []
+    for color_bin, group in sorted(groups.items()):
+        xs, ys, customdata = [], [], []
+        for label in group:
+            x, y = index.simplified_contour(label, tolerance)
+            xs.extend(x.tolist() + [None])
+            ys.extend(y.tolist() + [None])
+            customdata.extend([hover_data[int(label)]] * (len(x) + 1))
+        traces.append(go.Scattergl(
+            x=xs,
+            y=ys,
+            opacity=0.8,
+            mode="lines",
+            line=dict(color=bin_colors[color_bin],),
+            fill="toself",
+            customdata=customdata,
+            showlegend=False,
+            hovertemplate=hovertemplate,
+        ))
+    return traces
+
+
+def viewport_scale(viewport):
+    """
+    Returns the number of screen pixels per image pixel when the viewport fills the image view.
+    """
+    if viewport is None:
+        return args.screen_width / img.shape[1]
+    return args.screen_width / max(viewport[2] - viewport[0], 1)
 
 
-def image_with_contour(img, active_labels, data_table, active_columns, color_column):
+def background_images(viewport):
+    """
+    Returns the layout images of the tiles covering the viewport, from the pyramid level that matches the
+    zoom. The tiles are fetched by the browser from the tile route of the server.
+    """
+    height, width = img.shape[:2]
+    x0, y0, x1, y1 = viewport if viewport is not None else (0, 0, width, height)
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    downsample = segmentation_downsample
+    # full resolution pixels per screen pixel
+    level = tile_source.best_level(downsample / viewport_scale(viewport))
+    box = (window_x + x0 * downsample, window_y + y0 * downsample,
+           window_x + x1 * downsample, window_y + y1 * downsample)
+
+    images = []
+    for col, row in tile_source.visible_tiles(box, level):
+        tx0, ty0, tx1, ty1 = tile_source.tile_box(level, col, row)
+        images.append(dict(
+            source=tile_source.tile_url(level, col, row),
+            xref="x",
+            yref="y",
+            x=(tx0 - window_x) / downsample,
+            y=(ty0 - window_y) / downsample,
+            sizex=(tx1 - tx0) / downsample,
+            sizey=(ty1 - ty0) / downsample,
+            sizing="stretch",
+            layer="below",
+        ))
+    return images
+
+
+def image_with_contour(img, active_labels, data_table, active_columns, color_column, index=None, viewport=None,
+                       render=None):
     """
     Returns a greyscale image that is segmented and superimposed with contour traces of
     the segmented regions, color coded by values from a data table.
 
     Parameters
     ----------
-    img : PIL Image object.
+    img : np.ndarray
+        the segmented greyscale window
     active_labels : list
         the currently visible labels in the datatable
     data_table : pandas.DataFrame
@@ -98,53 +231,53 @@ def image_with_contour(img, active_labels, data_table, active_columns, color_col
         the currently selected columns of the datatable
     color_column: str
         name of the datatable column that is used to define the colorscale of the overlay
+    index: RegionIndex
+        precomputed contours, hover texts and colour mappings, defaults to the index of the app image
+    viewport: tuple
+        (x0, y0, x1, y1) of the visible image region; only the regions in it are drawn, at a level of detail
+        matching the zoom. Defaults to the whole image
+    render: str
+        "merged" to draw the contours as a few WebGL traces, one per colour bin, or "traces" to draw one
+        trace per region. Defaults to the --render argument
     """
+    if index is None:
+        index = region_index
+    if render is None:
+        render = args.render
+
+    # First we get the colour of every region from the values of the selected datatable column
+    colors, ticks = index.colors(color_column)
+    hover_texts = index.hover_texts(active_columns)
+
+    # Only the image tiles in view are added to the figure, the browser loads them from the tile server
+    fig = go.Figure(background)
+    fig.update_layout(images=background_images(viewport))
 
-    # First we get the values from the selected datatable column and use them to define a colormap
-    values = np.array(table[color_column].values)
-    norm = mpl.colors.Normalize(vmin=values.min(), vmax=values.max())
-    cmap = mpl.colormaps['viridis']
+    # Only the regions in the viewport that are at least a screen pixel large are drawn, with their contours
+    # simplified to the detail that can be seen at the current zoom
+    scale = viewport_scale(viewport)
+    labels = index.level_of_detail(data_table["label"], viewport, min_size=LOD_MIN_SIZE / scale)
+    tolerance = LOD_TOLERANCE / scale
 
-    # Now we convert our background image to a greyscale bytestring that is very small and can be transferred very
-    # efficiently over the network. We do not want any hover-information for this image, so we disable it
-    fig = px.imshow(img, binary_string=True, binary_backend="jpg",)
-    fig.update_traces(hoverinfo="skip", hovertemplate=None)
+    if render == "merged":
+        fig.add_traces(merged_contour_traces(index, labels, color_column, active_columns, tolerance))
 
-    # For each region that is visible in the datatable, we compute and draw the filled contour, color it based on
+    # For each region that is visible in the datatable, we draw the filled contour, color it based on
     # the color_column value of this region, and add it to the figure
     # here is an small tutorial of this: https://scikit-image.org/docs/dev/auto_examples/segmentation/plot_regionprops.html#sphx-glr-auto-examples-segmentation-plot-regionprops-py
-    for rid, row in data_table.iterrows():
-        label = row.label
-        value = row[color_column]
-        contour = measure.find_contours(label_array == label, 0.5)[0]
-        # We need to move the contour left and up by one, because
-        # we padded the label array
-        y, x = contour.T - 1
-        # We add the values of the selected datatable columns to the hover information of the current region
-        hoverinfo = (
-            "<br>".join(
-                [
-                    # All numbers are passed as floats. If there are no decimals, cast to int for visibility
-                    f"{prop_name}: {f'{int(prop_val):d}' if prop_val.is_integer() else f'{prop_val:.3f}'}"
-                    if np.issubdtype(type(prop_val), "float")
-                    else f"{prop_name}: {prop_val}"
-                    for prop_name, prop_val in row[active_columns].items()
-                ]
-            )
-            # remove the trace name. See e.g. https://plotly.com/python/reference/#scatter-hovertemplate
-            + " <extra></extra>"
-        )
+    for label in (labels if render == "traces" else []):
+        x, y = index.simplified_contour(label, tolerance)
         fig.add_scatter(
             x=x,
             y=y,
             name=label,
             opacity=0.8,
             mode="lines",
-            line=dict(color=mpl.colors.rgb2hex(cmap(norm(value))),),
+            line=dict(color=colors[label],),
             fill="toself",
             customdata=[label] * len(x),
             showlegend=False,
-            hovertemplate=hoverinfo,
+            hovertemplate=hover_texts[label],
             hoveron="points+fills",
         )
 
@@ -157,16 +290,15 @@ def image_with_contour(img, active_labels, data_table, active_columns, color_col
         mode="markers",
         showlegend=False,
         marker=dict(
-            colorscale=[mpl.colors.rgb2hex(cmap(i))
-                        for i in np.linspace(0, 1, 50)],
+            colorscale=index.colorscale(),
             showscale=True,
             # The cmin and cmax values here are arbitrary, we just set them to put our value ticks in the right place
             cmin=-5,
             cmax=5,
             colorbar=dict(
                 tickvals=[-5, 5],
-                ticktext=[f"{np.min(values[values!=0]):.2f}",
-                          f"{np.max(values):.2f}",],
+                ticktext=[f"{ticks[0]:.2f}",
+                          f"{ticks[1]:.2f}",],
                 # We want our colorbar to scale with the image when it is resized, so we set them to
                 # be a fraction of the total image container
                 lenmode="fraction",
@@ -181,16 +313,31 @@ def image_with_contour(img, active_labels, data_table, active_columns, color_col
         hoverinfo="none",
     )
 
-    # Remove axis ticks and labels and have the image fill the container
+    # Remove axis ticks and labels and have the image fill the container. The uirevision keeps the zoom of the
+    # user when the figure is redrawn
     fig.update_layout(margin=dict(l=0, r=0, b=0, t=0, pad=0),
-                      template="simple_white")
-    fig.update_xaxes(visible=False, range=[0, img.width]).update_yaxes(
-        visible=False, range=[img.height, 0]
+                      template="simple_white", uirevision="image")
+    x0, y0, x1, y1 = viewport if viewport is not None else (0, 0, img.shape[1], img.shape[0])
+    fig.update_xaxes(visible=False, range=[x0, x1]).update_yaxes(
+        visible=False, range=[y1, y0]
     )
 
     return fig
 
 
+def _write_csv(buffer, table, compression=None):
+    table.to_csv(buffer, index=False, compression=compression)
+
+
+# Writers of the table export formats; parquet is offered if pyarrow is installed
+EXPORT_FORMATS = {
+    "csv": _write_csv,
+    "csv.gz": partial(_write_csv, compression="gzip"),
+}
+if importlib.util.find_spec("pyarrow") is not None:
+    EXPORT_FORMATS["parquet"] = lambda buffer, table: table.to_parquet(buffer, index=False)
+
+
 # Color selector dropdown
 color_drop = dcc.Dropdown(
     id="color-drop-menu",
@@ -331,6 +478,7 @@ table_card = dbc.Card(
                             # filter_action="native",
                             # sort_action='native',
                             row_deletable=True,
+                            row_selectable="multi",
                             column_selectable="multi",
                             selected_columns=initial_columns,
                             # style_table={"overflowY": "scroll"},
@@ -338,13 +486,30 @@ table_card = dbc.Card(
                             style_cell={"width": "1em"},
                         ),
                         html.Div(id="row", hidden=True, children=None),
+                        dcc.Store(id="viewport", data=None),
 
                         dbc.CardFooter(
                             dbc.Row(
                                 [
                                     dbc.Col(
-                                        "Download statitistics as csv file:"
+                                        "Download statitistics:"
                                     ),
+                                    dbc.Col(dcc.Dropdown(
+                                        id="download-rows",
+                                        options=[
+                                            {"label": "All rows", "value": "all"},
+                                            {"label": "Filtered rows", "value": "filtered"},
+                                            {"label": "Selected rows", "value": "selected"},
+                                        ],
+                                        value="all",
+                                        clearable=False,
+                                    )),
+                                    dbc.Col(dcc.Dropdown(
+                                        id="download-format",
+                                        options=[{"label": name, "value": name} for name in EXPORT_FORMATS],
+                                        value="csv",
+                                        clearable=False,
+                                    )),
                                     dbc.Button(
                                         "Download Data",
                                         id="download-button",
@@ -361,6 +526,7 @@ table_card = dbc.Card(
                                             'margin': '0px'
                                         },
                                     ),
+                                    dcc.Download(id="download"),
                                 ],
                                 align="center",
                             ),
@@ -373,33 +539,29 @@ table_card = dbc.Card(
 )
 
 
-@app.callback(Output('output-data-upload', 'children'),
+@app.callback([Output('output-data-upload', 'children'),
+               Output('table-line', 'data')],
               Input('upload-outlines', 'contents'),
-              State('upload-outlines', 'filename'))
+              State('upload-outlines', 'filename'),
+              prevent_initial_call=True)
 def update_output(contents, filename):
-    if contents is not None:
-        # read the content of the uploaded file
-
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-
-        # save the file locally
-        with open(filename, 'wb') as f:
-            f.write(decoded)
-
-        # process the uploaded file
-        with open(filename, 'r') as f:
-            data = f.readlines()
-
-        polygons = get_polygons_from_outlines(data)
-
-        # ...
-        # return the result
-        return html.Div([
-            html.Pre(filename),
-        ])
-    else:
-        return None
+    """
+    Replaces the regions of the app with the cells of an uploaded Cellpose outline file. The upload is
+    decoded and parsed chunk by chunk in memory, nothing is written to disk.
+    """
+    global region_index
+    if contents is None:
+        raise PreventUpdate
+    polygons = polygons_from_upload(contents)
+    # the outlines are in full resolution image coordinates, the figure in those of the window at the
+    # segmentation level
+    polygons = [(polygon - (window_x, window_y)) / segmentation_downsample for polygon in polygons]
+    region_index = RegionIndex.from_outlines(polygons, img.shape, intensity_image=img, properties=prop_names)
+    logging.info(f"Loaded {len(polygons)} outlines from {filename}")
+    return [
+        html.Div([html.Pre(f"{filename}: {len(region_index.table)} of {len(polygons)} cells in the window")]),
+        region_index.table.to_dict("records"),
+    ]
 
 
 app.layout = html.Div([
@@ -431,6 +593,9 @@ def higlight_row(string):
     if 'customdata' not in string["points"][0].keys():
         return
     index = string["points"][0]["customdata"]
+    # The merged traces carry [label, *values] per point
+    if isinstance(index, list):
+        index = index[0]
     return [
         {
             "if": {"filter_query": "{label} eq %d" % index},
@@ -440,6 +605,29 @@ def higlight_row(string):
     ]
 
 
+@app.callback(
+    Output("viewport", "data"),
+    Input("graph", "relayoutData"),
+    prevent_initial_call=True,
+)
+def update_viewport(relayout):
+    """
+    Stores the visible image region (x0, y0, x1, y1) when the user zooms or pans, or None when the
+    axes are reset to the whole image.
+    """
+    if not relayout:
+        raise PreventUpdate
+    if relayout.get("xaxis.autorange") or relayout.get("yaxis.autorange"):
+        return None
+    keys = ["xaxis.range[0]", "xaxis.range[1]", "yaxis.range[0]", "yaxis.range[1]"]
+    if not all(key in relayout for key in keys):
+        # e.g. a change of the drag mode
+        raise PreventUpdate
+    xa, xb, ya, yb = (relayout[key] for key in keys)
+    # the y axis is reversed
+    return [min(xa, xb), min(ya, yb), max(xa, xb), max(ya, yb)]
+
+
 @app.callback(
     [
         Output("graph", "figure"),
@@ -452,11 +640,12 @@ def higlight_row(string):
         Input("table-line", "data"),
         Input("table-line", "selected_columns"),
         Input("color-drop-menu", "value"),
+        Input("viewport", "data"),
     ],
     [State("row", "children")],
     prevent_initial_call=True,
 )
-def highlight_filter(indices, cell_index, data, active_columns, color_column, previous_row):
+def highlight_filter(indices, cell_index, data, active_columns, color_column, viewport, previous_row):
     """
     Updates figure and labels array when a selection is made in the table.
 
@@ -474,7 +663,7 @@ def highlight_filter(indices, cell_index, data, active_columns, color_column, pr
     filtered_labels = _table.loc[indices, "label"].values
     filtered_table = _table.query("label in @filtered_labels")
     fig = image_with_contour(
-        img, filtered_labels, filtered_table, active_columns, color_column
+        img, filtered_labels, filtered_table, active_columns, color_column, viewport=viewport
     )
 
     if cell_index and cell_index["row"] != previous_row:
@@ -484,11 +673,7 @@ def highlight_filter(indices, cell_index, data, active_columns, color_column, pr
         # logging.info(input_id)
 
         label = filtered_labels[cell_index["row"]]
-        mask = (label_array == label).astype(float)
-        contour = measure.find_contours(label_array == label, 0.5)[0]
-        # We need to move the contour left and up by one, because
-        # we padded the label array
-        y, x = contour.T - 1
+        x, y = region_index.contour(label)
         # Add the computed contour to the figure as a scatter trace
         fig.add_scatter(
             x=x,
@@ -505,17 +690,30 @@ def highlight_filter(indices, cell_index, data, active_columns, color_column, pr
 
 
 @app.callback(
-    Output("download-button", "href"),
-    Input("table-line", "data"),
-    State("table-line", "columns"),
+    Output("download", "data"),
+    Input("download-button", "n_clicks"),
+    [
+        State("table-line", "data"),
+        State("table-line", "columns"),
+        State("table-line", "derived_virtual_indices"),
+        State("table-line", "selected_rows"),
+        State("download-rows", "value"),
+        State("download-format", "value"),
+    ],
+    prevent_initial_call=True,
 )
-def update_download_link(data, columns):
-    def get_table_csv(table):
-        return "data:text/csv;base64," + base64.b64encode(table.to_csv(index=False).encode()).decode()
-
+def download_table(n_clicks, data, columns, indices, selected_rows, rows, export_format):
+    """
+    Exports the table when the download button is clicked: all rows, the rows remaining after filtering
+    and sorting, or the selected rows, as csv, gzip-compressed csv or (with pyarrow) parquet. The file is
+    written on the server and streamed to the browser, nothing is prepared while the table is edited.
+    """
     table = pd.DataFrame(data, columns=[c["name"] for c in columns])
-    csv_file = get_table_csv(table)
-    return csv_file
+    if rows == "filtered" and indices is not None:
+        table = table.iloc[indices]
+    elif rows == "selected":
+        table = table.iloc[sorted(selected_rows or [])]
+    return dcc.send_bytes(EXPORT_FORMATS[export_format], f"object_properties.{export_format}", table=table)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+# multi-resolution tile serving for the image view
+
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.scn', '.bif', '.mrxs')
+
+
+class TileSource:
+    """
+    Lazy multi-resolution tiles of a slide or a plain image.
+
+    Slides are read with TiffSlide, one tile at a time from the pyramid level closest to the requested
+    resolution. Plain images are opened with PIL and their lower resolution levels are created on first
+    use by halving the previous level. Encoded tiles are kept in an LRU cache, so panning back and forth
+    doesn't decode and encode the same tiles again.
+
+    Parameters
+    ----------
+    filename : str
+        path to the slide or image
+    tile_size : int
+        side of a tile in pixels
+    cache_size : int
+        number of encoded tiles kept in the cache
+    grayscale : bool
+        encode the tiles as greyscale images
+    quality : int
+        JPEG quality of the encoded tiles
+    """
+
+    def __init__(self, filename, tile_size=256, cache_size=1024, grayscale=True, quality=85):
+        self.filename = filename
+        self.tile_size = tile_size
+        self.cache_size = cache_size
+        self.grayscale = grayscale
+        self.quality = quality
+        self.url_prefix = '/tiles'
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        if os.path.splitext(filename)[1].lower() in SLIDE_EXTENSIONS:
+            from tiffslide import TiffSlide
+            self.slide = TiffSlide(filename)
+            self.level_dimensions = list(self.slide.level_dimensions)
+            self.level_downsamples = list(self.slide.level_downsamples)
+        else:
+            self.slide = None
+            # PIL only reads the header here, the pixels are decoded on first use
+            self._levels = {0: Image.open(filename)}
+            width, height = self._levels[0].size
+            n_levels = max(1, math.ceil(math.log2(max(width, height) / tile_size)) + 1)
+            self.level_dimensions = [(max(1, width // 2 ** i), max(1, height // 2 ** i)) for i in range(n_levels)]
+            self.level_downsamples = [float(2 ** i) for i in range(n_levels)]
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    def best_level(self, downsample):
+        """
+        Returns the level with the largest downsample that is not larger than the given one.
+        """
+        level = 0
+        for i, level_downsample in enumerate(self.level_downsamples):
+            if level_downsample <= downsample * 1.01:
+                level = i
+        return level
+
+    def _level_image(self, level):
+        # the levels are created on first use, each from the next higher resolution level
+        with self._lock:
+            self._levels[0].load()
+            for i in range(1, level + 1):
+                if i not in self._levels:
+                    self._levels[i] = self._levels[i - 1].resize(self.level_dimensions[i], resample=Image.BILINEAR)
+            return self._levels[level]
+
+    def read_region(self, location, level, size):
+        """
+        Reads a region of a level as an RGB PIL image.
+
+        Parameters
+        ----------
+        location : tuple
+            (x, y) of the top left corner in level 0 coordinates
+        level : int
+            pyramid level
+        size : tuple
+            (width, height) of the region at the given level
+        """
+        if self.slide is not None:
+            return self.slide.read_region(location, level, size).convert('RGB')
+        downsample = self.level_downsamples[level]
+        left = int(location[0] / downsample)
+        upper = int(location[1] / downsample)
+        return self._level_image(level).crop((left, upper, left + size[0], upper + size[1])).convert('RGB')
+
+    def tile_box(self, level, col, row):
+        """
+        Returns the (x0, y0, x1, y1) box of a tile in level 0 coordinates.
+        """
+        width, height = self.level_dimensions[level]
+        downsample = self.level_downsamples[level]
+        left, upper = col * self.tile_size, row * self.tile_size
+        right, lower = min(left + self.tile_size, width), min(upper + self.tile_size, height)
+        return left * downsample, upper * downsample, right * downsample, lower * downsample
+
+    def visible_tiles(self, box, level):
+        """
+        Returns the (col, row) of the tiles of a level that intersect the box (x0, y0, x1, y1) in level 0
+        coordinates.
+        """
+        width, height = self.level_dimensions[level]
+        step = self.tile_size * self.level_downsamples[level]
+        cols = math.ceil(width / self.tile_size)
+        rows = math.ceil(height / self.tile_size)
+        col0, row0 = max(0, int(box[0] // step)), max(0, int(box[1] // step))
+        col1, row1 = min(cols - 1, int(box[2] // step)), min(rows - 1, int(box[3] // step))
+        return [(col, row) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+    def tile(self, level, col, row):
+        if not 0 <= level < self.level_count:
+            raise ValueError(f'Level {level} is out of range')
+        width, height = self.level_dimensions[level]
+        if not (0 <= col * self.tile_size < width and 0 <= row * self.tile_size < height):
+            raise ValueError(f'Tile {level}/{col}/{row} is out of range')
+        downsample = self.level_downsamples[level]
+        x0, y0, x1, y1 = self.tile_box(level, col, row)
+        size = (round((x1 - x0) / downsample), round((y1 - y0) / downsample))
+        return self.read_region((int(x0), int(y0)), level, size)
+
+    def tile_bytes(self, level, col, row):
+        """
+        Returns a tile encoded as JPEG, from the cache if it was encoded before.
+        """
+        key = (level, col, row)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        tile = self.tile(level, col, row)
+        if self.grayscale:
+            tile = tile.convert('L')
+        buffer = io.BytesIO()
+        tile.save(buffer, format='JPEG', quality=self.quality)
+        data = buffer.getvalue()
+
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    def register_routes(self, server, prefix='/tiles'):
+        """
+        Serves the tiles from a Flask server as <prefix>/<level>/<col>/<row>.jpg.
+        """
+        from flask import Response, abort
+
+        def serve_tile(level, col, row):
+            try:
+                data = self.tile_bytes(level, col, row)
+            except ValueError:
+                abort(404)
+            return Response(data, mimetype='image/jpeg', headers={'Cache-Control': 'public, max-age=3600'})
+
+        server.add_url_rule(f'{prefix}/<int:level>/<int:col>/<int:row>.jpg', 'serve_tile', serve_tile)
+        self.url_prefix = prefix
+        return server
+
+    def tile_url(self, level, col, row):
+        return f'{self.url_prefix}/{level}/{col}/{row}.jpg'
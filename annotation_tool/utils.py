@@ -1,12 +1,261 @@
 # helper functions
 
+import base64
 import numpy as np
+import pandas as pd
+import matplotlib as mpl
+from scipy import ndimage
+from skimage import draw, measure
+
 
 def get_polygons_from_outlines(outlines_txt):
     polygons = []
     for o in outlines_txt:
         coords_flat = np.fromstring(o, sep=',').astype(int)
+        if len(coords_flat) < 2:
+            continue
         # make pairs x, y
-        polyg = np.array([np.array(x) for x in zip(coords_flat[::2], coords_flat[1::2])])
-        polygons.append(polyg)
+        polygons.append(coords_flat[: len(coords_flat) // 2 * 2].reshape(-1, 2))
     return polygons
+
+
+def iter_base64_lines(content_string, chunk_size=4 * 2 ** 20):
+    """
+    Decodes base64 encoded text chunk by chunk and yields its lines, so that only one decoded chunk is held
+    in memory at a time.
+
+    Parameters
+    ----------
+    content_string : str
+        base64 encoded text, e.g. the data part of a dcc.Upload contents string
+    chunk_size : int
+        number of base64 characters decoded at a time, rounded down to a multiple of 4
+    """
+    chunk_size = max(4, chunk_size // 4 * 4)
+    rest = b""
+    for start in range(0, len(content_string), chunk_size):
+        block = rest + base64.b64decode(content_string[start:start + chunk_size])
+        lines = block.split(b"\n")
+        # the last line may continue in the next chunk
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode()
+    if rest:
+        yield rest.decode()
+
+
+def polygons_from_upload(contents, chunk_size=4 * 2 ** 20):
+    """
+    Parses the polygons of an outline file uploaded with dcc.Upload (a "data:<type>;base64,<data>" string)
+    without writing it to disk, see iter_base64_lines.
+    """
+    _, content_string = contents.split(",", 1)
+    return get_polygons_from_outlines(iter_base64_lines(content_string, chunk_size))
+
+
+def format_hover(row):
+    """
+    Returns the hover text of a region from its table row (a pandas.Series of the displayed columns).
+    """
+    return (
+        "<br>".join(
+            [
+                # All numbers are passed as floats. If there are no decimals, cast to int for visibility
+                f"{prop_name}: {f'{int(prop_val):d}' if prop_val.is_integer() else f'{prop_val:.3f}'}"
+                if np.issubdtype(type(prop_val), "float")
+                else f"{prop_name}: {prop_val}"
+                for prop_name, prop_val in row.items()
+            ]
+        )
+        # remove the trace name. See e.g. https://plotly.com/python/reference/#scatter-hovertemplate
+        + " <extra></extra>"
+    )
+
+
+class RegionIndex:
+    """
+    Contours and properties of the regions of a label image, computed once so that the app callbacks
+    only have to look them up.
+
+    Contours are traced on the bounding-box crop of every region instead of the full image, and the hover
+    texts and colour mappings derived from the property table are memoised per column selection.
+
+    Parameters
+    ----------
+    label_array : np.ndarray
+        label image, 0 is background
+    intensity_image : np.ndarray
+        image the intensity properties are computed on
+    properties : list
+        names of the skimage.measure.regionprops properties of the table
+    min_area : int
+        regions with an area up to min_area pixels are left out of the table
+    cmap : str
+        name of the matplotlib colormap used for the colour mappings
+    """
+
+    def __init__(self, label_array, intensity_image=None, properties=("label", "area"), min_area=None,
+                 cmap="viridis"):
+        self.label_array = label_array
+        properties = list(properties)
+        table = pd.DataFrame(measure.regionprops_table(label_array, intensity_image=intensity_image,
+                                                       properties=properties + ["area"] * ("area" not in properties)))
+        if min_area is not None:
+            table = table[table["area"] > min_area]
+        self.table = table[properties]
+        self.cmap = mpl.colormaps[cmap]
+        self._slices = ndimage.find_objects(label_array)
+        # x0, y0, x1, y1 of every label, indexed by label - 1
+        self._bboxes = np.array([(s[1].start, s[0].start, s[1].stop, s[0].stop) if s is not None else (0, 0, 0, 0)
+                                 for s in self._slices], dtype=float).reshape(-1, 4)
+        self._contours = {label: self._trace_contour(label) for label in self.table["label"]}
+        self._simplified = {}
+        self._hover_texts = {}
+        self._hover_data = {}
+        self._colors = {}
+        self._color_bins = {}
+
+    @classmethod
+    def from_outlines(cls, polygons, shape, intensity_image=None, properties=("label", "area"), min_area=None,
+                      cmap="viridis"):
+        """
+        Builds the index from Cellpose outlines (list of (n, 2) arrays of x, y coordinates), labelled
+        1..len(polygons) in file order.
+        """
+        label_array = np.zeros(shape, dtype=np.int32)
+        for label, polygon in enumerate(polygons, start=1):
+            if len(polygon) < 3:
+                continue
+            rr, cc = draw.polygon(polygon[:, 1], polygon[:, 0], shape=shape)
+            label_array[rr, cc] = label
+        return cls(label_array, intensity_image=intensity_image, properties=properties, min_area=min_area,
+                   cmap=cmap)
+
+    def _trace_contour(self, label):
+        slices = self._slices[label - 1]
+        # pad the crop with zero to get closed contours of regions on the crop edge
+        crop = np.pad(self.label_array[slices] == label, 1)
+        contour = measure.find_contours(crop, 0.5)[0]
+        # move the contour back by the padding and into image coordinates
+        y = contour[:, 0] - 1 + slices[0].start
+        x = contour[:, 1] - 1 + slices[1].start
+        return x, y
+
+    def contour(self, label):
+        """
+        Returns the x and y coordinates of the outer contour of a region.
+        """
+        label = int(label)
+        if label not in self._contours:
+            self._contours[label] = self._trace_contour(label)
+        return self._contours[label]
+
+    def simplified_contour(self, label, tolerance):
+        """
+        Returns the contour of a region simplified with skimage.measure.approximate_polygon. The tolerance
+        (in image pixels) is rounded down to a power of two, so that the simplified contours are cached and
+        shared by nearby zoom levels.
+        """
+        if tolerance <= 0:
+            return self.contour(label)
+        level = 2.0 ** np.floor(np.log2(tolerance))
+        key = (int(label), level)
+        if key not in self._simplified:
+            x, y = self.contour(label)
+            coords = measure.approximate_polygon(np.column_stack([x, y]), level)
+            self._simplified[key] = coords[:, 0], coords[:, 1]
+        return self._simplified[key]
+
+    def level_of_detail(self, labels, viewport=None, min_size=1.0):
+        """
+        Selects the regions worth drawing: those whose bounding box intersects the viewport and spans at
+        least min_size image pixels.
+
+        Parameters
+        ----------
+        labels : list
+            candidate labels
+        viewport : tuple
+            (x0, y0, x1, y1) of the visible image region, the whole image if None
+        min_size : float
+            smallest drawn bounding box side in image pixels, e.g. the size of a screen pixel
+
+        Returns
+        -------
+        labels : np.ndarray
+            the selected labels
+        """
+        labels = np.asarray(labels, dtype=int)
+        if len(labels) == 0:
+            return labels
+        bboxes = self._bboxes[labels - 1]
+        keep = np.maximum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]) >= min_size
+        if viewport is not None:
+            x0, y0, x1, y1 = viewport
+            keep &= (bboxes[:, 2] >= x0) & (bboxes[:, 0] <= x1) & (bboxes[:, 3] >= y0) & (bboxes[:, 1] <= y1)
+        return labels[keep]
+
+    def hover_texts(self, columns):
+        """
+        Returns a dict mapping every label to the hover text of the given table columns.
+        """
+        key = tuple(columns)
+        if key not in self._hover_texts:
+            rows = self.table.set_index(self.table["label"])[list(columns)]
+            self._hover_texts[key] = {label: format_hover(row) for label, row in rows.iterrows()}
+        return self._hover_texts[key]
+
+    def hover_data(self, columns):
+        """
+        Returns a dict mapping every label to its customdata row [label, *values of the given table columns],
+        and a hovertemplate showing those values that is shared by all regions, so that a trace only carries
+        the values of each point instead of a hover text.
+        """
+        key = tuple(columns)
+        if key not in self._hover_data:
+            rows = self.table.set_index(self.table["label"])[list(columns)].copy()
+            lines = []
+            for i, (name, values) in enumerate(rows.items(), start=1):
+                # Like format_hover, show integral numbers without decimals
+                if np.issubdtype(values.dtype, np.floating) and not np.all(np.mod(values.to_numpy(), 1) == 0):
+                    lines.append(f"{name}: %{{customdata[{i}]:.3f}}")
+                else:
+                    lines.append(f"{name}: %{{customdata[{i}]}}")
+                    if np.issubdtype(values.dtype, np.floating):
+                        rows[name] = values.astype(int)
+            data = {int(label): [int(label), *row] for label, row in zip(rows.index, rows.itertuples(index=False))}
+            self._hover_data[key] = data, "<br>".join(lines) + " <extra></extra>"
+        return self._hover_data[key]
+
+    def colors(self, column):
+        """
+        Returns a dict mapping every label to the hex colour of its value in column, with the colormap
+        normalised to the range of the column over all regions, and the (min, max) tick values of the
+        colour bar.
+        """
+        if column not in self._colors:
+            values = self.table[column].to_numpy()
+            norm = mpl.colors.Normalize(vmin=values.min(), vmax=values.max())
+            rgba = self.cmap(norm(values))
+            mapping = dict(zip(self.table["label"], (mpl.colors.rgb2hex(c) for c in rgba)))
+            nonzero = values[values != 0]
+            ticks = (nonzero.min() if len(nonzero) else values.min(), values.max())
+            self._colors[column] = mapping, ticks
+        return self._colors[column]
+
+    def color_bins(self, column, n_bins=50):
+        """
+        Returns a dict mapping every label to one of n_bins equal-width bins of the range of column, and the
+        hex colour of every bin, so that regions can be drawn in one trace per bin.
+        """
+        key = (column, n_bins)
+        if key not in self._color_bins:
+            values = self.table[column].to_numpy()
+            norm = mpl.colors.Normalize(vmin=values.min(), vmax=values.max())
+            bins = np.minimum((np.asarray(norm(values), dtype=float) * n_bins).astype(int), n_bins - 1)
+            bin_colors = [mpl.colors.rgb2hex(self.cmap((i + 0.5) / n_bins)) for i in range(n_bins)]
+            self._color_bins[key] = dict(zip(self.table["label"], bins)), bin_colors
+        return self._color_bins[key]
+
+    def colorscale(self, n=50):
+        return [mpl.colors.rgb2hex(self.cmap(i)) for i in np.linspace(0, 1, n)]
@@ -0,0 +1,327 @@
+'''
+Benchmarks of the abscr hot paths on synthetic data.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --cells 1000 10000 100000 --repeat 3
+
+Results are written as JSON to benchmarks/results/<timestamp>.json (or --output). Pass a previous result file
+with --compare to print the speed-up of every benchmark relative to that run.
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import re
+import subprocess
+import tempfile
+import time
+import numpy as np
+from benchmarks import synthetic
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+BENCHMARKS = []
+
+
+def benchmark(group, needs_mask=False):
+    '''
+    Registers a benchmark. The decorated function receives the synthetic data of a run and returns
+    the callable that is timed.
+    '''
+    def register(func):
+        BENCHMARKS.append({'name': f'{group}.{func.__name__}', 'group': group,
+                           'needs_mask': needs_mask, 'make': func})
+        return func
+    return register
+
+
+@benchmark('utils')
+def read_outlines_from_txt(data):
+    from abscr.util import utils
+    return lambda: utils.read_outlines_from_txt(data['outlines_file'])
+
+
+@benchmark('utils')
+def scale_outlines(data):
+    from abscr.util import utils
+    return lambda: utils.scale_outlines(data['outlines_file'], 2)
+
+
+@benchmark('utils')
+def smooth_outlines_moving_avg(data):
+    from abscr.util import utils
+    return lambda: utils.smooth_outlines_moving_avg(data['outlines_file'], num_avg=5)
+
+
+@benchmark('utils')
+def iterative_scaling_moving_avg(data):
+    from abscr.util import utils
+    return lambda: utils.iterative_scaling_moving_avg(data['outlines_file'], num_avg=5, factor=4, scale_step=2)
+
+
+@benchmark('utils')
+def iter_iterative_scaling_moving_avg(data):
+    from abscr.util import utils
+
+    def run():
+        for _ in utils.iter_iterative_scaling_moving_avg(data['outlines_file'], num_avg=5, factor=4, scale_step=2):
+            pass
+    return run
+
+
+@benchmark('utils')
+def make_polygons_from_outlines(data):
+    from abscr.util import utils
+    return lambda: utils.make_polygons_from_outlines(data['outlines_file'])
+
+
+@benchmark('utils')
+def filter_outlines(data):
+    from abscr.util import utils
+    outlines = data['outlines']
+    w, h = data['outlines_extent']
+    return lambda: utils.filter_outlines(0, w // 2, 0, h // 2, outlines)
+
+
+@benchmark('utils')
+def outlines_to_wkt_polygons(data):
+    from abscr.util import utils
+    return lambda: utils.outlines_to_wkt_polygons(data['outlines_file'])
+
+
+@benchmark('counter', needs_mask=True)
+def count_cells_from_mask_array(data):
+    from abscr.analysis.counter import CellCounter
+    return lambda: CellCounter().count_cells_from_masks(data['masks'])
+
+
+@benchmark('counter')
+def count_cells_from_txt(data):
+    from abscr.analysis.counter import CellCounter
+    return lambda: CellCounter().count_cells_from_masks(data['outlines_file'])
+
+
+def _shapely_polygons(data):
+    from shapely import Polygon
+    if 'shapely_polygons' not in data:
+        data['shapely_polygons'] = [Polygon(list(zip(o[::2], o[1::2]))) for o in data['outlines']]
+    return data['shapely_polygons']
+
+
+@benchmark('analysis')
+def calc_convexity(data):
+    from abscr.analysis import analysis
+    polygons = _shapely_polygons(data)
+    return lambda: [analysis.calc_convexity(p) for p in polygons]
+
+
+@benchmark('analysis')
+def calc_solidity(data):
+    from abscr.analysis import analysis
+    polygons = _shapely_polygons(data)
+    return lambda: [analysis.calc_solidity(p) for p in polygons]
+
+
+@benchmark('analysis')
+def calc_roundness(data):
+    from abscr.analysis import analysis
+    polygons = _shapely_polygons(data)
+    return lambda: [analysis.calc_roundness(p) for p in polygons]
+
+
+@benchmark('preprocessing', needs_mask=True)
+def scale_image_array(data):
+    from abscr.preprocessing.preprocessor import Preprocessor
+    return lambda: Preprocessor().scale_image(data['image'], 4)
+
+
+@benchmark('preprocessing', needs_mask=True)
+def scale_image_slide(data):
+    from tiffslide import TiffSlide
+    from abscr.preprocessing.preprocessor import Preprocessor
+    slide = TiffSlide(data['slide_file'])
+    return lambda: Preprocessor().scale_image(slide, 4)
+
+
+@benchmark('preprocessing', needs_mask=True)
+def crop_image_array(data):
+    from abscr.preprocessing.preprocessor import Preprocessor
+    h, w = data['image'].shape[:2]
+    return lambda: Preprocessor().crop_image(data['image'], w // 4, h // 4, 3 * w // 4, 3 * h // 4)
+
+
+@benchmark('preprocessing', needs_mask=True)
+def crop_image_slide(data):
+    from tiffslide import TiffSlide
+    from abscr.preprocessing.preprocessor import Preprocessor
+    slide = TiffSlide(data['slide_file'])
+    w, h = slide.dimensions
+    return lambda: Preprocessor().crop_image(slide, w // 4, h // 4, 3 * w // 4, 3 * h // 4, level=0)
+
+
+def segmentation_benchmark(n_cells=36, model_type='cyto', repeat=3, cpu_config=None):
+    '''
+    Times Segmentor.predict_epithelial on a small synthetic image with n_cells cells. The model is loaded
+    before timing, so only inference is measured. Also returns the number of cells the model found, which
+    the throughput is based on.
+    '''
+    from abscr.segmentation.segmentor import Segmentor
+
+    image = synthetic.make_image(synthetic.make_label_mask(n_cells, cell_diameter=30))
+    segmentor = Segmentor()
+    segmentor.get_model(model_type, cpu_config=cpu_config)
+    found = []
+
+    def predict():
+        result = segmentor.predict_epithelial(image, diameter=30, model_type=model_type, cpu_config=cpu_config)
+        found.append(int(np.count_nonzero(np.unique(result.masks))))
+
+    times = time_callable(predict, repeat)
+    return times, n_cells, found[-1], image.size
+
+
+def segmentation_variants():
+    from abscr.segmentation.cpu_inference import CPUInferenceConfig
+    return {
+        'segmentation.predict_epithelial': None,
+        'segmentation.predict_epithelial_cpu': CPUInferenceConfig(),
+        'segmentation.predict_epithelial_cpu_int8': CPUInferenceConfig(quantize=True),
+    }
+
+
+def time_callable(func, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        tic = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - tic)
+    return times
+
+
+def make_data(n_cells, workdir, max_mask_cells):
+    outlines_file = synthetic.save_outlines_file(os.path.join(workdir, f'outlines_{n_cells}.txt'), n_cells)
+    rows, cols = synthetic.grid_shape(n_cells)
+    with open(outlines_file) as f:
+        outlines = [np.fromstring(o, sep=',').astype(int) for o in f]
+    data = {
+        'outlines_file': outlines_file,
+        'outlines': outlines,
+        'outlines_extent': (int(cols * 30 * 1.25), int(rows * 30 * 1.25)),
+    }
+    if n_cells <= max_mask_cells:
+        data['masks'] = synthetic.make_label_mask(n_cells)
+        data['image'] = synthetic.make_image(data['masks'])
+        data['slide_file'] = synthetic.save_pyramid_tiff(os.path.join(workdir, f'slide_{n_cells}.tiff'),
+                                                         data['image'])
+    return data
+
+
+def result_record(name, group, n_cells, times, cells_processed=None, **extra):
+    # n_cells is the input size the results are compared by; the throughput is based on the cells actually
+    # processed where that differs, e.g. the cells a segmentation model found
+    median = float(np.median(times))
+    if cells_processed is None:
+        cells_processed = n_cells
+    return dict({
+        'benchmark': name,
+        'group': group,
+        'n_cells': n_cells,
+        'times': times,
+        'median': median,
+        'min': min(times),
+        'cells_per_second': cells_processed / median if median > 0 else None,
+    }, **extra)
+
+
+def run(cell_counts, repeat=3, only=None, max_mask_cells=10_000, segmentation=True):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_cells in cell_counts:
+            data = make_data(n_cells, workdir, max_mask_cells)
+            for bench in BENCHMARKS:
+                if only and not re.search(only, bench['name']):
+                    continue
+                if bench['needs_mask'] and 'masks' not in data:
+                    continue
+                times = time_callable(bench['make'](data), repeat)
+                results.append(result_record(bench['name'], bench['group'], n_cells, times))
+                print(f"{bench['name']:<45} {n_cells:>9} cells {results[-1]['median']:>10.4f} s")
+
+    if not segmentation:
+        return results
+    for name, cpu_config in segmentation_variants().items():
+        if only and not re.search(only, name):
+            continue
+        try:
+            times, n_cells, cells_found, pixels = segmentation_benchmark(repeat=repeat, cpu_config=cpu_config)
+        except Exception as e:
+            print(f'{name} skipped: {e}')
+            continue
+        results.append(result_record(name, 'segmentation', n_cells, times, cells_processed=cells_found,
+                                     cells_found=cells_found, pixels=pixels))
+        print(f"{name:<45} {n_cells:>9} cells {results[-1]['median']:>10.4f} s ({cells_found} found)")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r['benchmark'], r['n_cells']): r['median'] for r in json.load(f)['results']}
+    print(f"\n{'benchmark':<45} {'cells':>9} {'baseline':>10} {'current':>10} {'speed-up':>9}")
+    for r in results:
+        old = baseline.get((r['benchmark'], r['n_cells']))
+        if old is None:
+            continue
+        print(f"{r['benchmark']:<45} {r['n_cells']:>9} {old:>10.4f} {r['median']:>10.4f} {old / r['median']:>8.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark abscr on synthetic data.')
+    parser.add_argument('--cells', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of cells to benchmark with (e.g. 1000 10000 100000 1000000)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default=None, help='regular expression selecting benchmarks by name')
+    parser.add_argument('--max-mask-cells', type=int, default=10_000,
+                        help='largest cell count for which label masks and images are generated')
+    parser.add_argument('--no-segmentation', action='store_true', help='skip the Cellpose benchmark')
+    parser.add_argument('--output', default=None, help='result file, defaults to benchmarks/results/<timestamp>.json')
+    parser.add_argument('--compare', default=None, help='previous result file to compare with')
+    args = parser.parse_args(argv)
+
+    results = run(args.cells, repeat=args.repeat, only=args.only, max_mask_cells=args.max_mask_cells,
+                  segmentation=not args.no_segmentation)
+    report = dict(environment(), results=results)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
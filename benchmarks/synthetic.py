@@ -0,0 +1,113 @@
+'''Synthetic label masks, outline files and slides for benchmarking'''
+
+import math
+import numpy as np
+
+
+def grid_shape(n_cells):
+    '''
+    Returns the number of rows and columns of the smallest near-square grid holding n_cells cells.
+    '''
+    cols = math.ceil(math.sqrt(n_cells))
+    rows = math.ceil(n_cells / cols)
+    return rows, cols
+
+
+def make_label_mask(n_cells, cell_diameter=12, spacing=None, seed=0):
+    '''
+    Creates a label mask of n_cells disc-shaped cells laid out on a regular grid in shuffled label order.
+
+        Parameters:
+            n_cells (int): number of cells
+            cell_diameter (int): diameter of a cell in pixels
+            spacing (int): distance between the grid nodes, defaults to 1.25 * cell_diameter
+            seed (int): random seed
+
+        Returns:
+            masks (np.ndarray): label mask where 0 is background and 1..n_cells are cells
+    '''
+    rng = np.random.default_rng(seed)
+    spacing = spacing or int(math.ceil(cell_diameter * 1.25))
+    rows, cols = grid_shape(n_cells)
+
+    yy, xx = np.mgrid[:spacing, :spacing]
+    radius = cell_diameter / 2
+    disc = (yy - spacing / 2 + 0.5) ** 2 + (xx - spacing / 2 + 0.5) ** 2 <= radius ** 2
+
+    ids = np.zeros(rows * cols, dtype=np.int32)
+    ids[:n_cells] = rng.permutation(n_cells) + 1
+    ids = ids.reshape(rows, cols)
+    masks = np.repeat(np.repeat(ids, spacing, axis=0), spacing, axis=1)
+    masks *= np.tile(disc, (rows, cols))
+    return masks
+
+
+def make_outlines(n_cells, cell_diameter=30, spacing=None, jitter=0.15, seed=0):
+    '''
+    Creates outlines of n_cells roughly elliptical cells in the format written by Cellpose
+    (flat arrays of integer x, y coordinates), with about pi * cell_diameter points per outline.
+
+        Returns:
+            outlines (list): list of flat np.ndarray outlines
+    '''
+    rng = np.random.default_rng(seed)
+    spacing = spacing or cell_diameter * 1.25
+    rows, cols = grid_shape(n_cells)
+    n_points = max(8, int(math.pi * cell_diameter))
+    angles = np.linspace(0, 2 * math.pi, n_points, endpoint=False)
+
+    outlines = []
+    for i in range(n_cells):
+        cy, cx = (i // cols + 0.5) * spacing, (i % cols + 0.5) * spacing
+        a, b = cell_diameter / 2 * (1 + jitter * rng.uniform(-1, 1, 2))
+        rot = rng.uniform(0, math.pi)
+        noise = 1 + jitter / 3 * rng.uniform(-1, 1, n_points)
+        x = cx + noise * (a * np.cos(angles) * math.cos(rot) - b * np.sin(angles) * math.sin(rot))
+        y = cy + noise * (a * np.cos(angles) * math.sin(rot) + b * np.sin(angles) * math.cos(rot))
+        coords_flat = np.empty(2 * n_points, dtype=int)
+        coords_flat[::2] = np.round(x)
+        coords_flat[1::2] = np.round(y)
+        outlines.append(coords_flat)
+    return outlines
+
+
+def save_outlines_file(savename, n_cells, **kwargs):
+    '''
+    Writes synthetic outlines (see make_outlines) to a .txt file in the Cellpose outline format.
+    '''
+    with open(savename, 'w') as f:
+        for o in make_outlines(n_cells, **kwargs):
+            f.write(','.join(map(str, o)) + '\n')
+    return savename
+
+
+def make_image(masks, seed=0):
+    '''
+    Renders a grayscale image of dark cells on a bright background from a label mask,
+    similar to a brightfield swab image.
+    '''
+    rng = np.random.default_rng(seed)
+    image = np.full(masks.shape, 220, dtype=np.float32)
+    image[masks > 0] = 120
+    image += rng.normal(0, 10, masks.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def save_pyramid_tiff(savename, image, levels=3, mpp=0.25, tile=256):
+    '''
+    Writes an RGB image as a tiled pyramidal TIFF readable by TiffSlide, downsampling by 2 per level.
+    '''
+    import tifffile
+
+    if image.ndim == 2:
+        image = np.stack([image] * 3, axis=-1)
+    resolution = (1e4 / mpp, 1e4 / mpp)
+    with tifffile.TiffWriter(savename, bigtiff=True) as tif:
+        tif.write(image, subifds=levels - 1, tile=(tile, tile), photometric='rgb',
+                  resolution=resolution, resolutionunit='CENTIMETER', metadata=None)
+        level = image
+        for i in range(1, levels):
+            level = level[::2, ::2]
+            tif.write(level, subfiletype=1, tile=(tile, tile), photometric='rgb',
+                      resolution=(resolution[0] / 2 ** i, resolution[1] / 2 ** i), resolutionunit='CENTIMETER')
+    return savename
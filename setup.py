@@ -2,5 +2,10 @@ from setuptools import setup, find_packages
 setup(
     name='ABSCR',
     version='1.0.0',
-    packages=find_packages(include=['ome']),
+    packages=find_packages(include=['abscr', 'abscr.*']),
+    entry_points={
+        'console_scripts': [
+            'abscr-batch=abscr.batch.cli:main',
+        ],
+    },
 )
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import time
+import unittest
+from abscr.omero_connection.async_client import AsyncOmeroClient
+
+
+class _MockClient:
+    '''Stands in for an OmeroClient session with a slow, non-thread-safe gateway.'''
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.active = 0
+        self.max_active = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def get_metadata(self, object_name, object_id, namespace=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.latency)
+        with self._lock:
+            self.active -= 1
+        if object_id < 0:
+            raise ValueError(f'No {object_name} {object_id}')
+        return {'id': str(object_id)}
+
+    def close(self):
+        self.closed = True
+
+
+class TestAsyncOmeroClient(unittest.TestCase):
+    def test_concurrent_sessions(self):
+        clients = [_MockClient() for _ in range(4)]
+        client = AsyncOmeroClient(clients)
+        tic = time.perf_counter()
+        metadata = asyncio.run(client.get_metadata_many('Image', list(range(40))))
+        elapsed = time.perf_counter() - tic
+        client.close()
+
+        self.assertEqual(metadata, {i: {'id': str(i)} for i in range(40)})
+        # 40 calls of 50 ms on 4 sessions take about 0.5 s instead of 2 s
+        self.assertLess(elapsed, 1.2)
+        # every session serves one call at a time
+        self.assertEqual(max(c.max_active for c in clients), 1)
+        self.assertTrue(all(c.closed for c in clients))
+
+    def test_concurrency_limit_and_failures(self):
+        clients = [_MockClient() for _ in range(4)]
+        client = AsyncOmeroClient(clients, max_concurrency=1)
+        tic = time.perf_counter()
+        results = asyncio.run(client.gather('get_metadata', [('Image', 1), ('Image', -1), ('Image', 2)]))
+        # the calls ran one after another
+        self.assertGreaterEqual(time.perf_counter() - tic, 0.15)
+        self.assertEqual(results[0], {'id': '1'})
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], {'id': '2'})
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from abscr.batch import cli
+from abscr.batch.manifest import JobManifest, FAILED
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, *parts):
+        path = os.path.join(self.tmpdir.name, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        return path
+
+    def test_unit_ids_are_unique(self):
+        a = self.touch('a', 'swab.png')
+        b = self.touch('b', 'swab.png')
+        self.touch('a', 'other.png')
+        units = cli.collect_units([os.path.dirname(a), os.path.dirname(b), a])
+        ids = [unit_id for unit_id, _, _ in units]
+        # the input listed twice is processed once
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(sorted(unit_id.rsplit('_', 1)[0] for unit_id in ids), ['other', 'swab', 'swab'])
+
+    def test_unit_id_is_kept_when_a_collision_is_added(self):
+        a = self.touch('a', 'swab.png')
+        b = self.touch('b', 'swab.png')
+        [(first_id, _, _)] = cli.collect_units([a])
+        # the second run adds a file of the same name from another directory
+        units = cli.collect_units([a, b])
+        self.assertEqual(units[0], (first_id, 'image', a))
+        self.assertNotEqual(units[1][0], first_id)
+
+    def test_unreadable_source_fails_its_unit(self):
+        image = SimpleNamespace(getId=lambda: 1)
+        units = [('broken_1', 'omero', (None, image))]
+        params = {'tile_size': None, 'trace': False, 'cpu_inference': False, 'quantize': False,
+                  'model_type_epithelial': 'cyto', 'model_type_immune': None}
+
+        def load_source(kind, source, in_process=False):
+            raise IOError('image not readable')
+
+        with mock.patch.object(cli, '_load_source', load_source):
+            report = cli.run_batch(units, self.tmpdir.name, workers=1, threads=1, params=params)
+        self.assertEqual(report['units_failed'], ['broken_1'])
+        self.assertEqual(report['units_processed'], 0)
+        with JobManifest(os.path.join(self.tmpdir.name, 'manifest.jsonl')) as manifest:
+            self.assertEqual(manifest.units['broken_1']['status'], FAILED)
+
+
+if __name__ == '__main__':
+    unittest.main()
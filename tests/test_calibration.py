@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+from abscr.segmentation.calibration import DiameterCalibration, calibrate_diameter, foreground_tiles, otsu_threshold
+
+
+class _SizeModel:
+    def __init__(self):
+        self.calls = 0
+
+    def eval(self, tile, channels=None, invert=False, batch_size=8):
+        self.calls += 1
+        # the "estimate" is the mean intensity of the tile, so every tile gives a known value
+        return np.array(tile.mean()), np.array(tile.mean())
+
+
+class _Model:
+    def __init__(self):
+        self.sz = _SizeModel()
+        self.pretrained_size = 'size.npy'
+        self.diam_mean = 30.0
+
+
+class _Segmentor:
+    def __init__(self):
+        self.model = _Model()
+
+    def get_model(self, model_type='cyto', cpu_config=None):
+        return self.model
+
+
+class TestDiameterCalibration(unittest.TestCase):
+    def setUp(self):
+        # bright background with dark cells in the left half only
+        self.image = np.full((1024, 2048), 200, dtype=np.uint8)
+        self.image[:, :1024][np.add.outer(np.arange(1024) % 32, np.arange(1024) % 32) < 20] = 20
+
+    def test_otsu_threshold(self):
+        values = np.r_[np.full(100, 10.0), np.full(300, 200.0)]
+        self.assertTrue(10 < otsu_threshold(values) < 200)
+
+    def test_foreground_tiles(self):
+        boxes, fractions = foreground_tiles(self.image, tile_size=256, n_tiles=4)
+        self.assertEqual(len(boxes), 4)
+        self.assertTrue(all(box[3] <= 1024 for box in boxes))
+        self.assertEqual(fractions, sorted(fractions, reverse=True))
+        # the sample is reproducible
+        self.assertEqual(boxes, foreground_tiles(self.image, tile_size=256, n_tiles=4)[0])
+
+    def test_statistics(self):
+        calibration = DiameterCalibration([20, 22, 24], [(0, 0, 1, 1)] * 3, 'cyto', mpp_diameter=44)
+        self.assertEqual(calibration.diameter, 22)
+        self.assertTrue(0 < calibration.confidence < 1)
+        self.assertAlmostEqual(calibration.mpp_ratio, 0.5)
+        self.assertFalse(calibration.agrees_with_mpp())
+
+        fallback = DiameterCalibration([], [], 'cyto', mpp_diameter=44)
+        self.assertEqual((fallback.diameter, fallback.confidence), (44, 0))
+
+    def test_calibrate_diameter(self):
+        segmentor = _Segmentor()
+        calibration = calibrate_diameter(segmentor, self.image, n_tiles=5, tile_size=256, mpp_diameter=60)
+        self.assertEqual(segmentor.model.sz.calls, 5)
+        self.assertEqual(len(calibration.samples), 5)
+        self.assertAlmostEqual(calibration.diameter, np.median(calibration.samples))
+        self.assertEqual(calibration.to_dict()['mpp_diameter'], 60)
+
+        blank = calibrate_diameter(segmentor, np.full((512, 512), 200, dtype=np.uint8), tile_size=256)
+        self.assertEqual((blank.diameter, blank.confidence), (30, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
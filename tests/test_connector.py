@@ -0,0 +1,245 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+import numpy as np
+
+from abscr.omero_connection.tiled_upload import TileSource, labels_dtype
+
+try:
+    import omero
+    from abscr.omero_connection.connector import OmeroClient
+except ImportError:
+    OmeroClient = None
+
+
+class _RawPixelsStore:
+    '''Records the tiles written to the raw pixels store; fails after fail_after tiles if given.'''
+
+    def __init__(self, tile_size, pyramid=False, fail_after=None):
+        self.tile_size = tile_size
+        self.pyramid = pyramid
+        self.fail_after = fail_after
+        self.tiles = []
+        self.saved = False
+        self.closed = False
+
+    def setPixelsId(self, pixels_id, bypass, ctx):
+        self.pixels_id = pixels_id
+
+    def getTileSize(self):
+        return list(self.tile_size)
+
+    def requiresPixelsPyramid(self):
+        return self.pyramid
+
+    def setTile(self, data, z, c, t, x, y, w, h, ctx):
+        if self.fail_after is not None and len(self.tiles) >= self.fail_after:
+            raise ConnectionError('connection lost')
+        self.tiles.append((c, x, y, w, h, data))
+
+    def save(self, ctx):
+        self.saved = True
+
+    def close(self):
+        self.closed = True
+
+
+class _UpdateService:
+    def __init__(self):
+        self.requests = []
+        self.next_id = 100
+
+    def _new_id(self):
+        self.next_id += 1
+        return omero.rtypes.rlong(self.next_id)
+
+    def saveAndReturnArray(self, objects, ctx):
+        self.requests.append(list(objects))
+        for obj in objects:
+            obj.setId(self._new_id())
+            if isinstance(obj, omero.model.ImageAnnotationLinkI) and obj.getChild().getId() is None:
+                obj.getChild().setId(self._new_id())
+        return objects
+
+
+class _Gateway:
+    '''Stands in for a BlitzGateway connection.'''
+
+    def __init__(self, images=(), links=()):
+        self.images = set(images)
+        self.links = list(links)
+        self.stores = []
+        self.update_service = _UpdateService()
+        self.deleted = []
+        self.SERVICE_OPTS = None
+        self.c = SimpleNamespace(sf=SimpleNamespace(createRawPixelsStore=lambda: self.stores.pop(0)))
+
+    def isConnected(self):
+        return True
+
+    def close(self):
+        pass
+
+    def getObject(self, object_name, object_id):
+        return SimpleNamespace(getPrimaryPixels=lambda: SimpleNamespace(getId=lambda: object_id + 1000))
+
+    def getObjects(self, object_name, object_ids):
+        return [SimpleNamespace(getId=lambda i=i: i) for i in object_ids if i in self.images]
+
+    def getUpdateService(self):
+        return self.update_service
+
+    def getAnnotationLinks(self, object_name, parent_ids=None, ns=None):
+        return [SimpleNamespace(getParent=lambda p=p: SimpleNamespace(getId=lambda: p),
+                                getChild=lambda a=a: SimpleNamespace(getId=lambda: a))
+                for p, a in self.links if p in parent_ids]
+
+    def deleteObjects(self, object_name, object_ids, wait=False):
+        self.deleted.append((object_name, sorted(object_ids)))
+
+
+@unittest.skipIf(OmeroClient is None, 'omero-py is not installed')
+class TestOmeroClient(unittest.TestCase):
+    def client(self, gateway):
+        client = OmeroClient.__new__(OmeroClient)
+        client.conn = gateway
+        self.created = []
+
+        def create_image(tiles, image_name, dataset_id, description=None):
+            self.created.append(image_name)
+            return len(self.created)
+
+        client._create_image = create_image
+        return client
+
+    @staticmethod
+    def assemble(store, shape, dtype):
+        # the big-endian planes written to the store, put back together
+        image = np.zeros(shape, dtype=dtype)
+        for c, x, y, w, h, data in store.tiles:
+            image[y:y + h, x:x + w, c] = np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder('>')).reshape(h, w)
+        return image
+
+    def test_post_image_tiled(self):
+        image = np.arange(300 * 500 * 3, dtype=np.uint16).reshape(300, 500, 3)
+        store = _RawPixelsStore((256, 128))
+        gateway = _Gateway()
+        gateway.stores.append(store)
+        image_id = self.client(gateway).post_image_tiled(image, 'image', 1)
+
+        self.assertEqual(image_id, 1)
+        # the tiles have the server's tile size
+        self.assertEqual({(x, y, w, h) for _, x, y, w, h, _ in store.tiles},
+                         {(x, y, min(256, 500 - x), min(128, 300 - y)) for y in (0, 128, 256) for x in (0, 256)})
+        np.testing.assert_array_equal(self.assemble(store, image.shape, image.dtype), image)
+        self.assertTrue(store.saved and store.closed)
+
+    def test_pyramid_tile_order(self):
+        def tiles():
+            for y in range(0, 128, 32):
+                for x in range(0, 128, 32):
+                    yield x, y, np.zeros((32, 32), dtype=np.uint8)
+
+        store = _RawPixelsStore((64, 64), pyramid=True)
+        gateway = _Gateway()
+        gateway.stores.append(store)
+        with self.assertRaises(ValueError):
+            self.client(gateway).post_image_tiled(tiles(), 'image', 1, size=(128, 128))
+        self.assertFalse(store.saved)
+        self.assertTrue(store.closed)
+
+    def test_resume(self):
+        image = np.random.default_rng(0).integers(0, 255, (200, 200), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest_path = os.path.join(tmpdir, 'upload.jsonl')
+            gateway = _Gateway()
+            client = self.client(gateway)
+            interrupted = _RawPixelsStore((64, 64), fail_after=5)
+            gateway.stores.append(interrupted)
+            with self.assertRaises(ConnectionError):
+                client.post_image_tiled(image, 'image', 1, manifest_path=manifest_path)
+
+            # the upload continues into the same image with the tiles not sent yet
+            store = _RawPixelsStore((64, 64))
+            gateway.stores.append(store)
+            self.assertEqual(client.post_image_tiled(image, 'image', 1, manifest_path=manifest_path), 1)
+            self.assertEqual(self.created, ['image'])
+            self.assertEqual(len(store.tiles), 16 - 5)
+            interrupted.tiles += store.tiles
+            np.testing.assert_array_equal(self.assemble(interrupted, (200, 200, 1), np.uint8)[..., 0], image)
+
+            # a pyramid-backed image can't be reopened, the upload starts over in a new image
+            gateway.stores += [_RawPixelsStore((64, 64), pyramid=True, fail_after=5),
+                               _RawPixelsStore((64, 64), pyramid=True), _RawPixelsStore((64, 64), pyramid=True)]
+            with self.assertRaises(ConnectionError):
+                client.post_image_tiled(image, 'pyramid', 1, manifest_path=manifest_path)
+            self.assertEqual(client.post_image_tiled(image, 'pyramid', 1, manifest_path=manifest_path), 3)
+            self.assertEqual(len(gateway.stores), 0)
+
+    def test_add_metadata_bulk(self):
+        gateway = _Gateway(images=[1, 2])
+        results = self.client(gateway).add_metadata_bulk(
+            'Image', {1: {'cells': 10}, 2: [('cells', 20)], 3: {'cells': 30}}, chunk_size=1)
+        self.assertEqual(len(gateway.update_service.requests), 2)
+        self.assertIsInstance(results[3], ValueError)
+        links = [request[0] for request in gateway.update_service.requests]
+        self.assertEqual(sorted(results[i] for i in (1, 2)),
+                         sorted(link.getChild().getId().getValue() for link in links))
+        values = {link.getParent().getId().getValue(): [(nv.name, nv.value) for nv in link.getChild().getMapValue()]
+                  for link in links}
+        self.assertEqual(values, {1: [('cells', '10')], 2: [('cells', '20')]})
+
+    def test_delete_metadata_bulk(self):
+        gateway = _Gateway(links=[(1, 10), (1, 11), (2, 11), (4, 12)])
+        results = self.client(gateway).delete_metadata_bulk('Image', [1, 2, 3])
+        self.assertEqual(results, {1: 2, 2: 1, 3: 0})
+        # one delete request for the annotations of all objects
+        self.assertEqual(gateway.deleted, [('Annotation', [10, 11])])
+
+    def test_post_segmentation(self):
+        labels = np.zeros((100, 150), dtype=np.int32)
+        labels[10:20, 10:20] = 1
+        labels[10:20, 20:30] = 2
+        labels[70:90, 70:90] = 3
+        image = SimpleNamespace(_obj=omero.model.ImageI(7, False), getId=lambda: 7, getName=lambda: 'swab')
+        gateway = _Gateway()
+        result = self.client(gateway).post_segmentation(image, labels, tile_size=64, polygon_labels=[1, 3],
+                                                        chunk_size=2)
+        requests = gateway.update_service.requests
+        self.assertEqual([len(request) for request in requests], [2, 1])
+        mask_roi = requests[0][0]
+        self.assertEqual(result['mask_roi_id'], mask_roi.getId().getValue())
+        # one mask shape per tile with cells
+        self.assertEqual(len(mask_roi.copyShapes()), 2)
+        self.assertEqual(sorted(result['polygon_roi_ids']), [1, 3])
+        self.assertIsNone(result['label_image_id'])
+
+    def test_post_segmentation_label_image(self):
+        class LazyLabels:
+            # a lazy array which must only be read tile by tile
+            shape, dtype = (100, 150), np.dtype(np.uint16)
+
+            def __getitem__(self, item):
+                return np.ones((100, 150), dtype=np.uint16)[item]
+
+            def __array__(self, dtype=None):
+                raise AssertionError('the whole label image was read')
+
+        image = SimpleNamespace(_obj=omero.model.ImageI(7, False), getId=lambda: 7, getName=lambda: 'swab',
+                                getParent=lambda: None)
+        client = self.client(_Gateway())
+        with self.assertRaises(ValueError):
+            client.post_segmentation(image, LazyLabels(), mode='label_image')
+
+        posted = []
+        client.post_label_image = lambda labels, name, dataset_id, **kwargs: posted.append(dataset_id) or 8
+        result = client.post_segmentation(image, LazyLabels(), mode='label_image', dataset_id=3)
+        self.assertEqual((result['label_image_id'], posted), (8, [3]))
+        self.assertEqual(np.dtype(TileSource(LazyLabels(), dtype=labels_dtype(LazyLabels())).dtype), np.uint16)
+        # without polygons, the masks are read tile by tile as well
+        self.assertIsNotNone(client.post_segmentation(image, LazyLabels(), tile_size=64)['mask_roi_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 import sys
@@ -8,6 +10,10 @@ from abscr.analysis import counter
 class TestCellCounter(unittest.TestCase):
     def setUp(self):
         self.counter = counter.CellCounter()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
 
     def test_count_cells_from_masks_with_numpy_array(self):
         # Test with a numpy array of masks
@@ -18,7 +24,7 @@ class TestCellCounter(unittest.TestCase):
 
     def test_count_cells_from_masks_with_txt_file(self):
         # Test with a text file containing masks
-        masks_file = 'test_masks.txt'
+        masks_file = os.path.join(self.tmpdir.name, 'test_masks.txt')
         with open(masks_file, 'w') as f:
             f.write('0 0 1 1\n0 1 1 0\n1 1 0 0\n')
         expected_count = 3
@@ -27,7 +33,7 @@ class TestCellCounter(unittest.TestCase):
     
     def test_count_cells_from_masks_with_npy_file(self):
         # Test with a numpy .npy file containing masks
-        masks_file = 'test_masks.npy'
+        masks_file = os.path.join(self.tmpdir.name, 'test_masks.npy')
         masks_array = np.array([[1, 1, 0, 0], [1, 1, 0, 0], [0, 0, 0, 0], [0, 0, 0, 2]])
         np.save(masks_file, {'masks': masks_array})
         expected_count = 2
@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+import torch
+from cellpose import models
+from abscr.segmentation.cpu_inference import CPUInferenceConfig, check_accuracy, prepare_model
+
+
+class TestCPUInference(unittest.TestCase):
+    def setUp(self):
+        self.image = np.random.default_rng(0).random((1, 2, 64, 64), dtype=np.float32)
+
+    def network_input(self, net):
+        # the layout the first convolution of the network receives
+        inputs = []
+        conv = next(m for m in net.modules() if isinstance(m, torch.nn.Conv2d))
+        handle = conv.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+        with torch.inference_mode():
+            output = net(torch.from_numpy(self.image))[0]
+        handle.remove()
+        return inputs[0], output
+
+    def test_channels_last(self):
+        reference = models.Cellpose(model_type='cyto', gpu=False).cp.net
+        reference.eval()
+        reference.mkldnn = False
+        _, expected = self.network_input(reference)
+
+        model = prepare_model(models.Cellpose(model_type='cyto', gpu=False), CPUInferenceConfig())
+        self.assertFalse(model.cp.mkldnn or model.cp.net.mkldnn)
+        data, output = self.network_input(model.cp.net)
+        self.assertFalse(data.is_mkldnn)
+        self.assertTrue(data.is_contiguous(memory_format=torch.channels_last))
+        np.testing.assert_allclose(output.numpy(), expected.numpy(), rtol=1e-4, atol=1e-4)
+
+    def test_quantize(self):
+        model = prepare_model(models.Cellpose(model_type='cyto', gpu=False), CPUInferenceConfig(quantize=True))
+        self.assertFalse(any(type(m) is torch.nn.Linear for m in model.cp.net.modules()))
+        data, _ = self.network_input(model.cp.net)
+        self.assertTrue(data.is_contiguous(memory_format=torch.channels_last))
+
+    def test_check_accuracy_without_cells(self):
+        image = np.full((96, 96), 128, dtype=np.uint8)
+        report = check_accuracy(image, CPUInferenceConfig(num_threads=1), thresholds=(0.5,))
+        self.assertEqual(report['float_cells'], 0)
+        self.assertEqual(report['average_precision'], {0.5: None})
+        self.assertTrue(report['identical_masks'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from scipy.stats import gaussian_kde
+from abscr.analysis.density import DensityEstimator
+
+
+class TestDensityEstimator(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = np.concatenate([rng.normal(100, 20, 2000), rng.normal(300, 40, 1000)])
+        self.y = rng.normal(200, 50, 3000) + 0.3 * self.x
+        self.estimator = DensityEstimator(self.x, self.y, grid_size=100)
+
+    def assert_matches_gaussian_kde(self, indices):
+        X, Y, Z = self.estimator.density(indices)
+        kernel = gaussian_kde(np.vstack([self.x[indices], self.y[indices]]))
+        expected = kernel(np.vstack([X.ravel(), Y.ravel()])).reshape(X.shape)
+        self.assertLess(np.abs(Z - expected).max(), 0.01 * expected.max())
+
+    def test_matches_gaussian_kde(self):
+        self.assert_matches_gaussian_kde(np.arange(3000))
+
+    def test_subsets_match_gaussian_kde(self):
+        # a small selection is binned directly, a large one as the complement of the rest
+        self.assert_matches_gaussian_kde(np.arange(0, 3000, 3))
+        self.assert_matches_gaussian_kde(np.arange(100, 3000))
+
+    def test_degenerate_subsets(self):
+        _, _, Z = self.estimator.density([5])
+        self.assertFalse(Z.any())
+        _, _, Z = self.estimator.density([5, 5, 5])
+        self.assertFalse(Z.any())
+        # collinear points have a singular covariance
+        estimator = DensityEstimator(np.arange(10.0), np.zeros(10), grid_size=20, extent=(0, 9, -1, 1))
+        _, _, Z = estimator.density()
+        self.assertTrue(np.all(np.isfinite(Z)))
+        self.assertGreater(Z.max(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
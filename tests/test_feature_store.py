@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from abscr.analysis.feature_store import FeatureStore, query_cohort
+
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        n = 500
+        self.features = pd.DataFrame({
+            'x': rng.uniform(0, 1000, n),
+            'y': rng.uniform(0, 600, n),
+            'area': rng.uniform(50, 500, n),
+            'roundness': rng.uniform(0.3, 1, n),
+        })
+        self.classes = rng.choice(['epithelial', 'immune', None], n)
+        self.store = FeatureStore.write(os.path.join(self.tmp.name, 'slide_a'), self.features, tile_size=256,
+                                        classes=self.classes, slide='slide_a')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def expected(self, mask):
+        expected = self.features[mask].copy()
+        expected['label'] = np.flatnonzero(mask) + 1
+        return expected.sort_values('label').reset_index(drop=True)
+
+    def test_region_and_predicate_query(self):
+        bbox = (100, 50, 400, 300)
+        cells = self.store.query(bbox=bbox, where=[('roundness', '>', 0.8)], columns=['label', 'x', 'y', 'area',
+                                                                                     'roundness'])
+        f = self.features
+        mask = (f.x >= 100) & (f.x <= 400) & (f.y >= 50) & (f.y <= 300) & (f.roundness > 0.8)
+        cells = cells.sort_values('label').reset_index(drop=True)
+        pd.testing.assert_frame_equal(cells, self.expected(mask)[cells.columns], check_dtype=False)
+        # only the tiles overlapping the region are read
+        self.assertLess(len(self.store.partitions(bbox)), len(self.store.meta['partitions']))
+
+    def test_class_query(self):
+        cells = self.store.query(where=[('cell_class', '==', 'immune')], columns=['label', 'cell_class'])
+        np.testing.assert_array_equal(np.sort(cells['label']), np.flatnonzero(self.classes == 'immune') + 1)
+        self.assertTrue((cells['cell_class'] == 'immune').all())
+        self.assertEqual(len(self.store.query(where=[('cell_class', '==', 'unknown')])), 0)
+
+    def test_cohort_query(self):
+        other = FeatureStore.write(os.path.join(self.tmp.name, 'slide_b'), self.features[:10], tile_size=256)
+        cells = query_cohort([self.store.path, other.path], where=[('area', '<', 200)], columns=['area'])
+        self.assertEqual(list(cells.columns), ['slide', 'area'])
+        self.assertEqual((cells['slide'] == 'slide_a').sum(), (self.features['area'] < 200).sum())
+        self.assertEqual((cells['slide'] == other.path).sum(), (self.features['area'][:10] < 200).sum())
+
+    def test_slide_without_cells(self):
+        empty = FeatureStore.write(os.path.join(self.tmp.name, 'slide_c'), self.features[:0], slide='slide_c')
+        self.assertEqual(empty.meta['partitions'], [])
+        self.assertEqual(len(empty.query(where=[('x', '>', 0)])), 0)
+        cells = query_cohort([self.store.path, empty.path], where=[('area', '<', 200)], columns=['area'])
+        self.assertEqual(len(cells), (self.features['area'] < 200).sum())
+        self.assertFalse((cells['slide'] == 'slide_c').any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from shapely import Polygon
+from abscr.analysis.analysis import calc_convexity, calc_roundness, calc_solidity
+from abscr.analysis.features import FeatureSidecar, compute_features
+
+
+class TestFeatureSidecar(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'image_cp_outlines.txt')
+        self.polygons = [np.array([[0, 0], [10, 0], [10, 10], [0, 10]]),
+                         np.array([[20, 20], [30, 22], [25, 28], [24, 23], [21, 26]])]
+        self.write_outlines(self.polygons)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_outlines(self, polygons):
+        with open(self.filename, 'w') as f:
+            f.write(''.join(','.join(map(str, p.ravel())) + '\n' for p in polygons))
+
+    def test_features_match_shape_metrics(self):
+        features = compute_features(self.polygons, chunk_size=1)
+        for i, polygon in enumerate(self.polygons):
+            poly = Polygon(polygon)
+            self.assertAlmostEqual(features['x'][i], poly.centroid.x)
+            self.assertAlmostEqual(features['convexity'][i], calc_convexity(poly))
+            self.assertAlmostEqual(features['solidity'][i], calc_solidity(poly))
+            self.assertAlmostEqual(features['roundness'][i], calc_roundness(poly))
+        self.assertAlmostEqual(features['diameter'][0], np.sqrt(200))
+
+    def test_sidecar_is_reused_until_the_file_changes(self):
+        sidecar = FeatureSidecar(self.filename, cache_dir=os.path.join(self.tmp.name, 'cache'))
+        self.assertFalse(sidecar.is_valid())
+        features, polygons = sidecar.get()
+        self.assertTrue(sidecar.is_valid())
+
+        loaded, loaded_polygons = sidecar.load()
+        for column in features:
+            np.testing.assert_array_equal(loaded[column], features[column])
+        for polygon, loaded_polygon in zip(self.polygons, loaded_polygons):
+            np.testing.assert_array_equal(loaded_polygon, polygon)
+
+        # a touched but unchanged file keeps its sidecar, a changed one doesn't
+        os.utime(self.filename, ns=(0, 0))
+        self.assertTrue(sidecar.is_valid())
+        self.write_outlines(self.polygons[:1])
+        self.assertFalse(sidecar.is_valid())
+        features, _ = sidecar.get()
+        self.assertEqual(len(features['x']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from abscr.omero_connection.label_shapes import label_polygons, tile_masks
+
+
+class TestLabelShapes(unittest.TestCase):
+    def setUp(self):
+        self.labels = np.zeros((100, 150), dtype=np.int32)
+        self.labels[10:30, 20:60] = 1
+        self.labels[10:30, 60:80] = 2
+        self.labels[70:90, 120:140] = 3
+
+    def test_tile_masks(self):
+        mask = np.zeros(self.labels.shape, dtype=bool)
+        shapes = list(tile_masks(self.labels, tile_size=64))
+        # the two empty tiles are skipped
+        self.assertEqual(len(shapes), 4)
+        for x, y, width, height, bits in shapes:
+            mask[y:y + height, x:x + width] |= np.unpackbits(np.frombuffer(bits, dtype=np.uint8),
+                                                             count=width * height).reshape(height, width).astype(bool)
+        expected = self.labels > 0
+        # where cells 1 and 2 touch, the pixels of cell 2 are left out
+        expected[10:30, 60] = False
+        np.testing.assert_array_equal(mask, expected)
+
+    def test_label_polygons(self):
+        polygons = label_polygons(self.labels, [2, 3, 9])
+        self.assertEqual(sorted(polygons), [2, 3])
+        np.testing.assert_array_equal(polygons[3].min(axis=0), [120, 70])
+        np.testing.assert_array_equal(polygons[3].max(axis=0), [139, 89])
+
+
+if __name__ == '__main__':
+    unittest.main()
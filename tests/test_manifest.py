@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from abscr.batch.manifest import JobManifest, DONE, FAILED, PENDING
+
+
+class TestJobManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'manifest.jsonl')
+        self.output = os.path.join(self.tmpdir.name, 'tile_1_cp_outlines.txt')
+        with open(self.output, 'w') as f:
+            f.write('1,2,3,4\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resume_skips_finished_units(self):
+        with JobManifest(self.path) as manifest:
+            manifest.add_unit('tile_1', {'diameter': 30})
+            manifest.add_unit('tile_2', {'diameter': 30})
+            manifest.mark_done('tile_1', [self.output])
+            manifest.mark_failed('tile_2', 'killed')
+
+        with JobManifest(self.path) as manifest:
+            self.assertTrue(manifest.is_done('tile_1', {'diameter': 30}))
+            self.assertFalse(manifest.is_done('tile_2', {'diameter': 30}))
+            self.assertEqual(manifest.summary()[DONE], 1)
+            self.assertEqual(manifest.summary()[FAILED], 1)
+
+    def test_changed_params_reset_unit(self):
+        with JobManifest(self.path) as manifest:
+            manifest.add_unit('tile_1', {'diameter': 30})
+            manifest.mark_done('tile_1', [self.output])
+            manifest.add_unit('tile_1', {'diameter': 60})
+            self.assertEqual(manifest.units['tile_1']['status'], PENDING)
+
+    def test_runtime_params_are_not_recorded(self):
+        with JobManifest(self.path) as manifest:
+            manifest.add_unit('tile_1', {'diameter': 30, 'engine': object(), 'trace': True})
+            manifest.mark_done('tile_1', [self.output])
+
+        # a new worker pool in the next run doesn't reset the unit
+        with JobManifest(self.path) as manifest:
+            params = {'diameter': 30, 'engine': object(), 'trace': False}
+            manifest.add_unit('tile_1', params)
+            self.assertTrue(manifest.is_done('tile_1', params))
+            self.assertEqual(manifest.units['tile_1']['params'], {'diameter': 30})
+
+    def test_missing_output_is_not_done(self):
+        with JobManifest(self.path) as manifest:
+            manifest.add_unit('tile_1')
+            manifest.mark_done('tile_1', [self.output])
+        os.remove(self.output)
+
+        with JobManifest(self.path) as manifest:
+            self.assertFalse(manifest.is_done('tile_1'))
+            self.assertEqual(manifest.pending_units(), ['tile_1'])
+
+    def test_truncated_record_is_ignored(self):
+        with JobManifest(self.path) as manifest:
+            manifest.add_unit('tile_1')
+            manifest.mark_done('tile_1', [self.output])
+        with open(self.path, 'a') as f:
+            f.write('{"unit_id": "tile_2", "sta')
+
+        with JobManifest(self.path) as manifest:
+            self.assertEqual(list(manifest.units), ['tile_1'])
+            self.assertTrue(manifest.is_done('tile_1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
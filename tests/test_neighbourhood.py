@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from scipy.spatial.distance import cdist
+from abscr.analysis.neighbourhood import NeighbourhoodAnalysis, mask_centroids
+
+
+class TestNeighbourhoodAnalysis(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.points = rng.uniform(0, 500, (1000, 2))
+        self.other = rng.uniform(0, 500, (200, 2))
+        # small chunks, so that results are assembled from several queries
+        self.analysis = NeighbourhoodAnalysis(self.points[:, 0], self.points[:, 1], chunk_size=128)
+
+    def test_matches_brute_force(self):
+        distances = cdist(self.points, self.points)
+        np.fill_diagonal(distances, np.inf)
+        np.testing.assert_allclose(self.analysis.nearest_neighbour_distance(), distances.min(axis=1))
+        np.testing.assert_array_equal(self.analysis.neighbour_count(20), (distances <= 20).sum(axis=1))
+
+        other_distances = cdist(self.points, self.other)
+        distance, count = self.analysis.colocation(self.other[:, 0], self.other[:, 1], 20)
+        np.testing.assert_allclose(distance, other_distances.min(axis=1))
+        np.testing.assert_array_equal(count, (other_distances <= 20).sum(axis=1))
+
+    def test_table(self):
+        table = self.analysis.table(20, other=(self.other[:, 0], self.other[:, 1]))
+        self.assertEqual(len(table), 1000)
+        self.assertEqual(list(table.columns), ['nn_distance', 'neighbours', 'local_density', 'immune_distance',
+                                               'immune_count'])
+        np.testing.assert_allclose(table['local_density'], table['neighbours'] / (np.pi * 400))
+
+    def test_mask_centroids(self):
+        masks = np.zeros((10, 10), dtype=int)
+        masks[0:2, 0:4] = 3
+        masks[6:9, 5:8] = 7
+        labels, x, y = mask_centroids(masks)
+        np.testing.assert_array_equal(labels, [3, 7])
+        np.testing.assert_allclose(x, [1.5, 6])
+        np.testing.assert_allclose(y, [0.5, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from abscr.batch.cli import segment_unit
+from abscr.omero_connection.omero_slide import OmeroSlide
+from abscr.preprocessing.preprocessor import Preprocessor, is_slide
+
+
+class _RawPixelsStore:
+    '''Serves the planes of a two-level pyramid as the OMERO raw pixels store does.'''
+
+    def __init__(self, levels, tile_size):
+        # levels from the full resolution down, each an RGB uint8 array
+        self.levels = levels
+        self.tile_size = tile_size
+        self.level = None
+        self.tiles_read = 0
+        self.closed = False
+
+    def setPixelsId(self, pixels_id, bypass, ctx):
+        pass
+
+    def getResolutionLevels(self):
+        return len(self.levels)
+
+    def getResolutionDescriptions(self):
+        return [SimpleNamespace(sizeX=level.shape[1], sizeY=level.shape[0]) for level in self.levels]
+
+    def setResolutionLevel(self, level):
+        # the server numbers the levels from the smallest one
+        self.level = len(self.levels) - 1 - level
+
+    def getTileSize(self):
+        return [self.tile_size, self.tile_size]
+
+    def getTile(self, z, c, t, x, y, w, h):
+        self.tiles_read += 1
+        return self.levels[self.level][y:y + h, x:x + w, c].astype('>u1').tobytes()
+
+    def close(self):
+        self.closed = True
+
+
+class TestOmeroSlide(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.full = rng.integers(0, 255, (300, 400, 3), dtype=np.uint8)
+        self.half = self.full[::2, ::2].copy()
+        self.store = _RawPixelsStore([self.full, self.half], tile_size=64)
+        self.slide = self.open_slide(mpp=0.25)
+
+    def open_slide(self, mpp):
+        conn = SimpleNamespace(c=SimpleNamespace(sf=SimpleNamespace(createRawPixelsStore=lambda: self.store)),
+                               SERVICE_OPTS=None)
+        image = SimpleNamespace(getPixelsType=lambda: 'uint8', getSizeC=lambda: 3, getSizeX=lambda: 400,
+                                getSizeY=lambda: 300, getPixelSizeX=lambda: mpp, getPixelSizeY=lambda: mpp,
+                                getPrimaryPixels=lambda: SimpleNamespace(getId=lambda: 1))
+        return OmeroSlide(SimpleNamespace(conn=conn), image, cache_size=64)
+
+    def test_levels(self):
+        self.assertTrue(is_slide(self.slide))
+        self.assertEqual(self.slide.level_dimensions, [(400, 300), (200, 150)])
+        self.assertEqual(self.slide.level_downsamples, [1.0, 2.0])
+        self.assertEqual(self.slide.get_best_level_for_downsample(8), 1)
+        self.assertEqual(self.slide.get_best_level_for_downsample(1.5), 0)
+        self.assertEqual(self.slide.properties['tiffslide.level[1].height'], 150)
+
+    def test_read_region(self):
+        region = self.slide.read_region((50, 70), 0, (130, 100), as_array=True)
+        np.testing.assert_array_equal(region, self.full[70:170, 50:180])
+        # location in level 0 coordinates, size in level coordinates, zeros outside of the image
+        region = np.asarray(self.slide.read_region((300, 200), 1, (80, 80)))
+        np.testing.assert_array_equal(region[:50, :50], self.half[100:150, 150:200])
+        self.assertFalse(region[50:].any())
+
+        # the tiles of the first region are cached
+        tiles_read = self.store.tiles_read
+        self.slide.read_region((64, 64), 0, (64, 64))
+        self.assertEqual(self.store.tiles_read, tiles_read)
+
+    def test_preprocessor_tiles(self):
+        for core_box, read_box, tile in Preprocessor().iter_tiles(self.slide, 128, level=1):
+            left, upper, right, lower = read_box
+            np.testing.assert_array_equal(tile, self.half[upper:lower, left:right])
+
+    def test_scale_without_mpp(self):
+        slide = self.open_slide(mpp=None)
+        image, diameter = Preprocessor().scale_image(slide, 2)
+        self.assertEqual(image.size, (200, 150))
+        # the default diameter is taken in pixels
+        self.assertEqual(diameter, 30)
+
+    def test_batch_unit(self):
+        received = {}
+
+        def predict_all(image_array, **params):
+            received.update(params, image_array=image_array)
+            return SimpleNamespace(epithelial_masks=np.zeros((2, 2), dtype=np.int32), immune_masks=None,
+                                   calibrations={})
+
+        segmentor = SimpleNamespace(predict_all=predict_all)
+        counter = SimpleNamespace(count_cells_from_masks=lambda masks: int(masks.max()))
+        with tempfile.TemporaryDirectory() as savedir:
+            # params of a caller that doesn't know the tracing and CPU inference options
+            params = {'diameter_epithelial': None, 'save_png': False, 'savedir': savedir, 'scale_factor': 8}
+            segment_unit(segmentor, Preprocessor(), counter, 'unit', 'image', self.slide, params)
+        # OMERO images are segmented at full resolution with the image default diameter
+        np.testing.assert_array_equal(received['image_array'], self.full)
+        self.assertEqual(received['diameter_epithelial'], 30)
+        self.assertTrue(self.store.closed)
+
+    def test_batch_unit_releases_store_on_failure(self):
+        preprocessor = SimpleNamespace(scale_image=lambda slide, factor: 1 / 0)
+        params = {'diameter_epithelial': None, 'save_png': False, 'savedir': os.getcwd(), 'scale_factor': 8,
+                  'trace': False, 'cpu_inference': False, 'quantize': False, 'calibrate': False}
+        with self.assertRaises(ZeroDivisionError):
+            segment_unit(None, preprocessor, None, 'unit', 'slide', self.slide, params)
+        self.assertTrue(self.store.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
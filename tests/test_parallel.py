@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+from abscr.batch.cli import model_types, pass_model_types
+from abscr.segmentation.parallel import ParallelTileSegmentor
+from abscr.segmentation.segmentor import Segmentor
+
+
+class TestParallelTileSegmentor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # an epithelial and an immune pass with the same model, as with --model-type-immune cyto
+        params = {'model_type_epithelial': 'cyto', 'model_type_immune': 'cyto'}
+        cls.engine = ParallelTileSegmentor(workers=1, max_tile_shape=(128, 128, 3), model_type=model_types(params),
+                                           max_passes=len(pass_model_types(params)))
+        cls.passes = [('predict_epithelial', dict(model_type='cyto', diameter=30, flow_threshold=0.4,
+                                                  cellprob_threshold=0.0, channels=[0, 0], invert=True,
+                                                  batch_size=8)),
+                      ('predict_immune', dict(model_type='cyto', diameter=15, flow_threshold=0.4,
+                                              cellprob_threshold=0.0, channels=[0, 0], invert=True, batch_size=8))]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+
+    def test_model_types(self):
+        self.assertEqual(self.engine.model_types, ['cyto'])
+        self.assertEqual(self.engine.max_passes, 2)
+
+    def test_passes_through_shared_memory(self):
+        rng = np.random.default_rng(0)
+        tiles = {i: rng.integers(0, 255, (96 + 8 * i, 128, 3), dtype=np.uint8) for i in range(5)}
+        results = {key: masks for key, masks, _ in self.engine.imap_passes(tiles.items(), self.passes)}
+        self.assertEqual(sorted(results), sorted(tiles))
+
+        # the masks read back from the shared output slots are those of the models run in this process
+        segmentor = Segmentor()
+        for key, tile in tiles.items():
+            expected = segmentor.predict_passes(tile, self.passes)
+            self.assertEqual(len(results[key]), 2)
+            for masks, segmentation in zip(results[key], expected):
+                self.assertEqual(masks.shape, tile.shape[:2])
+                np.testing.assert_array_equal(masks, segmentation.masks)
+
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            list(self.engine.imap_passes([(0, np.zeros((256, 128, 3), dtype=np.uint8))], self.passes[:1]))
+        with self.assertRaises(ValueError):
+            list(self.engine.imap_passes([(0, np.zeros((64, 64, 3), dtype=np.uint8))], self.passes * 2))
+        # the slot of the rejected tile is free again
+        self.assertEqual(len(list(self.engine.imap_passes([(0, np.zeros((64, 64, 3), dtype=np.uint8))],
+                                                          self.passes))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from abscr.util.profiling import Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def test_disabled_tracer_records_nothing(self):
+        tracer = Tracer()
+        with tracer.span('cellpose.eval'):
+            pass
+        tracer.count('segmentation.pixels', 100)
+        summary = tracer.summary()
+        self.assertEqual(summary['stages'], {})
+        self.assertEqual(summary['counters'], {})
+
+    def test_spans_and_counters_are_aggregated(self):
+        tracer = Tracer(enabled=True)
+        for _ in range(3):
+            with tracer.span('outlines_list'):
+                pass
+        tracer.count('segmentation.cells', 5)
+        tracer.count('segmentation.cells', 7)
+        summary = tracer.summary()
+        self.assertEqual(summary['stages']['outlines_list']['calls'], 3)
+        self.assertEqual(summary['counters']['segmentation.cells'], 12)
+
+    def test_suppressed_counters_are_ignored(self):
+        tracer = Tracer(enabled=True)
+        with tracer.suppress('segmentation.cells'):
+            tracer.count('segmentation.cells', 5)
+            tracer.count('segmentation.pixels', 100)
+        tracer.count('segmentation.cells', 2)
+        self.assertEqual(tracer.summary()['counters'], {'segmentation.cells': 2, 'segmentation.pixels': 100})
+
+    def test_nested_spans_report_self_time(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span('predict_epithelial'):
+            time.sleep(0.02)
+            with tracer.span('cellpose.eval'):
+                time.sleep(0.05)
+        stages = tracer.summary()['stages']
+        parent, child = stages['predict_epithelial'], stages['cellpose.eval']
+        self.assertGreaterEqual(parent['total'], child['total'])
+        self.assertAlmostEqual(child['self'], child['total'])
+        self.assertAlmostEqual(parent['self'], parent['total'] - child['total'])
+
+    def test_export_json_writes_trace_events(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span('scale_image', factor=4):
+            pass
+        with tempfile.TemporaryDirectory() as tmpdir:
+            savename = tracer.export_json(os.path.join(tmpdir, 'trace.json'))
+            with open(savename) as f:
+                report = json.load(f)
+        self.assertEqual(report['traceEvents'][0]['name'], 'scale_image')
+        self.assertEqual(report['traceEvents'][0]['args'], {'factor': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+import numpy as np
+from PIL import Image
+from abscr.util.tile_pyramid import TilePyramid, serve
+
+
+class TestTilePyramid(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image_path = os.path.join(self.tmp.name, 'image.png')
+        self.cache_dir = os.path.join(self.tmp.name, 'tiles')
+        self.image = (np.arange(300 * 200) % 251).astype(np.uint8).reshape(200, 300)
+        Image.fromarray(self.image).save(self.image_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tiles_are_flipped_in_tms_layout(self):
+        pyramid = TilePyramid(self.image_path, self.cache_dir, tile_size=128).build()
+        self.assertEqual(pyramid.max_zoom, 2)
+        self.assertEqual(pyramid.tile_count(2), (3, 2))
+        self.assertEqual(pyramid.tile_count(0), (1, 1))
+
+        # tile y = 1 of the full resolution level holds rows 128..199, drawn upside down at the bottom
+        tile = np.asarray(Image.open(os.path.join(pyramid.path, '2', '1', '1.png')))
+        self.assertEqual(tile.shape, (128, 128, 2))
+        np.testing.assert_array_equal(tile[-72:, :, 0], self.image[128:200, 128:256][::-1])
+        self.assertTrue((tile[:-72, :, 1] == 0).all())
+
+    def test_cache_is_reused_until_the_image_changes(self):
+        pyramid = TilePyramid(self.image_path, self.cache_dir, tile_size=128).build()
+        marker = os.path.join(pyramid.path, 'marker')
+        open(marker, 'w').close()
+        same = TilePyramid(self.image_path, self.cache_dir, tile_size=128).build()
+        self.assertEqual(same.path, pyramid.path)
+        self.assertTrue(os.path.exists(marker))
+
+        stat = os.stat(self.image_path)
+        os.utime(self.image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        changed = TilePyramid(self.image_path, self.cache_dir, tile_size=128)
+        self.assertNotEqual(changed.key, pyramid.key)
+        self.assertFalse(changed.is_built)
+
+    def test_serve(self):
+        pyramid = TilePyramid(self.image_path, self.cache_dir, tile_size=128).build()
+        base_url = serve(self.cache_dir)
+        self.assertEqual(serve(self.cache_dir), base_url)
+        url = pyramid.url_template(base_url).format(Z=0, X=0, Y=0)
+        with urllib.request.urlopen(url, timeout=10) as response:
+            self.assertEqual(response.headers['Content-Type'], 'image/png')
+            self.assertGreater(len(response.read()), 0)
+        # the cache directory is not listed
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'{base_url}/{pyramid.key}/0/', timeout=10)
+        self.assertEqual(error.exception.code, 404)
+        self.assertEqual(serve(self.cache_dir, public_url='http://tiles.example.org/'), 'http://tiles.example.org')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+from abscr.omero_connection.tiled_upload import TileSource, label_dtype, labels_dtype, tile_bytes
+
+
+class TestTileSource(unittest.TestCase):
+    def test_array_tiles_cover_the_image(self):
+        image = np.arange(300 * 500 * 3, dtype=np.uint16).reshape(300, 500, 3)
+        tiles = TileSource(image, tile_size=128)
+        self.assertEqual((tiles.size_x, tiles.size_y, tiles.size_c, tiles.pixel_type), (500, 300, 3, 'uint16'))
+
+        result = np.zeros_like(image)
+        for x, y, tile in tiles:
+            self.assertLessEqual(max(tile.shape[:2]), 128)
+            result[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        np.testing.assert_array_equal(result, image)
+
+        # server tile sizes need not be square
+        tiles.tile_size = (500, 16)
+        self.assertEqual(tiles.boxes()[:2], [(0, 0, 500, 16), (0, 16, 500, 16)])
+        self.assertEqual(tiles.boxes()[-1], (0, 288, 500, 12))
+
+    def test_tile_iterable(self):
+        def generate():
+            for y in range(0, 64, 32):
+                for x in range(0, 96, 32):
+                    yield x, y, np.full((32, 32), x + y, dtype=np.int32)
+
+        tiles = TileSource(generate(), size=(96, 64), dtype=np.uint8)
+        self.assertEqual((tiles.size_c, tiles.pixel_type), (1, 'uint8'))
+        received = list(tiles)
+        # the tile read to find the pixel type is not lost
+        self.assertEqual([(x, y) for x, y, _ in received][:2], [(0, 0), (32, 0)])
+        self.assertEqual(len(received), 6)
+        self.assertEqual(received[-1][2].shape, (32, 32, 1))
+        self.assertEqual(received[-1][2].dtype, np.uint8)
+
+        with self.assertRaises(ValueError):
+            TileSource(generate())
+
+    def test_tile_bytes_and_label_dtype(self):
+        plane = np.array([[1, 256]], dtype=np.uint16)
+        self.assertEqual(tile_bytes(plane), b'\x00\x01\x01\x00')
+        self.assertEqual(label_dtype(255), np.uint8)
+        self.assertEqual(label_dtype(70000), np.uint32)
+        self.assertEqual(labels_dtype(np.array([[0, 300]], dtype=np.int64)), np.uint16)
+        self.assertEqual(labels_dtype(np.array([[0, 300]], dtype=np.int64), max_label=3), np.uint8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import numpy as np
+from scipy import ndimage
+from abscr.preprocessing.preprocessor import Preprocessor
+from abscr.segmentation.parallel import ParallelTileSegmentor
+from abscr.segmentation.segmentor import Segmentor, SegmentationData
+from abscr.util import profiling
+from abscr.util.profiling import get_tracer
+
+
+def disc_mask(shape, centres, radius):
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    masks = np.zeros(shape, dtype=np.int32)
+    for label, (cy, cx) in enumerate(centres, start=1):
+        masks[(yy - cy) ** 2 + (xx - cx) ** 2 <= radius ** 2] = label
+    return masks
+
+
+class _ThresholdSegmentor(Segmentor):
+    '''Segments the connected dark blobs of a tile instead of running Cellpose.'''
+
+    def _eval(self, image_array, model_type, diameter, *args, **kwargs):
+        # the prepared (normalised, inverted) image is bright where the tile is dark
+        masks, _ = ndimage.label(image_array[..., 0] > 0.5)
+        get_tracer().count('segmentation.cells', int(masks.max()))
+        return SegmentationData(masks.astype(np.int32), diams=diameter)
+
+
+class TestTiling(unittest.TestCase):
+    def test_tile_grid_covers_image(self):
+        grid = Preprocessor.tile_grid(250, 130, 100, overlap=20)
+        covered = np.zeros((130, 250), dtype=int)
+        for core_box, read_box in grid:
+            left, upper, right, lower = core_box
+            covered[upper:lower, left:right] += 1
+            self.assertLessEqual(read_box[0], left)
+            self.assertGreaterEqual(read_box[2], right)
+            self.assertGreaterEqual(read_box[0], 0)
+            self.assertLessEqual(read_box[3], 130)
+        self.assertTrue((covered == 1).all())
+
+    def test_stitching_keeps_every_cell_once(self):
+        centres = [(y, x) for y in range(15, 200, 30) for x in range(15, 300, 30)]
+        truth = disc_mask((200, 300), centres, 10)
+        stitched = np.zeros_like(truth)
+        n_cells = 0
+        for core_box, read_box in Preprocessor.tile_grid(300, 200, 64, overlap=24):
+            left, upper, right, lower = read_box
+            tile_masks = truth[upper:lower, left:right]
+            # tile-local labels, as a segmentation of the tile would return them
+            _, tile_masks = np.unique(tile_masks, return_inverse=True)
+            tile_masks = tile_masks.reshape(lower - upper, right - left)
+            n_cells += Segmentor._paste_tile_masks(stitched, tile_masks, core_box, read_box, n_cells)
+
+        self.assertEqual(n_cells, len(centres))
+        self.assertTrue(((stitched > 0) == (truth > 0)).all())
+        # one stitched label per true cell
+        pairs = np.unique(np.stack([truth[truth > 0], stitched[truth > 0]]), axis=1)
+        self.assertEqual(pairs.shape[1], len(centres))
+
+    def test_cascade_keeps_every_cell_once(self):
+        # two groups of cells far apart give two fine regions
+        centres = [(20, 20), (20, 50), (50, 35), (150, 250), (170, 270)]
+        fine = disc_mask((200, 300), centres, 8)
+        coarse = fine[::4, ::4]
+        regions, boxes = Segmentor.cascade_regions(coarse, (4, 4), margin=12, fine_size=(300, 200))
+        self.assertEqual(len(boxes), 2)
+        for box in boxes:
+            self.assertTrue(0 <= box[0] < box[2] <= 300 and 0 <= box[1] < box[3] <= 200)
+
+        kept = []
+        for region, box in enumerate(boxes, start=1):
+            # fine tiles read only inside the region box
+            for core_box, read_box in Preprocessor.tile_grid(box[2] - box[0], box[3] - box[1], 32, overlap=16):
+                core_box = tuple(np.add(core_box, box[:2] * 2))
+                read_box = tuple(np.add(read_box, box[:2] * 2))
+                tile_masks = fine[read_box[1]:read_box[3], read_box[0]:read_box[2]]
+                # the crop keeps the global labels, so the kept labels identify the cells
+                labels = Segmentor._cascade_cells(tile_masks, region, regions, (4, 4), core_box, read_box)
+                kept += labels
+        self.assertEqual(sorted(kept), list(range(1, len(centres) + 1)))
+
+    def test_cascade_end_to_end(self):
+        centres = [(30, 30), (30, 70), (200, 300), (220, 340), (120, 200)]
+        truth = disc_mask((256, 384), centres, 9)
+        image = np.where(truth[..., np.newaxis] > 0, 40, 220).astype(np.uint8).repeat(3, axis=2)
+        segmentation = _ThresholdSegmentor().predict_cascade(image, coarse_downsample=4, tile_size=96,
+                                                             tile_overlap=32, diameter=18, return_masks=True)
+        self.assertEqual(len(segmentation.outlines), len(centres))
+        # every outline lies on the border of its own cell
+        found = sorted(int(truth[outline[:, 1], outline[:, 0]].max()) for outline in segmentation.outlines)
+        self.assertEqual(found, list(range(1, len(centres) + 1)))
+        self.assertTrue(((segmentation.masks > 0) == (truth > 0)).all())
+
+    def test_cascade_counts_returned_cells(self):
+        centres = [(30, 30), (30, 70), (200, 300), (220, 340), (120, 200)]
+        image = np.where(disc_mask((256, 384), centres, 9)[..., np.newaxis] > 0, 40, 220).astype(np.uint8)
+        tracer = get_tracer()
+        enabled = tracer.enabled
+        profiling.enable()
+        try:
+            segmentation = _ThresholdSegmentor().predict_cascade(image.repeat(3, axis=2), coarse_downsample=4,
+                                                                 tile_size=96, tile_overlap=32, diameter=18)
+            counters = tracer.summary()['counters']
+        finally:
+            tracer.enabled = enabled
+        self.assertEqual(counters['segmentation.cells'], len(segmentation.outlines))
+
+    def test_cascade_with_engine(self):
+        # the workers run the real models, so compare with the same models run in this process
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)
+        kwargs = dict(coarse_downsample=4, tile_size=128, tile_overlap=32, return_masks=True)
+        expected = Segmentor().predict_cascade(image, **kwargs)
+        with ParallelTileSegmentor(workers=1, max_tile_shape=(256, 256, 3)) as engine:
+            segmentation = Segmentor().predict_cascade(image, engine=engine, **kwargs)
+        self.assertEqual(len(segmentation.outlines), len(expected.outlines))
+        np.testing.assert_array_equal(segmentation.masks, expected.masks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from abscr.util import utils
+
+
+class TestStreamingOutlineTransforms(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outlines_file = os.path.join(self.tmp.name, 'cells_cp_outlines.txt')
+        rng = np.random.default_rng(0)
+        with open(self.outlines_file, 'w') as f:
+            for _ in range(25):
+                n = rng.integers(4, 30)
+                f.write(','.join(map(str, rng.integers(0, 1000, 2 * n))) + '\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_outlines_equal(self, streamed, eager):
+        streamed = [o for chunk in streamed for o in chunk]
+        self.assertEqual(len(streamed), len(eager))
+        for a, b in zip(streamed, eager):
+            np.testing.assert_array_equal(a, b)
+
+    def test_transforms_match_eager_versions(self):
+        # 25 outlines in chunks of 7 end with a partial chunk
+        f = self.outlines_file
+        self.assert_outlines_equal(utils.iter_outlines_from_txt(f, 7), utils.read_outlines_from_txt(f))
+        self.assert_outlines_equal(utils.iter_scale_outlines(f, 2, chunk_size=7), utils.scale_outlines(f, 2))
+        self.assert_outlines_equal(utils.iter_smooth_outlines_moving_avg(f, num_avg=3, chunk_size=7),
+                                   utils.smooth_outlines_moving_avg(f, num_avg=3))
+        self.assert_outlines_equal(utils.iter_iterative_scaling_moving_avg(f, factor=4, chunk_size=7),
+                                   utils.iterative_scaling_moving_avg(f, factor=4))
+        self.assert_outlines_equal(utils.iter_make_polygons_from_outlines(f, chunk_size=7),
+                                   utils.make_polygons_from_outlines(f))
+        wkt = pd.concat(utils.iter_outlines_to_wkt_polygons(f, chunk_size=7), ignore_index=True)
+        pd.testing.assert_frame_equal(wkt, utils.outlines_to_wkt_polygons(f))
+
+    def test_pipeline_to_files(self):
+        f = self.outlines_file
+        scaled = os.path.join(self.tmp.name, 'scaled.txt')
+        utils.save_outlines_to_txt_chunked(utils.iter_scale_outlines(f, 2, chunk_size=4), scaled)
+        self.assert_outlines_equal([utils.read_outlines_from_txt(scaled)], utils.scale_outlines(f, 2))
+
+        csv = os.path.join(self.tmp.name, 'cells.csv')
+        utils.save_wkt_polygons_to_csv_chunked(utils.iter_outlines_to_wkt_polygons(f, chunk_size=4), csv)
+        pd.testing.assert_frame_equal(pd.read_csv(csv), utils.outlines_to_wkt_polygons(f))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,9 +15,6 @@ from bokeh.models import LinearColorMapper, ColorBar
 from bokeh.transform import transform
 from bokeh.plotting import figure
 from bokeh.palettes import Blues9
-from scipy.stats import gaussian_kde
-import base64
-from io import BytesIO
 import numpy as np
 
 from bokeh.layouts import gridplot, row, column
@@ -26,104 +23,114 @@ from bokeh.models import (BoxSelectTool, LassoSelectTool, DataTable, NumberEdito
                           StringEditor, StringFormatter, Select, HoverTool,
                           ColumnDataSource, TableColumn, Dropdown, Button)
 from bokeh.models import ColumnDataSource, Grid, LinearAxis, Patches, Plot
-from bokeh.models import CustomJS
+from bokeh.models import CustomJS, TMSTileSource, Div
 from bokeh.plotting import curdoc, figure
-from PIL import Image
+from bokeh.plotting.contour import contour_data
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
 from bokeh.sampledata.autompg2 import autompg2 as mpg
-from abscr.analysis.analysis import calc_convexity, calc_roundness, calc_solidity
-from shapely import Polygon, centroid
-from shapely.geometry import Point
-from shapely.plotting import plot_polygon, plot_points
-from shapely import measurement
+from abscr.analysis.density import DensityEstimator
+from abscr.analysis.features import FEATURE_COLUMNS, FeatureSidecar
+from abscr.util.tile_pyramid import TilePyramid, serve
 import pandas as pd
 
 DATA_DIR = 'data'
+# Tile pyramids of the images, built once per image file and shared by all sessions
+TILE_CACHE_DIR = os.path.join(DATA_DIR, '.tiles')
+# The tiles are served on ABSCR_TILE_HOST:ABSCR_TILE_PORT, by default to this machine only. To open the app
+# from other machines, set ABSCR_TILE_HOST=0.0.0.0 (and a fixed, reachable ABSCR_TILE_PORT); browsers then
+# load the tiles from the host name they reach the app under, or from ABSCR_TILE_URL if it is set
+TILE_HOST = os.environ.get('ABSCR_TILE_HOST', '127.0.0.1')
+TILE_PORT = int(os.environ.get('ABSCR_TILE_PORT', 0))
+TILE_URL = os.environ.get('ABSCR_TILE_URL')
+# Per-cell features of the outline files, computed once per file and reused while it is unchanged
+FEATURE_CACHE_DIR = os.path.join(DATA_DIR, '.features')
+
+doc = curdoc()
+# features of outline files without a valid sidecar are computed in the background
+feature_executor = ThreadPoolExecutor(max_workers=1)
 
 
 def load_image(img_filename):
-    image = Image.open(os.path.join(DATA_DIR, img_filename)).convert('L')
-    image.save("data/image-file-compressed.jpg",
-               "JPEG",
-               optimize=True,
-               quality=10)
+    return TilePyramid(os.path.join(DATA_DIR, img_filename), TILE_CACHE_DIR).build()
 
-    return Image.open('data/image-file-compressed.jpg')
 
+def tile_base_url():
+    base_url = serve(TILE_CACHE_DIR, host=TILE_HOST, port=TILE_PORT, public_url=TILE_URL)
+    request = doc.session_context.request if doc.session_context is not None else None
+    if TILE_URL is None and TILE_HOST in ('0.0.0.0', '::') and request is not None:
+        # the host name the browser reaches the app under reaches the tile server as well
+        browser_host = urlsplit('//' + request.headers.get('Host', '')).hostname
+        if browser_host:
+            base_url = f'http://{browser_host}:{urlsplit(base_url).port}'
+    return base_url
 
-def load_outlines(filename):
-    with open(os.path.join(DATA_DIR, filename)) as f:
-        outlines = f.readlines()
-    return outlines
+
+def image_tile_source(pyramid):
+    # tiles are served by an HTTP server in plot units of image pixels, with y pointing up
+    return TMSTileSource(url=pyramid.url_template(tile_base_url()),
+                         tile_size=pyramid.tile_size,
+                         initial_resolution=2 ** pyramid.max_zoom,
+                         min_zoom=0,
+                         max_zoom=pyramid.max_zoom,
+                         x_origin_offset=0,
+                         y_origin_offset=0,
+                         wrap_around=False)
 
 
 def handle_image(attr, old, new):
-    image = load_image(new)
-    return image
+    image_tiles.tile_source = image_tile_source(load_image(new))
 
 
-def polygons_from_outlines(outlines):
-    polygons = []
-    for o in outlines:
-        if len(o) < 2:
-            continue
-        coords_flat = np.fromstring(o, sep=',').astype(int)
-        # make pairs x, y
-        polyg = np.array([np.array(x)
-                         for x in zip(coords_flat[::2], coords_flat[1::2])])
-        polygons.append(polyg)
-    return polygons
+def load_features(filename, progress=None):
+    return FeatureSidecar(os.path.join(DATA_DIR, filename), cache_dir=FEATURE_CACHE_DIR).get(progress=progress)
 
 
-def handle_outlines(attr, old, new):
-    outlines = load_outlines(new)
-    polygons = polygons_from_outlines(outlines)
-    return
+def show_progress(filename, done, total):
+    status.text = f'Computing the features of {filename}: {done}/{total} cells'
 
 
-# dropdown_outlines.on_change('value', handle_outlines)
-# END DROPDWON
+def features_loaded(filename, future):
+    # ignore the result if another file was selected in the meantime
+    if dropdown_outlines.value != filename:
+        return
+    try:
+        features, polygons = future.result()
+    except Exception as e:
+        status.text = f'Failed to load {filename}: {e}'
+        return
+    set_dataset(filename, features, polygons)
+    status.text = ''
 
 
-# PATCHES
-def get_polygons(filename):
-    outlines = load_outlines(filename)
-    polygons = polygons_from_outlines(outlines)
-    return polygons
-
+def handle_outlines(attr, old, new):
+    if not new:
+        return
+    sidecar = FeatureSidecar(os.path.join(DATA_DIR, new), cache_dir=FEATURE_CACHE_DIR)
+    if sidecar.is_valid():
+        features, polygons = sidecar.load()
+        set_dataset(new, features, polygons)
+        return
 
-outlines_filename = '020_Buccal_05.04.2022_small_cp_outlines(2).txt'
-polygs = get_polygons(outlines_filename)
+    def progress(done, total):
+        doc.add_next_tick_callback(partial(show_progress, new, done, total))
 
+    status.text = f'Computing the features of {new}'
+    future = feature_executor.submit(sidecar.compute, progress=progress)
+    future.add_done_callback(lambda f: doc.add_next_tick_callback(partial(features_loaded, new, f)))
 
-def create_df(polygons):
-    diams = []
-    convs = []
-    solds = []
-    rounds = []
-    xs = []
-    ys = []
 
-    for i, poly in enumerate(polygons):  # np.expand_dims(polygons, axis=0)
-        cur_poly = Polygon(poly)
-        mbr = measurement.minimum_bounding_radius(cur_poly)
-        cntr = centroid(cur_poly)
+# END DROPDWON
 
-        xs.append(cntr.x)
-        ys.append(cntr.y)
-        diams.append(mbr*2)
 
-        convexity = calc_convexity(cur_poly)
-        solidity = calc_solidity(cur_poly)
-        roundness = calc_roundness(cur_poly)
+outlines_filename = '020_Buccal_05.04.2022_small_cp_outlines(2).txt'
+features, polygs = load_features(outlines_filename)
 
-        convs.append(convexity)
-        solds.append(solidity)
-        rounds.append(roundness)
 
-    data = [xs, ys, diams, convs, solds, rounds]
-    df = pd.DataFrame(data).T
-    df.columns = ['x', 'y', 'diameter', 'convexity', 'solidity', 'roundness']
+def create_df(features):
+    df = pd.DataFrame({c: features[c] for c in FEATURE_COLUMNS})
     df['cell_class'] = None
     return df.round(2)
 
@@ -145,7 +152,7 @@ def create_data_table(dataframe):
     return (data_table, source)
 
 
-df = create_df(polygs)
+df = create_df(features)
 data_table, source = create_data_table(df)
 
 
@@ -157,28 +164,12 @@ table_button = Button(label="Press to set", button_type="success")
 table_button.on_click(update_labels)
 
 
-def im_2_b64(image):
-    buff = BytesIO()
-    image.save(buff, format="png")
-    img_str = base64.b64encode(buff.getvalue())
-    return img_str
-
-
 TOOLS = "pan, wheel_zoom, box_select, lasso_select, reset"
 
 #  IMAGE
 img_filename = '020_Buccal_05.04.2022_small.jpeg'
 img = load_image(img_filename)
 
-# TODO: flip?
-img = Image.fromarray(np.flipud(img))
-
-img_arr = np.array(img)
-# print(img_arr.shape)
-img_b64 = im_2_b64(img)
-
-url = 'data:image/png;base64,' + img_b64.decode('utf-8')
-
 # create the scatter plot
 aspect_ratio = 500/1100
 p = figure(tools=TOOLS,
@@ -198,13 +189,8 @@ r = p.circle(x="x", y="y", fill_color="#396285",
              size=10, alpha=0.0, source=source, )
 
 
-p.image_url(url=[url],
-            x=0,
-            y=0,
-            w=img_arr.shape[1],
-            h=img_arr.shape[0],
-            anchor="bottom_left",
-            global_alpha=0.8)
+# The image is drawn from its tile pyramid, so only the tiles in view are loaded, at the resolution of the zoom
+image_tiles = p.add_tile(image_tile_source(img), alpha=0.8)
 
 # create the horizontal histogram
 hhist, hedges = np.histogram(df.x.values, bins=32)
@@ -215,20 +201,17 @@ hmax = max(hhist)*1.1
 # KDE
 
 
-def kde(x, y, N):
-    xmin, xmax = x.min(), x.max()
-    ymin, ymax = y.min(), y.max()
+def kde(filename, x, y, N):
+    # binned FFT estimate, cached per outline file and recomputed only for the selected cells
+    return DensityEstimator.for_file(os.path.join(DATA_DIR, filename), x, y, grid_size=N)
 
-    X, Y = np.mgrid[xmin:xmax:N*1j, ymin:ymax:N*1j]
-    positions = np.vstack([X.ravel(), Y.ravel()])
-    values = np.vstack([x, y])
-    kernel = gaussian_kde(values)
-    Z = np.reshape(kernel(positions).T, X.shape)
 
-    return X, Y, Z
+def kde_levels(z):
+    return np.linspace(np.min(z), np.max(z), 10)[1:]
 
 
-x, y, z = kde(df.x, df.y, 300)
+density = kde(outlines_filename, df.x, df.y, 300)
+kde_x, kde_y, z = density.density()
 
 pkde = figure(toolbar_location=None, width=p.width, height=200, x_range=p.x_range,
               min_border=0, min_border_left=0)
@@ -237,8 +220,7 @@ pkde.grid.grid_line_color = "black"
 pkde.grid.grid_line_alpha = 0.05
 
 palette = Blues9[::-1]
-levels = np.linspace(np.min(z), np.max(z), 10)
-pkde.contour(x, y, z, levels[1:], fill_color=palette, line_color=palette)
+kde_contours = pkde.contour(kde_x, kde_y, z, kde_levels(z), fill_color=palette, line_color=palette)
 
 
 LINE_ARGS = dict(color="#3A5785", line_color=None)
@@ -249,8 +231,8 @@ ph.xgrid.grid_line_color = None
 ph.yaxis.major_label_orientation = np.pi/4
 ph.background_fill_color = "#fafafa"
 
-ph.quad(bottom=0, left=hedges[:-1], right=hedges[1:],
-        top=hhist, color="white", line_color="#3A5785")
+hh0 = ph.quad(bottom=0, left=hedges[:-1], right=hedges[1:],
+              top=hhist, color="white", line_color="#3A5785")
 hh1 = ph.quad(
     bottom=0, left=hedges[:-1], right=hedges[1:], top=hzeros, alpha=0.5, **LINE_ARGS)
 hh2 = ph.quad(
@@ -268,23 +250,21 @@ dropdown_image.on_change('value', handle_image)
 
 menu_outlines = [x for x in os.listdir('data') if x[-3:] == 'txt']
 menu_outlines.insert(0, '')
-dropdown_outlines = Select(value=menu_outlines[0], options=menu_outlines)
+dropdown_outlines = Select(value=outlines_filename if outlines_filename in menu_outlines else menu_outlines[0],
+                           options=menu_outlines)
+dropdown_outlines.on_change('value', handle_outlines)
+status = Div(text='')
 # dropdown_outlines.js_on_event("menu_item_click", CustomJS(
 #     code="console.log('dropdown_outlines: ' + this.item, this.toString())"))
 
 
-xs = []
-ys = []
-for polygs in polygs:
-    xs.append([x[0] for x in polygs])
-    ys.append([x[1] for x in polygs])
+def patches_data(polygons, df):
+    return dict(xs=[p[:, 0] for p in polygons],
+                ys=[p[:, 1] for p in polygons],
+                diameter=df['diameter'])
 
-poly_source = ColumnDataSource(dict(
-    xs=xs,
-    ys=ys,
-    diameter=df['diameter']
-)
-)
+
+poly_source = ColumnDataSource(patches_data(polygs, df))
 
 color_mapper = LinearColorMapper(palette="Viridis256",
                                  low=df.diameter.min(),
@@ -308,12 +288,33 @@ tooltips = [
 ]
 p.add_tools(HoverTool(tooltips=tooltips))
 
-layout = gridplot([[row(dropdown_image, dropdown_outlines)],
+layout = gridplot([[row(dropdown_image, dropdown_outlines, status)],
                    [column(p, pkde, ph), column(data_table, table_button)],]
                   )
 
-curdoc().add_root(layout)
-curdoc().title = "Annotation viz app"
+doc.add_root(layout)
+doc.title = "Annotation viz app"
+
+
+def set_dataset(filename, features, polygons):
+    global df, hedges, hzeros, density, kde_x, kde_y
+    df = create_df(features)
+    source.selected.indices = []
+    source.data = ColumnDataSource.from_df(df)
+    poly_source.data = patches_data(polygons, df)
+    color_mapper.update(low=df.diameter.min(), high=df.diameter.max())
+
+    hhist, hedges = np.histogram(df.x.values, bins=32)
+    hzeros = np.zeros(len(hedges)-1)
+    hmax = max(hhist)*1.1
+    ph.y_range.update(start=-hmax, end=hmax)
+    hh0.data_source.data = dict(left=hedges[:-1], right=hedges[1:], top=hhist)
+    for hh in (hh1, hh2):
+        hh.data_source.data = dict(left=hedges[:-1], right=hedges[1:], top=hzeros)
+
+    density = kde(filename, df.x, df.y, 300)
+    kde_x, kde_y, z = density.density()
+    kde_contours.set_data(contour_data(kde_x, kde_y, z, kde_levels(z)))
 
 
 def update(attr, old, new):
@@ -329,5 +330,11 @@ def update(attr, old, new):
     hh1.data_source.data["top"] = hhist1
     hh2.data_source.data["top"] = -hhist2
 
+    # the density panel follows the selection
+    _, _, z = density.density(inds if len(inds) > 1 else None)
+    if np.max(z) == 0:
+        _, _, z = density.density()
+    kde_contours.set_data(contour_data(kde_x, kde_y, z, kde_levels(z)))
+
 
 r.data_source.selected.on_change('indices', update)